@@ -0,0 +1,267 @@
+import asyncio
+import logging
+from urllib.parse import quote_plus as url_quote
+
+from django.conf import settings
+from django.utils import timezone
+import httpx
+from requests.exceptions import ConnectionError, HTTPError, RequestException
+
+from send_money.circuit_breaker import CircuitBreaker
+from send_money.govuk_pay import GovUkPayClient, RequestPriority
+from send_money.mail import send_email_for_card_payment_on_hold
+from send_money.payments import CapturableStep, GovUkPaymentStatus, PaymentClient
+from send_money.utils import api_url, govuk_headers, govuk_url
+
+logger = logging.getLogger('mtp')
+
+
+def raise_for_status(response):
+    """
+    Raises the same type of exception as `requests` would so that callers can handle both clients alike.
+    """
+    if response.is_error:
+        raise HTTPError(
+            'Status code %s for %s' % (response.status_code, response.url),
+            response=response,
+        )
+
+
+def parse_json(response):
+    """
+    Decodes the response body raising a `requests` exception, as `requests` would, if it is not valid JSON.
+    """
+    try:
+        return response.json()
+    except ValueError:
+        raise RequestException('Cannot parse response', response=response)
+
+
+class AsyncPaymentClient:
+    """
+    Asynchronous counterpart of PaymentClient used to reconcile many payments concurrently from a single thread.
+
+    All decisions are made by a PaymentClient's methods that make no requests so that both behave identically;
+    only calls to the MTP API and GOV.UK Pay are made here, asynchronously.
+    Errors are raised as `requests` exceptions for the same reason and requests share circuit breakers.
+    """
+    transport = None
+
+    def __init__(self, max_connections=100):
+        self.payment_client = PaymentClient(govuk_pay_priority=RequestPriority.background)
+        self.max_connections = max_connections
+        self.client = None
+
+    async def __aenter__(self):
+        # authenticating with the MTP API happens once so it's not worth doing asynchronously
+        await asyncio.to_thread(getattr, self.payment_client, 'api_session')
+        self.client = httpx.AsyncClient(
+            transport=self.transport,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+            timeout=15,
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.client.aclose()
+        self.client = None
+
+    async def request(self, method, url, circuit_breaker, **kwargs):
+        circuit_breaker.before_request()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            circuit_breaker.record(True)
+            raise ConnectionError(str(e)) from e
+        except BaseException as e:
+            # e.g. other httpx errors or cancellation; an outcome is always recorded
+            # so that a half-open circuit breaker does not wait for a probe forever
+            circuit_breaker.record(circuit_breaker.is_failure(exception=e))
+            raise
+        circuit_breaker.record(circuit_breaker.is_failure(response=response))
+        return response
+
+    async def govuk_request(self, method, path, endpoint, **kwargs):
+        """
+        Makes a request to GOV.UK Pay sharing the rate limiter of GovUkPayClient; see GovUkPayClient.request
+        """
+        rate_limiter = self.payment_client.govuk_pay_client.rate_limiter
+        priority = self.payment_client.govuk_pay_priority
+        retries = settings.GOVUK_PAY_RATE_LIMIT_RETRIES
+        while True:
+            while delay := rate_limiter.try_acquire(priority):
+                await asyncio.sleep(delay)
+            response = await self.request(
+                method, govuk_url(path), CircuitBreaker.get('govuk_pay'),
+                headers=govuk_headers(),
+                timeout=GovUkPayClient.get_timeout(endpoint),
+                **kwargs
+            )
+            if response.status_code != 429:
+                rate_limiter.record_success()
+                return response
+
+            delay = rate_limiter.record_throttled(response.headers.get('Retry-After'))
+            if retries <= 0:
+                return response
+            retries -= 1
+            logger.warning(
+                'GOV.UK Pay rate limit reached, retrying %(endpoint)s in %(delay)0.1f seconds',
+                {'endpoint': endpoint, 'delay': delay},
+            )
+
+    async def api_request(self, method, path, **kwargs):
+        token = self.payment_client.api_session.token
+        response = await self.request(
+            method, api_url(path), CircuitBreaker.get('api'),
+            headers={'Authorization': 'Bearer %s' % token['access_token']},
+            timeout=30,
+            **kwargs
+        )
+        raise_for_status(response)
+        return parse_json(response)
+
+    async def get_incomplete_payments(self):
+        older_than = timezone.now() - self.payment_client.CHECK_INCOMPLETE_PAYMENT_DELAY
+        page_size = settings.REQUEST_PAGE_SIZE
+        loaded_results = []
+
+        offset = 0
+        while True:
+            content = await self.api_request('GET', '/payments/', params=dict(
+                limit=page_size, offset=offset, modified__lt=older_than.isoformat(),
+            ))
+            count = content.get('count', 0)
+            loaded_results += [
+                self.payment_client.compact_payment(payment)
+                for payment in content.get('results', [])
+            ]
+            if len(loaded_results) >= count:
+                break
+            offset += page_size
+
+        return loaded_results
+
+    async def update_payment(self, payment_ref, payment_update):
+        if not payment_ref:
+            raise ValueError('payment_ref must be provided')
+        return await self.api_request('PATCH', '/payments/%s/' % url_quote(payment_ref), json=payment_update)
+
+    async def get_govuk_payment(self, govuk_id):
+        response = await self.govuk_request('GET', '/payments/%s' % govuk_id, endpoint='get_payment')
+
+        if response.status_code != 200:
+            if response.status_code == 404:
+                return None
+            raise RequestException(
+                'Unexpected status code: %s' % response.status_code,
+                response=response
+            )
+        return self.payment_client.parse_govuk_payment(response)
+
+    async def get_govuk_payment_events(self, govuk_id):
+        response = await self.govuk_request('GET', f'/payments/{govuk_id}/events', endpoint='get_payment_events')
+
+        raise_for_status(response)
+
+        try:
+            return parse_json(response)['events']
+        except KeyError:
+            raise RequestException('Cannot parse response', response=response)
+
+    async def capture_govuk_payment(self, govuk_payment):
+        return await self.finalise_govuk_payment(govuk_payment, 'capture', GovUkPaymentStatus.success)
+
+    async def cancel_govuk_payment(self, govuk_payment):
+        return await self.finalise_govuk_payment(govuk_payment, 'cancel', GovUkPaymentStatus.cancelled)
+
+    async def finalise_govuk_payment(self, govuk_payment, action, new_govuk_status):
+        govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
+        if govuk_status is None or govuk_status.finished():
+            return govuk_status
+
+        govuk_id = govuk_payment['payment_id']
+        response = await self.govuk_request('POST', f'/payments/{govuk_id}/{action}', endpoint=f'{action}_payment')
+
+        raise_for_status(response)
+
+        return self.payment_client.set_finalised_govuk_status(govuk_payment, new_govuk_status)
+
+    async def payment_timed_out_after_capturable(self, govuk_payment):
+        """
+        See GovUkPaymentStatus.payment_timed_out_after_capturable
+        """
+        if not GovUkPaymentStatus.may_have_timed_out_after_capturable(govuk_payment):
+            return False
+
+        govuk_id = govuk_payment['payment_id']
+        events_cache = self.payment_client.govuk_payment_events_cache
+        if govuk_id not in events_cache:
+            events_cache[govuk_id] = await self.get_govuk_payment_events(govuk_id)
+        return GovUkPaymentStatus.events_include_capturable(events_cache[govuk_id])
+
+    async def check_payment(self, payment, govuk_payment=None, on_checked=None):
+        """
+        See PaymentClient.check_payment
+        """
+        govuk_id = payment['processor_id']
+        if govuk_payment is None:
+            govuk_payment = await self.get_govuk_payment(govuk_id)
+        previous_govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
+        govuk_status = await self.complete_payment_if_necessary(payment, govuk_payment)
+        if on_checked:
+            on_checked(previous_govuk_status, govuk_status)
+
+        if govuk_status and not govuk_status.finished():
+            return None
+
+        if previous_govuk_status != govuk_status and not self.payment_client.has_completion_details(govuk_payment):
+            govuk_payment = await self.get_govuk_payment(govuk_id)
+
+        return await self.update_completed_payment(payment, govuk_payment)
+
+    async def complete_payment_if_necessary(self, payment, govuk_payment):
+        """
+        See PaymentClient.complete_payment_if_necessary
+        """
+        govuk_status, payment_attr_updates = self.payment_client.get_completion_updates(payment, govuk_payment)
+        if payment_attr_updates is None:
+            return govuk_status
+
+        if payment_attr_updates:
+            # update instead of replace payment because we want to keep the same reference
+            payment.update(
+                **await self.update_payment(payment['uuid'], payment_attr_updates),
+            )
+
+        if govuk_status == GovUkPaymentStatus.capturable:
+            step = self.payment_client.get_capturable_step(payment, payment_attr_updates)
+            if step == CapturableStep.notify_on_hold:
+                await asyncio.to_thread(send_email_for_card_payment_on_hold, payment_attr_updates['email'], payment)
+            elif step == CapturableStep.capture:
+                govuk_status = await self.capture_govuk_payment(govuk_payment)
+            elif step == CapturableStep.cancel:
+                govuk_status = await self.cancel_govuk_payment(govuk_payment)
+
+        return govuk_status
+
+    async def update_completed_payment(self, payment, govuk_payment):
+        """
+        See PaymentClient.update_completed_payment
+        """
+        timed_out_after_capturable = await self.payment_timed_out_after_capturable(govuk_payment)
+
+        payment_attr_updates = self.payment_client.get_completed_payment_attr_updates(
+            payment, govuk_payment, timed_out_after_capturable,
+        )
+        await self.update_payment(payment['uuid'], payment_attr_updates)
+
+        # send notification email; sending is synchronous unless spooled
+        await asyncio.to_thread(
+            self.payment_client.send_completed_payment_email,
+            payment, govuk_payment, timed_out_after_capturable,
+        )
+        return payment_attr_updates['status']
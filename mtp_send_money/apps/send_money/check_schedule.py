@@ -0,0 +1,97 @@
+from datetime import timedelta
+import threading
+
+from django.utils import timezone
+
+from send_money.check_store import PaymentCheckStore
+
+
+class PaymentCheckSchedule:
+    """
+    Decides when each incomplete payment is next checked on GOV.UK Pay by `update_incomplete_payments --daemon`.
+
+    Checks are recorded in a PaymentCheckStore which backs off from payments found in the same GOV.UK status
+    in the same way as for runs started by cron; the schedule only keeps when each listed payment is next due
+    so that the daemon can wait for it. A payment is due immediately when its security check changes
+    so that accepted payments are captured as soon as the change is listed.
+
+    Times are `time.monotonic()` values.
+    """
+    # payments whose check failed are tried again after this long
+    retry_delay = timedelta(minutes=1)
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        # scheduled checks keyed by payment uuid
+        self.checks = {}
+
+    def __len__(self):
+        return len(self.checks)
+
+    def get_due(self, payment, now):
+        """
+        :return: when the payment is due according to the checks recorded in the store
+        """
+        due = self.store.get_due(payment)
+        if due is None:
+            return now
+        return now + max((due - timezone.now()).total_seconds(), 0)
+
+    def refresh(self, payments, now):
+        """
+        Updates the schedule with the current list of incomplete payments;
+        payments no longer listed have been completed and are forgotten.
+        """
+        with self.lock:
+            checks = {}
+            for payment in payments:
+                security_check_status = PaymentCheckStore.get_security_check_status(payment)
+                check = self.checks.get(payment['uuid'])
+                if not check or check['security_check_status'] != security_check_status:
+                    check = {
+                        'due': self.get_due(payment, now),
+                        'security_check_status': security_check_status,
+                    }
+                check['payment'] = payment
+                checks[payment['uuid']] = check
+            self.checks = checks
+
+    def take_due(self, now):
+        """
+        Returns payments that are due, most overdue first, and postpones them by `retry_delay`
+        so that they are tried again later if their check fails.
+        """
+        with self.lock:
+            due_checks = sorted(
+                (check for check in self.checks.values() if check['due'] <= now),
+                key=lambda check: check['due'],
+            )
+            for check in due_checks:
+                check['due'] = now + self.retry_delay.total_seconds()
+            return [check['payment'] for check in due_checks]
+
+    def get_next_due(self):
+        """
+        :return: when the next payment is due or None if there are no payments
+        """
+        with self.lock:
+            return min((check['due'] for check in self.checks.values()), default=None)
+
+    def postpone(self, payment, delay, now):
+        with self.lock:
+            check = self.checks.get(payment['uuid'])
+            if check:
+                check['due'] = now + delay.total_seconds()
+
+    def record_check(self, payment, govuk_status, now):
+        """
+        Records that a payment was checked and found in `govuk_status` and schedules its next check.
+
+        :param govuk_status: GovUkPaymentStatus or None if the GOV.UK payment was not found
+        """
+        self.store.record_check(payment, govuk_status)
+        with self.lock:
+            check = self.checks.get(payment['uuid'])
+            if check:
+                check['due'] = self.get_due(payment, now)
@@ -0,0 +1,124 @@
+from datetime import datetime, timedelta
+import sqlite3
+import threading
+
+from django.utils import timezone
+
+
+class PaymentCheckStore:
+    """
+    Records when incomplete payments were last checked on GOV.UK Pay in a SQLite database
+    so that `update_incomplete_payments` can back off from payments that are not changing.
+    Runs started by cron use a database on persistent storage; the daemon keeps one in memory (`:memory:`)
+    and uses PaymentCheckSchedule to wait until payments are due.
+
+    The delay before a payment is checked again doubles every time it is found in the same
+    GOV.UK status, starting from the initial delay for that status and up to its maximum.
+    Payments are due immediately if they were never checked or if their security check has changed.
+    """
+    # GOV.UK status: (initial delay, maximum delay)
+    back_off = {
+        'created': (timedelta(minutes=2), timedelta(hours=1)),
+        'started': (timedelta(minutes=2), timedelta(hours=1)),
+        'submitted': (timedelta(minutes=1), timedelta(minutes=30)),
+        # decided by FIU whose actions make payments due immediately
+        'capturable': (timedelta(minutes=30), timedelta(hours=6)),
+        # waiting for settlement data after capture
+        'success': (timedelta(minutes=1), timedelta(minutes=30)),
+    }
+    default_back_off = (timedelta(minutes=2), timedelta(hours=1))
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS payment_checks ('
+            'uuid TEXT PRIMARY KEY, '
+            'last_checked TEXT NOT NULL, '
+            'govuk_status TEXT NOT NULL, '
+            'security_check_status TEXT NOT NULL, '
+            'attempts INTEGER NOT NULL'
+            ')'
+        )
+
+    def close(self):
+        self.connection.close()
+
+    @classmethod
+    def get_security_check_status(cls, payment):
+        return (payment.get('security_check') or {}).get('status') or ''
+
+    def get_check(self, payment_ref):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT last_checked, govuk_status, security_check_status, attempts '
+                'FROM payment_checks WHERE uuid = ?',
+                (payment_ref,),
+            ).fetchone()
+        if not row:
+            return None
+        last_checked, govuk_status, security_check_status, attempts = row
+        return {
+            'last_checked': datetime.fromisoformat(last_checked),
+            'govuk_status': govuk_status,
+            'security_check_status': security_check_status,
+            'attempts': attempts,
+        }
+
+    def get_delay(self, govuk_status, attempts):
+        """
+        :return: timedelta to wait before checking a payment found in `govuk_status` `attempts` times in a row
+        """
+        initial_delay, maximum_delay = self.back_off.get(govuk_status, self.default_back_off)
+        return min(initial_delay * 2 ** (attempts - 1), maximum_delay)
+
+    def get_due(self, payment):
+        """
+        :return: datetime when the payment should next be checked on GOV.UK Pay or None if it is due now
+        """
+        check = self.get_check(payment['uuid'])
+        if not check:
+            return None
+        if check['security_check_status'] != self.get_security_check_status(payment):
+            return None
+        return check['last_checked'] + self.get_delay(check['govuk_status'], check['attempts'])
+
+    def is_due(self, payment, now=None):
+        """
+        :return: True if the payment should be checked on GOV.UK Pay now
+        """
+        due = self.get_due(payment)
+        return due is None or (now or timezone.now()) >= due
+
+    def record_check(self, payment, govuk_status, now=None):
+        """
+        Records that the payment was checked and found in `govuk_status`.
+
+        :param govuk_status: GovUkPaymentStatus or None if the GOV.UK payment was not found
+        """
+        now = now or timezone.now()
+        govuk_status = govuk_status.name if govuk_status else ''
+        security_check_status = self.get_security_check_status(payment)
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO payment_checks '
+                '(uuid, last_checked, govuk_status, security_check_status, attempts) '
+                'VALUES (?, ?, ?, ?, 1) '
+                'ON CONFLICT (uuid) DO UPDATE SET '
+                'attempts = CASE WHEN govuk_status = excluded.govuk_status '
+                'AND security_check_status = excluded.security_check_status THEN attempts + 1 ELSE 1 END, '
+                'last_checked = excluded.last_checked, '
+                'govuk_status = excluded.govuk_status, '
+                'security_check_status = excluded.security_check_status',
+                (payment['uuid'], now.isoformat(), govuk_status, security_check_status),
+            )
+
+    def prune(self, older_than):
+        """
+        Forgets payments not checked since `older_than` which have probably been completed.
+        """
+        with self.lock:
+            self.connection.execute(
+                'DELETE FROM payment_checks WHERE last_checked < ?',
+                (older_than.isoformat(),),
+            )
@@ -0,0 +1,202 @@
+from collections import deque
+from contextlib import contextmanager
+import enum
+import logging
+import threading
+import time
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+logger = logging.getLogger('mtp')
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of making a request to an upstream whose circuit breaker is open.
+    It is a `requests` ConnectionError so that callers handle it like the upstream being unreachable.
+    """
+
+
+class CircuitState(enum.Enum):
+    # requests are made
+    closed = 'closed'
+    # requests fail immediately
+    open = 'open'
+    # a few requests are made to probe whether the upstream recovered
+    half_open = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Stops making requests to an upstream for a while when too many recent ones failed
+    so that threads do not wait for timeouts while it is degraded.
+
+    The breaker opens when at least CIRCUIT_BREAKER_FAILURE_RATE of the requests made in the last
+    CIRCUIT_BREAKER_WINDOW seconds failed, provided there were at least CIRCUIT_BREAKER_MINIMUM_REQUESTS.
+    After CIRCUIT_BREAKER_OPEN_DURATION seconds, it becomes half-open: one request at a time is let through
+    and the breaker closes if it succeeds or opens again if it fails.
+
+    Failures are connection errors, timeouts and 5xx responses.
+    Breakers are shared by all threads in a process (see `get`).
+    """
+    breakers_lock = threading.Lock()
+    breakers = {}
+
+    @classmethod
+    def get(cls, name):
+        """
+        :return: the CircuitBreaker shared by all requests to upstream `name`
+        """
+        with cls.breakers_lock:
+            if name not in cls.breakers:
+                cls.breakers[name] = cls(name)
+            return cls.breakers[name]
+
+    @classmethod
+    def reset_all(cls):
+        with cls.breakers_lock:
+            for breaker in cls.breakers.values():
+                breaker.reset()
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.state = CircuitState.closed
+        # (time, failed) of requests made in the last CIRCUIT_BREAKER_WINDOW seconds while closed
+        self.outcomes = deque()
+        self.opened_at = None
+        self.probing = False
+
+    @classmethod
+    def is_failure(cls, response=None, exception=None):
+        if exception is not None:
+            if isinstance(exception, (ConnectionError, Timeout)):
+                return True
+            response = getattr(exception, 'response', None)
+            if response is None:
+                return False
+        return response is not None and response.status_code >= 500
+
+    def before_request(self):
+        """
+        :raise CircuitOpenError: if the request should not be made
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.state == CircuitState.open:
+                if now - self.opened_at < settings.CIRCUIT_BREAKER_OPEN_DURATION:
+                    raise CircuitOpenError(f'Circuit breaker for {self.name} is open')
+                self.state = CircuitState.half_open
+                self.probing = False
+            if self.state == CircuitState.half_open:
+                if self.probing:
+                    raise CircuitOpenError(f'Circuit breaker for {self.name} is waiting for a probe request')
+                self.probing = True
+
+    def record(self, failed):
+        with self.lock:
+            now = time.monotonic()
+            if self.state == CircuitState.half_open:
+                self.probing = False
+                if failed:
+                    self.open(now)
+                else:
+                    logger.info('Circuit breaker for %(name)s closed', {'name': self.name})
+                    self.state = CircuitState.closed
+                    self.outcomes.clear()
+                return
+            if self.state == CircuitState.open:
+                # a request started before the breaker opened
+                return
+
+            self.outcomes.append((now, failed))
+            while self.outcomes and self.outcomes[0][0] < now - settings.CIRCUIT_BREAKER_WINDOW:
+                self.outcomes.popleft()
+            failures = sum(1 for _, outcome_failed in self.outcomes if outcome_failed)
+            if (
+                failed
+                and len(self.outcomes) >= settings.CIRCUIT_BREAKER_MINIMUM_REQUESTS
+                and failures / len(self.outcomes) >= settings.CIRCUIT_BREAKER_FAILURE_RATE
+            ):
+                self.open(now)
+
+    def open(self, now):
+        logger.warning(
+            'Circuit breaker for %(name)s opened for %(duration)s seconds',
+            {'name': self.name, 'duration': settings.CIRCUIT_BREAKER_OPEN_DURATION},
+        )
+        self.state = CircuitState.open
+        self.opened_at = now
+        self.outcomes.clear()
+
+    @contextmanager
+    def guard(self):
+        """
+        Context manager around a request that raises `requests` exceptions for failures,
+        e.g. one made using an MTP API session.
+        """
+        self.before_request()
+        try:
+            yield
+        except (ConnectionError, Timeout, HTTPError) as e:
+            self.record(self.is_failure(exception=e))
+            raise
+        except BaseException:
+            self.record(False)
+            raise
+        self.record(False)
+
+    @property
+    def is_open(self):
+        with self.lock:
+            return (
+                self.state == CircuitState.open
+                and time.monotonic() - self.opened_at < settings.CIRCUIT_BREAKER_OPEN_DURATION
+            )
+
+
+class CircuitBreakerAdapter(HTTPAdapter):
+    """
+    `requests` transport adapter that makes requests only while the upstream's circuit breaker allows it.
+    It is mounted by the MTP API and GOV.UK Pay sessions.
+    """
+    observers_lock = threading.Lock()
+    # callables taking (method, url, response, elapsed) called after every request made by these adapters;
+    # response is None if the request failed
+    observers = ()
+
+    @classmethod
+    def add_observer(cls, observe):
+        with cls.observers_lock:
+            cls.observers += (observe,)
+
+    @classmethod
+    def remove_observer(cls, observe):
+        with cls.observers_lock:
+            observers = list(cls.observers)
+            observers.remove(observe)
+            cls.observers = tuple(observers)
+
+    def __init__(self, circuit_breaker, **kwargs):
+        self.circuit_breaker = circuit_breaker
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.circuit_breaker.before_request()
+        start = time.perf_counter()
+        response = None
+        try:
+            response = super().send(request, **kwargs)
+        except BaseException as e:
+            self.circuit_breaker.record(self.circuit_breaker.is_failure(exception=e))
+            raise
+        finally:
+            for observe in self.observers:
+                observe(request.method, request.url, response, time.perf_counter() - start)
+        self.circuit_breaker.record(self.circuit_breaker.is_failure(response=response))
+        return response
@@ -1,18 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import decimal
+import hashlib
+import json
 import logging
 import threading
 
 from django import forms
 from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator
+from django.utils.crypto import constant_time_compare
 from django.utils.translation import gettext, gettext_lazy as _
 from mtp_common.auth.exceptions import HttpNotFoundError
 from mtp_common.forms.fields import SplitDateField
 from oauthlib.oauth2 import OAuth2Error, TokenExpiredError
 from requests.exceptions import RequestException
 
+from send_money.metrics import prisoner_validity_lookups
 from send_money.models import PaymentMethodBankTransferDisabled
 from send_money.utils import (
     serialise_amount, unserialise_amount, serialise_date, unserialise_date,
@@ -24,6 +31,39 @@ logger = logging.getLogger('mtp')
 
 
 class SendMoneyForm(forms.Form):
+    # forms whose `clean` calls the MTP API and can be trusted for VALIDATED_STEP_TTL seconds after
+    # being validated instead of calling it again on every later page
+    remotely_validated = False
+    validated_steps_session_key = 'validated_steps'
+    validated_step_signer = signing.TimestampSigner(salt='send_money.forms.validated_step')
+
+    @classmethod
+    def get_session_fields(cls):
+        return list(cls.base_fields) + list(getattr(cls, 'additional_fields_to_deserialize', []))
+
+    @classmethod
+    def get_session_fingerprint(cls, session):
+        """
+        :return: hash of this form's serialised data in the session
+        """
+        data = [session.get(field) for field in cls.get_session_fields()]
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    @classmethod
+    def is_validated_in_session(cls, session):
+        """
+        :return: True if the data in the session was validated less than VALIDATED_STEP_TTL seconds ago
+        """
+        if not cls.remotely_validated:
+            return False
+        record = session.get(cls.validated_steps_session_key, {}).get(cls.__name__)
+        if not record:
+            return False
+        try:
+            fingerprint = cls.validated_step_signer.unsign(record, max_age=settings.VALIDATED_STEP_TTL)
+        except signing.BadSignature:
+            return False
+        return constant_time_compare(fingerprint, cls.get_session_fingerprint(session))
 
     @classmethod
     def unserialise_from_session(cls, request):
@@ -47,11 +87,30 @@ class SendMoneyForm(forms.Form):
             field: get_value(field)
             for field in getattr(cls, 'additional_fields_to_deserialize', [])
         }
-        return cls(request=request, data=data, **extra_kwargs)
+        form = cls(request=request, data=data, **extra_kwargs)
+        form.validated_in_session = cls.is_validated_in_session(request.session)
+        return form
 
     def __init__(self, request=None, **kwargs):
         super().__init__(**kwargs)
         self.request = request
+        # if True, `clean` skips checks against the MTP API
+        self.validated_in_session = False
+
+    def record_validation(self):
+        """
+        Records in the session that its data for this form was just validated
+        so that the MTP API need not be called again for VALIDATED_STEP_TTL seconds.
+        The record is signed with a timestamp because signed cookie sessions can be replayed.
+        """
+        if not self.remotely_validated or self.validated_in_session:
+            return
+        session = self.request.session
+        validated_steps = dict(session.get(self.validated_steps_session_key, {}))
+        validated_steps[self.__class__.__name__] = self.validated_step_signer.sign(
+            self.get_session_fingerprint(session)
+        )
+        session[self.validated_steps_session_key] = validated_steps
 
     def serialise_to_session(self):
         cls = self.__class__
@@ -65,6 +124,8 @@ class SendMoneyForm(forms.Form):
         for field in getattr(cls, 'additional_fields_to_deserialize', []):
             session[field] = getattr(self, field, self.cleaned_data.get(field))
 
+        self.record_validation()
+
 
 class PaymentMethodChoiceForm(SendMoneyForm):
     additional_fields_to_deserialize = ('payment_method',)
@@ -104,15 +165,11 @@ class PrisonerDetailsForm(SendMoneyForm):
         'not_found': _('No prisoner matches the details you’ve supplied'),
     }
 
-    shared_api_session_lock = threading.RLock()
-    shared_api_session = None
+    remotely_validated = True
 
     @classmethod
     def get_api_session(cls, reconnect=False):
-        with cls.shared_api_session_lock:
-            if reconnect or not cls.shared_api_session:
-                cls.shared_api_session = get_api_session()
-            return cls.shared_api_session
+        return get_api_session(reconnect=reconnect)
 
     def __init__(self, **kwargs):
         if isinstance((kwargs.get('data') or {}).get('prisoner_dob'), datetime.date):
@@ -124,7 +181,31 @@ class PrisonerDetailsForm(SendMoneyForm):
             })
         super().__init__(**kwargs)
 
+    @classmethod
+    def get_prisoner_validity_cache_key(cls, filters):
+        # hashed so that personal details are not kept in cache keys
+        filters = json.dumps(filters, sort_keys=True)
+        return f'prisoner_validity:{hashlib.sha256(filters.encode()).hexdigest()}'
+
     def lookup_prisoner(self, **filters):
+        """
+        Looks up prisoners matching `filters`, caching the response for PRISONER_VALIDITY_CACHE_TTL seconds
+        or PRISONER_VALIDITY_NEGATIVE_CACHE_TTL if no single prisoner matched
+        """
+        cache_key = self.get_prisoner_validity_cache_key(filters)
+        prisoners = cache.get(cache_key)
+        if prisoners is not None:
+            prisoner_validity_lookups.labels(result='hit').inc()
+            return prisoners
+        prisoner_validity_lookups.labels(result='miss').inc()
+        prisoners = self.request_prisoner_validity(**filters)
+        if isinstance(prisoners, dict) and prisoners.get('count') == 1:
+            cache.set(cache_key, prisoners, timeout=settings.PRISONER_VALIDITY_CACHE_TTL)
+        else:
+            cache.set(cache_key, prisoners, timeout=settings.PRISONER_VALIDITY_NEGATIVE_CACHE_TTL)
+        return prisoners
+
+    def request_prisoner_validity(self, **filters):
         session = self.get_api_session()
         try:
             return session.get('/prisoner_validity/', params=filters).json()
@@ -157,7 +238,7 @@ class PrisonerDetailsForm(SendMoneyForm):
 
     def clean(self):
         try:
-            if not self.errors and not self.is_prisoner_known():
+            if not self.errors and not self.validated_in_session and not self.is_prisoner_known():
                 raise ValidationError(self.error_messages['not_found'], code='not_found')
         except (RequestException, OAuth2Error):
             logger.exception('Could not look up prisoner validity')
@@ -203,8 +284,11 @@ class DebitCardAmountForm(SendMoneyForm):
     unserialise_amount = unserialise_amount
     max_lookup_tries = 2
     additional_fields_to_deserialize = ['prisoner_number']
-    shared_api_session_lock = threading.RLock()
-    shared_api_session = None
+    remotely_validated = True
+    # balances are prefetched in background threads while users enter the amount
+    balance_prefetch_workers = 4
+    balance_prefetcher_lock = threading.Lock()
+    balance_prefetcher = None
 
     def __init__(self, *args, **kwargs):
         self.prisoner_number = kwargs.pop('prisoner_number')
@@ -212,14 +296,15 @@ class DebitCardAmountForm(SendMoneyForm):
 
     @classmethod
     def get_api_session(cls, reconnect=False):
-        with cls.shared_api_session_lock:
-            if reconnect or not cls.shared_api_session:
-                cls.shared_api_session = get_api_session()
-            return cls.shared_api_session
+        return get_api_session(reconnect=reconnect)
 
     def clean(self):
         try:
-            if not self.errors and not self.is_account_balance_below_threshold():
+            if (
+                not self.errors
+                and not self.validated_in_session
+                and not self.is_account_balance_below_threshold()
+            ):
                 raise ValidationError(self.error_messages['cap_exceeded'], code='cap_exceeded')
         except (RequestException, OAuth2Error):
             logger.exception('Could not look up prisoner account balance')
@@ -239,7 +324,50 @@ class DebitCardAmountForm(SendMoneyForm):
         prisoner_account_balance += decimal.Decimal(self.data['amount'])
         return prisoner_account_balance <= settings.PRISONER_CAPPING_THRESHOLD_IN_POUNDS
 
-    def lookup_prisoner_account_balance(self, tries=0):
+    @classmethod
+    def get_balance_cache_key(cls, prisoner_number):
+        return f'prisoner_account_balance:{hashlib.sha256(prisoner_number.encode()).hexdigest()}'
+
+    @classmethod
+    def prefetch_prisoner_account_balance(cls, prisoner_number):
+        """
+        Starts loading the prisoner's account balance in a background thread and keeps it in the cache
+        for PRISONER_BALANCE_PREFETCH_TTL seconds so that the amount form need not wait for it.
+
+        :return: Future of the prefetch or None if balances are not needed
+        """
+        if not settings.PRISONER_CAPPING_ENABLED:
+            return None
+        with cls.balance_prefetcher_lock:
+            if cls.balance_prefetcher is None:
+                cls.balance_prefetcher = ThreadPoolExecutor(
+                    max_workers=cls.balance_prefetch_workers,
+                    thread_name_prefix='prefetch_balance',
+                )
+        return cls.balance_prefetcher.submit(cls.store_prisoner_account_balance, prisoner_number)
+
+    @classmethod
+    def store_prisoner_account_balance(cls, prisoner_number):
+        form = cls(prisoner_number=prisoner_number)
+        try:
+            balance = form.request_prisoner_account_balance()
+        except (RequestException, OAuth2Error, ValidationError):
+            # the amount form will load the balance itself
+            logger.warning('Could not prefetch prisoner account balance', exc_info=True)
+            return
+        cache.set(cls.get_balance_cache_key(prisoner_number), balance, timeout=settings.PRISONER_BALANCE_PREFETCH_TTL)
+
+    def lookup_prisoner_account_balance(self):
+        """
+        Returns the balance prefetched when prisoner details were entered if it has arrived,
+        otherwise loads it
+        """
+        balance = cache.get(self.get_balance_cache_key(self.prisoner_number))
+        if balance is not None:
+            return balance
+        return self.request_prisoner_account_balance()
+
+    def request_prisoner_account_balance(self, tries=0):
         session = self.get_api_session(reconnect=(tries != 0))
         try:
             return session.get(f'/prisoner_account_balances/{self.prisoner_number}').json()
@@ -249,6 +377,6 @@ class DebitCardAmountForm(SendMoneyForm):
             if getattr(e.response, 'status_code', None) != 401:
                 raise
         if tries < self.max_lookup_tries:
-            return self.lookup_prisoner_account_balance(tries=tries + 1)
+            return self.request_prisoner_account_balance(tries=tries + 1)
         else:
             raise ValidationError(self.error_messages['connection'], code='connection')
@@ -0,0 +1,222 @@
+from email.utils import parsedate_to_datetime
+import enum
+import hashlib
+import hmac
+from http.cookiejar import DefaultCookiePolicy
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+import requests
+
+from send_money.circuit_breaker import CircuitBreaker, CircuitBreakerAdapter
+from send_money.utils import govuk_headers, govuk_url
+
+logger = logging.getLogger('mtp')
+
+
+def is_valid_webhook_signature(body, signature):
+    """
+    :return: True if `signature` from the Pay-Signature header is the HMAC-SHA256 of the webhook body
+        signed with GOVUK_PAY_WEBHOOK_SIGNING_SECRET
+    """
+    if not settings.GOVUK_PAY_WEBHOOK_SIGNING_SECRET or not signature:
+        return False
+    expected_signature = hmac.new(
+        settings.GOVUK_PAY_WEBHOOK_SIGNING_SECRET.encode(), body, hashlib.sha256,
+    ).hexdigest()
+    return hmac.compare_digest(expected_signature, signature)
+
+
+class RequestPriority(enum.Enum):
+    # made on behalf of a user waiting for a page
+    interactive = 'interactive'
+    # made by scheduled jobs
+    background = 'background'
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the rate of requests to GOV.UK Pay made by this process.
+
+    A number of tokens is reserved for interactive requests so that background requests never make users wait
+    for tokens of the same process; the bucket is not shared with other processes (see GovUkPayClient).
+    When GOV.UK Pay responds with 429 Too Many Requests, all requests are held back for as long as
+    it asks and the rate is halved; it then increases gradually with every successful response.
+    """
+    decrease_factor = 0.5
+    increase_fraction = 0.02
+    default_retry_after = 1
+
+    def __init__(self, rate, interactive_reserve=0, min_rate=1):
+        """
+        :param rate: maximum number of requests per second which is also the size of the bucket
+        :param interactive_reserve: number of tokens only interactive requests can use
+        :param min_rate: rate will not be reduced below this when throttled
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.interactive_reserve = min(interactive_reserve, rate - 1)
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.blocked_until = self.updated
+        self.lock = threading.Lock()
+
+    def try_acquire(self, priority):
+        """
+        Takes a token if one is available for requests of this priority.
+
+        :return: 0 if a token was taken, otherwise the number of seconds to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self.tokens = min(self.max_rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            minimum = 0 if priority == RequestPriority.interactive else self.interactive_reserve
+            if self.tokens >= minimum + 1:
+                self.tokens -= 1
+                return 0
+            return (minimum + 1 - self.tokens) / self.rate
+
+    def acquire(self, priority, max_wait=None):
+        """
+        Waits until a token can be taken.
+
+        :param max_wait: stop waiting after this many seconds and proceed anyway
+        """
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            delay = self.try_acquire(priority)
+            if not delay:
+                return
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return
+            time.sleep(delay)
+
+    def record_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.increase_fraction)
+
+    def record_throttled(self, retry_after=None):
+        """
+        Holds back all requests and reduces the rate after a 429 response.
+
+        :param retry_after: value of the `Retry-After` header
+        :return: number of seconds requests are held back for
+        """
+        delay = self.parse_retry_after(retry_after)
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.tokens = min(self.tokens, 0)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return delay
+
+    @classmethod
+    def parse_retry_after(cls, retry_after):
+        if not retry_after:
+            return cls.default_retry_after
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(retry_after) - timezone.now()).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return cls.default_retry_after
+
+
+class GovUkPayClient:
+    """
+    Makes requests to GOV.UK Pay reusing pooled keep-alive connections.
+
+    A single instance is shared by all threads in a process (see `shared_client`)
+    so that views and the scheduled job do not open a new TCP and TLS connection for every call.
+    It also limits the rate of requests made so that GOV.UK Pay's rate limits are not hit
+    and fails fast while GOV.UK Pay's circuit breaker is open.
+
+    Each process has its own rate limiter so GOVUK_PAY_RATE_LIMIT and its interactive reserve are divided
+    equally between the GOVUK_PAY_RATE_LIMIT_PROCESSES processes of an instance, i.e. uWSGI workers, the spooler
+    and `update_incomplete_payments`. Background jobs therefore can only use their share of the rate
+    and the interactive reserve only applies to background requests made by the same process.
+    """
+    shared_client_lock = threading.Lock()
+    _shared_client = None
+
+    @classmethod
+    def shared_client(cls):
+        with cls.shared_client_lock:
+            if cls._shared_client is None:
+                cls._shared_client = cls(pool_size=settings.GOVUK_PAY_POOL_SIZE)
+            return cls._shared_client
+
+    @classmethod
+    def get_timeout(cls, endpoint):
+        return settings.GOVUK_PAY_TIMEOUTS.get(endpoint, settings.GOVUK_PAY_TIMEOUTS['default'])
+
+    def __init__(self, pool_size):
+        self.session = requests.Session()
+        # requests made on behalf of different users must not share state
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = CircuitBreakerAdapter(
+            CircuitBreaker.get('govuk_pay'),
+            pool_connections=1, pool_maxsize=pool_size,
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        processes = max(settings.GOVUK_PAY_RATE_LIMIT_PROCESSES, 1)
+        self.rate_limiter = RateLimiter(
+            # at least one request per second is needed for the bucket to hold a token
+            rate=max(settings.GOVUK_PAY_RATE_LIMIT / processes, 1),
+            interactive_reserve=settings.GOVUK_PAY_RATE_LIMIT_INTERACTIVE_RESERVE / processes,
+        )
+
+    def request(self, method, path, endpoint, priority=RequestPriority.interactive, **kwargs):
+        """
+        Retries requests that GOV.UK Pay rejects with 429 Too Many Requests; interactive requests are
+        not held back for longer than GOVUK_PAY_RATE_LIMIT_MAX_INTERACTIVE_WAIT seconds.
+
+        :param endpoint: name of the GOV.UK Pay endpoint, used to choose the timeout
+        :param priority: RequestPriority
+        """
+        max_wait = self.get_max_wait(priority)
+        retries = settings.GOVUK_PAY_RATE_LIMIT_RETRIES
+        while True:
+            self.rate_limiter.acquire(priority, max_wait=max_wait)
+            response = self.session.request(
+                method,
+                govuk_url(path),
+                headers=govuk_headers(),
+                timeout=self.get_timeout(endpoint),
+                **kwargs
+            )
+            if response.status_code != 429:
+                self.rate_limiter.record_success()
+                return response
+
+            delay = self.rate_limiter.record_throttled(response.headers.get('Retry-After'))
+            if retries <= 0 or (max_wait is not None and delay > max_wait):
+                return response
+            retries -= 1
+            logger.warning(
+                'GOV.UK Pay rate limit reached, retrying %(endpoint)s in %(delay)0.1f seconds',
+                {'endpoint': endpoint, 'delay': delay},
+            )
+
+    @classmethod
+    def get_max_wait(cls, priority):
+        if priority == RequestPriority.interactive:
+            return settings.GOVUK_PAY_RATE_LIMIT_MAX_INTERACTIVE_WAIT
+        return None
+
+    def get(self, path, endpoint, **kwargs):
+        return self.request('GET', path, endpoint, **kwargs)
+
+    def post(self, path, endpoint, **kwargs):
+        return self.request('POST', path, endpoint, **kwargs)
@@ -0,0 +1,72 @@
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, write_to_textfile
+
+from send_money.recording import get_endpoint_name
+
+
+class UpdateIncompletePaymentsMetrics:
+    """
+    Prometheus metrics collected during one run of `update_incomplete_payments`.
+
+    The job is too short-lived to be scraped so metrics are written to a file
+    to be exported by node-exporter's textfile collector.
+    """
+    upstream_request_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        self.outcomes = Counter(
+            'mtp_update_incomplete_payments_outcomes',
+            'Payments by what happened to them when checked',
+            labelnames=('outcome',),
+            registry=self.registry,
+        )
+        self.upstream_request_duration = Histogram(
+            'mtp_update_incomplete_payments_upstream_request_duration_seconds',
+            'Durations of requests made to the MTP API, GOV.UK Pay and other upstreams',
+            labelnames=('endpoint', 'status'),
+            buckets=self.upstream_request_buckets,
+            registry=self.registry,
+        )
+        self.backlog = Gauge(
+            'mtp_update_incomplete_payments_backlog',
+            'Number of incomplete payments loaded from the MTP API',
+            registry=self.registry,
+        )
+        self.run_duration = Gauge(
+            'mtp_update_incomplete_payments_run_duration_seconds',
+            'How long the last run took',
+            registry=self.registry,
+        )
+        self.time_budget_exhausted = Gauge(
+            'mtp_update_incomplete_payments_time_budget_exhausted',
+            '1 if the last run stopped before checking all payments because it ran out of time',
+            registry=self.registry,
+        )
+        self.last_run = Gauge(
+            'mtp_update_incomplete_payments_last_run_timestamp_seconds',
+            'When the last run finished',
+            registry=self.registry,
+        )
+
+    def count_outcome(self, outcome):
+        self.outcomes.labels(outcome=outcome).inc()
+
+    def observe_request(self, method, url, response, elapsed):
+        """
+        Can be passed to `send_money.recording.observing_requests`; failed requests have status `error`
+        """
+        self.upstream_request_duration.labels(
+            endpoint=get_endpoint_name(method, url),
+            status='error' if response is None else str(response.status_code),
+        ).observe(elapsed)
+
+    def finish_run(self, run_duration, time_budget_exhausted=False):
+        self.run_duration.set(run_duration)
+        self.time_budget_exhausted.set(int(time_budget_exhausted))
+        self.last_run.set_to_current_time()
+
+    def write(self, path):
+        """
+        Writes metrics to `path` atomically; the file name must end in `.prom` to be collected
+        """
+        write_to_textfile(path, self.registry)
@@ -0,0 +1,146 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('mtp')
+
+
+def get_partition(key, partitions):
+    """
+    :return: index of the hash range `key` falls in when split into `partitions` equal ranges
+    """
+    key_hash = int.from_bytes(hashlib.sha256(key.encode()).digest()[:4], 'big')
+    return key_hash * partitions // 2 ** 32
+
+
+@contextmanager
+def try_lock_file(path):
+    """
+    Takes an exclusive lock on a file without waiting; the lock is released on exit
+    or when the process dies.
+
+    :return: context manager yielding True if the lock was taken
+    """
+    with open(path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class FileLeaseStore:
+    """
+    Grants time-limited exclusive leases shared by all instances.
+    Leases that are not renewed expire so that work held by instances that died is picked up by others.
+
+    Leases are kept as files in a directory that must be shared by all instances,
+    using an exclusive lock on a file to update them safely.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, name):
+        return os.path.join(self.directory, f'{name}.lease')
+
+    @contextmanager
+    def locked(self):
+        with open(os.path.join(self.directory, 'leases.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self, name):
+        try:
+            with open(self.get_path(name)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write(self, name, owner, duration):
+        path = self.get_path(name)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump({'owner': owner, 'expires': time.time() + duration}, f)
+        os.replace(f'{path}.tmp', path)
+
+    def acquire(self, name, owner, duration):
+        """
+        :return: True if `owner` now holds lease `name` for `duration` seconds
+        """
+        with self.locked():
+            lease = self.read(name)
+            if lease and lease['owner'] != owner and lease['expires'] > time.time():
+                return False
+            self.write(name, owner, duration)
+            return True
+
+    def renew(self, name, owner, duration):
+        """
+        :return: True if `owner` still held lease `name` and now holds it for another `duration` seconds
+        """
+        with self.locked():
+            lease = self.read(name)
+            if not lease or lease['owner'] != owner:
+                return False
+            self.write(name, owner, duration)
+            return True
+
+    def hold(self, name, owner, duration):
+        """
+        :return: HeldLease that keeps renewing the lease in a background thread; the lease must already be acquired
+        """
+        return HeldLease(self, name, owner, duration)
+
+
+class HeldLease:
+    """
+    Context manager renewing a lease every third of its duration until exited.
+    The lease is not released on exit so that the work it covers is not repeated by others until it expires.
+    """
+
+    def __init__(self, store, name, owner, duration):
+        self.store = store
+        self.name = name
+        self.owner = owner
+        self.duration = duration
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.renewer = None
+
+    def __enter__(self):
+        self.renewer = threading.Thread(target=self.keep_renewing, name=f'lease-{self.name}', daemon=True)
+        self.renewer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.renewer.join()
+
+    def keep_renewing(self):
+        while not self.stopped.wait(self.duration / 3):
+            try:
+                renewed = self.store.renew(self.name, self.owner, self.duration)
+            except OSError:
+                logger.exception('Could not renew lease %(name)s', {'name': self.name})
+                renewed = False
+            if not renewed:
+                logger.warning('Lost lease %(name)s', {'name': self.name})
+                self.lost.set()
+                return
+
+    @property
+    def is_held(self):
+        return not self.lost.is_set()
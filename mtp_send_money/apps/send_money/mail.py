@@ -1,13 +1,150 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from decimal import Decimal
+import hashlib
+import logging
+import os
 
 from django.conf import settings
 from django.urls import reverse
 from django.utils import timezone
+from mtp_common.spooling import Context, spoolable, spooler
 from mtp_common.tasks import send_email
+from notifications_python_client.errors import APIError, InvalidResponse
 
 from send_money.notify.templates import SendMoneyNotifyTemplates
 from send_money.utils import currency_format, site_url
 
+logger = logging.getLogger('mtp')
+
+# sends emails in the background while in `sending_emails_in_background`
+_background_sender = None
+
+
+@contextmanager
+def sending_emails_in_background():
+    """
+    Sends emails from a background thread while in this context unless they can be spooled,
+    waiting for all of them to be sent on exit.
+
+    For jobs run outside uWSGI, like cron commands, which cannot use the spooler
+    but should not wait for GOV.UK Notify. Emails are still sent in order.
+    """
+    global _background_sender
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='send_email') as sender:
+        _background_sender = sender
+        try:
+            yield
+        finally:
+            _background_sender = None
+
+
+def get_email_reference_path(reference):
+    return os.path.join(
+        settings.NOTIFICATION_EMAIL_REFERENCE_DIRECTORY,
+        hashlib.sha256(reference.encode()).hexdigest(),
+    )
+
+
+def claim_email_reference(reference):
+    """
+    Records that the email with `reference` is being sent so that it is never sent again, e.g. when
+    a payment is completed by both the confirmation page and `update_incomplete_payments`.
+    References are shared by all processes using NOTIFICATION_EMAIL_REFERENCE_DIRECTORY;
+    emails are not de-duplicated if it is not set.
+
+    :return: True if the email was not sent before and should be sent now
+    """
+    if not settings.NOTIFICATION_EMAIL_REFERENCE_DIRECTORY:
+        return True
+    try:
+        os.makedirs(settings.NOTIFICATION_EMAIL_REFERENCE_DIRECTORY, exist_ok=True)
+        # creating a file that does not exist is atomic even across instances sharing the directory
+        os.close(os.open(get_email_reference_path(reference), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    except OSError:
+        # better to send an email twice than not at all
+        logger.exception('Could not record email reference %(reference)s', {'reference': reference})
+    return True
+
+
+def release_email_reference(reference):
+    """
+    Forgets that the email with `reference` was claimed so that it can be sent later, i.e. when sending failed.
+    """
+    if not settings.NOTIFICATION_EMAIL_REFERENCE_DIRECTORY:
+        return
+    try:
+        os.remove(get_email_reference_path(reference))
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logger.exception('Could not release email reference %(reference)s', {'reference': reference})
+
+
+@spoolable(body_params=('personalisation',))
+def send_claimed_email(
+    template_name: str,
+    to: str,
+    personalisation: dict = None,
+    reference: str = None,
+    staff_email: bool = None,
+    retry_attempts: int = 2,
+    spoolable_ctx: Context = None,
+):
+    """
+    Sends an email whose reference was claimed, releasing the reference if sending fails
+    so that it is not prevented from being sent again.
+    Spooled itself in uWSGI so that the reference is released by the job that actually calls GOV.UK Notify;
+    temporary errors are retried like `send_email` does.
+    """
+    email_kwargs = dict(
+        template_name=template_name,
+        to=to,
+        personalisation=personalisation,
+        reference=reference,
+        staff_email=staff_email,
+    )
+    try:
+        if spoolable_ctx.spooled:
+            # `send_email` would be spooled again and its failures would not be seen here
+            send_email.func(spoolable_ctx=Context(spooled=False), **email_kwargs)
+        else:
+            send_email(**email_kwargs)
+    except Exception as e:
+        should_retry = (
+            spoolable_ctx.spooled
+            and retry_attempts
+            and isinstance(e, APIError)
+            and 500 <= e.status_code < 600
+            and not isinstance(e, InvalidResponse)
+        )
+        if should_retry:
+            send_claimed_email(retry_attempts=retry_attempts - 1, **email_kwargs)
+            return
+        # logged here too as errors are not raised to anyone when sending in the background
+        logger.warning('Could not send email %(reference)s', {'reference': reference}, exc_info=True)
+        release_email_reference(reference)
+        raise
+
+
+def prune_email_references(older_than):
+    """
+    Forgets emails sent before `older_than` (a timestamp) which cannot be sent again.
+    """
+    directory = settings.NOTIFICATION_EMAIL_REFERENCE_DIRECTORY
+    if not directory or not os.path.isdir(directory):
+        return
+    for entry in os.scandir(directory):
+        try:
+            if entry.stat().st_mtime < older_than:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            # pruned by another process
+            pass
+
 
 def _send_notification_email(email, payment, template_name, reference_prefix):
     personalisation = {
@@ -25,13 +162,23 @@ def _send_notification_email(email, payment, template_name, reference_prefix):
         field: personalisation[field]
         for field in SendMoneyNotifyTemplates.templates[template_name]['personalisation']
     }
-    send_email(
+    reference = '%s-%s' % (reference_prefix, payment['uuid'])
+    if not claim_email_reference(reference):
+        logger.info('Not sending email %(reference)s again', {'reference': reference})
+        return
+
+    email_kwargs = dict(
         template_name=template_name,
         to=email,
         personalisation=personalisation,
-        reference='%s-%s' % (reference_prefix, payment['uuid']),
+        reference=reference,
         staff_email=False,
     )
+    if _background_sender and not spooler.installed:
+        _background_sender.submit(send_claimed_email, **email_kwargs)
+    else:
+        # spooled if running in uWSGI
+        send_claimed_email(**email_kwargs)
 
 
 def send_email_for_card_payment_confirmation(email, payment):
@@ -1,15 +1,37 @@
+import asyncio
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
 from datetime import timedelta
+import enum
+import functools
 import logging
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import uuid
 
-from django.core.management import BaseCommand
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from mtp_common.stack import StackException, is_first_instance
 from oauthlib.oauth2 import OAuth2Error
 from requests.exceptions import RequestException
 
+from send_money.async_payments import AsyncPaymentClient
+from send_money.check_schedule import PaymentCheckSchedule
+from send_money.check_store import PaymentCheckStore
 from send_money.exceptions import GovUkPaymentStatusException
-from send_money.payments import GovUkPaymentStatus, PaymentClient
+from send_money.govuk_pay import RequestPriority
+from send_money.job_metrics import UpdateIncompletePaymentsMetrics
+from send_money.leases import FileLeaseStore, get_partition, try_lock_file
+from send_money.mail import prune_email_references, sending_emails_in_background
+from send_money.payments import GovUkPaymentStatus, PaymentClient, PaymentUpdateBatch
+from send_money.recording import CallStats, Recording, observing_requests, recording_requests, replaying_requests
 from send_money.utils import get_requests_exception_for_logging
 from send_money.views import get_payment_delayed_capture_rollout_percentage
 
@@ -17,31 +39,461 @@ logger = logging.getLogger('mtp')
 
 
 ALWAYS_CHECK_IF_OLDER_THAN = timedelta(days=3)
+# GOV.UK payments are created shortly after MTP payments so search a little beyond the latest one
+SEARCH_WINDOW_MARGIN = timedelta(hours=1)
+# GOV.UK Pay expires payments which are not captured within this time
+CAPTURE_EXPIRY = timedelta(hours=120)
+# payments this close to expiring are checked before others when prioritising
+CAPTURE_EXPIRY_MARGIN = timedelta(hours=24)
+
+
+def replay_latency(value):
+    """
+    :return: latency in seconds or None to use the recorded latency
+    """
+    if value == 'recorded':
+        return None
+    return float(value) / 1000
+
+
+class CheckPriority(enum.IntEnum):
+    """
+    Order in which payments are checked when prioritising, most valuable first.
+    """
+    security_check_accepted = 0
+    close_to_capture_expiry = 1
+    must_have_finished = 2
+    other = 3
 
 
 class Command(BaseCommand):
+    # records past checks if UPDATE_INCOMPLETE_PAYMENTS_STATE_PATH is set
+    check_store = None
+    # (index, count) of the partition of payments being checked and the HeldLease on it, if partitioned
+    partition = None
+    partition_lease = None
+    # collected if UPDATE_INCOMPLETE_PAYMENTS_METRICS_PATH is set
+    metrics = None
+    # time.monotonic() value after which no more payments are checked, if there is a time budget
+    deadline = None
+    time_budget_exhausted = False
+    # when each payment is next checked, if running as a daemon
+    schedule = None
+    # set when the daemon receives SIGTERM or SIGINT
+    stop_requested = None
+    # whether it was reported that the instance cannot be identified, so that the daemon reports it only once
+    reported_not_on_cloud_platform = False
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--daemon', action='store_true',
+            help='Keep running and check each payment when it is next due instead of all payments once; '
+                 'stops gracefully on SIGTERM',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=settings.UPDATE_INCOMPLETE_PAYMENTS_WORKERS,
+            help='Number of payments to check concurrently; 1 checks them one at a time',
+        )
+        parser.add_argument(
+            '--async', action='store_true', dest='use_async',
+            help='Check payments using asyncio rather than threads; '
+                 '--workers then sets how many payments are checked concurrently',
+        )
+        parser.add_argument(
+            '--search', action='store_true',
+            help='Load GOV.UK payments using the search endpoint for the dates of incomplete payments; '
+                 'only payments missing from the search results are then loaded individually',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.UPDATE_INCOMPLETE_PAYMENTS_BATCH_SIZE,
+            help='Number of completed payments to save in one request to the API; '
+                 '1 saves them one at a time; not used with --async',
+        )
+        parser.add_argument(
+            '--prioritise', action='store_true',
+            help='Load all incomplete payments first and check the most valuable ones first '
+                 'so that they are handled even if the run is cut short',
+        )
+        parser.add_argument(
+            '--partitions', type=int, default=settings.UPDATE_INCOMPLETE_PAYMENTS_PARTITIONS,
+            help='Split payments into this many ranges of uuid hashes that all instances take leases on; '
+                 '1 only runs on the first instance',
+        )
+        parser.add_argument(
+            '--time-budget', type=int, default=settings.UPDATE_INCOMPLETE_PAYMENTS_TIME_BUDGET, metavar='SECONDS',
+            help='Stop checking new payments after this many seconds so that runs do not overlap; '
+                 'payments already being checked are finished; 0 for no limit',
+        )
+        parser.add_argument(
+            '--record', metavar='PATH',
+            help='Save responses from the MTP API and GOV.UK Pay to this fixture file so that the run can be replayed',
+        )
+        parser.add_argument(
+            '--replay', metavar='PATH',
+            help='Benchmark the update using responses saved with --record instead of making requests; '
+                 'reports wall time and calls and latency percentiles for each upstream endpoint',
+        )
+        parser.add_argument(
+            '--replay-latency', type=replay_latency, default=None, metavar='MS',
+            help='Milliseconds to wait before responding to every replayed request; '
+                 'defaults to how long each request took when recorded',
+        )
+
     def handle(self, **options):
+        if options['daemon']:
+            if options['use_async'] or options['partitions'] > 1 or options['record'] or options['replay']:
+                raise CommandError('--daemon cannot be used with --async, --partitions, --record or --replay')
+            if not settings.NOTIFICATION_EMAIL_REFERENCE_DIRECTORY:
+                # the daemon checks payments soon after the confirmation page and webhooks complete them
+                raise CommandError('--daemon requires NOTIFICATION_EMAIL_REFERENCE_DIRECTORY to be set '
+                                   'so that emails are never sent twice')
+            self.run_daemon(**options)
+        elif options['replay']:
+            self.replay_update(**options)
+        elif options['record']:
+            recording = Recording()
+            stats = CallStats()
+            try:
+                with recording_requests(recording, stats):
+                    self.update_incomplete_payments(**options)
+            finally:
+                recording.save(options['record'])
+            if options['verbosity']:
+                self.write_call_stats(stats)
+        else:
+            self.update_incomplete_payments(**options)
+
+    def replay_update(self, **options):
+        """
+        Runs the update against recorded responses without checking which instance this is
+        or keeping state so that runs can be compared.
+        Note that decisions depending on the age of payments may differ from when the responses were recorded.
+        """
+        recording = Recording.load(options['replay'])
+        stats = CallStats()
+        start = time.perf_counter()
+        with replaying_requests(recording, stats, latency=options['replay_latency']):
+            self.run_update(**options)
+        self.stdout.write(f'Wall time: {time.perf_counter() - start:.2f}s')
+        self.write_call_stats(stats)
+
+    def write_call_stats(self, stats):
+        for line in stats.get_report():
+            self.stdout.write(line)
+
+    def update_incomplete_payments(self, **options):
         verbosity = options['verbosity']
-        if self.should_perform_update():
-            if verbosity:
-                self.stdout.write('Updating incomplete payments')
-            self.perform_update()
+        partitions = options['partitions']
+        if partitions > 1 or self.should_perform_update():
+            with try_lock_file(settings.UPDATE_INCOMPLETE_PAYMENTS_LOCK_PATH) as locked:
+                if not locked:
+                    # overlapping runs would check the same payments
+                    logger.warning('Scheduled job: Not updating incomplete payments because a previous run is active')
+                    if verbosity:
+                        self.stdout.write('Not updating incomplete payments because a previous run is still active')
+                    return
+                if verbosity:
+                    self.stdout.write('Updating incomplete payments')
+                self.perform_budgeted_update(**options)
         elif verbosity:
             self.stdout.write('Not updating incomplete payments because running on secondary instance')
 
+    def perform_budgeted_update(self, **options):
+        """
+        Updates payments until the time budget runs out; payments already being checked are finished
+        and the rest are left for the next run.
+        """
+        partitions = options['partitions']
+        if settings.UPDATE_INCOMPLETE_PAYMENTS_STATE_PATH:
+            self.check_store = PaymentCheckStore(settings.UPDATE_INCOMPLETE_PAYMENTS_STATE_PATH)
+            # payments not checked for this long have been completed
+            self.check_store.prune(older_than=timezone.now() - CAPTURE_EXPIRY * 2)
+        # payments are completed long before then so their emails cannot be sent again
+        prune_email_references(older_than=time.time() - (CAPTURE_EXPIRY * 2).total_seconds())
+        if settings.UPDATE_INCOMPLETE_PAYMENTS_METRICS_PATH:
+            self.metrics = UpdateIncompletePaymentsMetrics()
+        start = time.perf_counter()
+        if options['time_budget'] > 0:
+            self.deadline = time.monotonic() + options['time_budget']
+        try:
+            with observing_requests(self.metrics.observe_request) if self.metrics else nullcontext(), \
+                    sending_emails_in_background():
+                if partitions > 1:
+                    self.perform_partitioned_update(**options)
+                else:
+                    self.run_update(**options)
+        finally:
+            if self.check_store:
+                self.check_store.close()
+                self.check_store = None
+            if self.metrics:
+                self.metrics.finish_run(time.perf_counter() - start, self.time_budget_exhausted)
+                self.metrics.write(settings.UPDATE_INCOMPLETE_PAYMENTS_METRICS_PATH)
+                self.metrics = None
+            self.deadline = None
+            self.time_budget_exhausted = False
+
+    def is_out_of_time(self):
+        """
+        Returns True if no more payments should be checked because the time budget ran out
+        or the daemon is stopping.
+        """
+        if self.stop_requested and self.stop_requested.is_set():
+            return True
+        if self.deadline is None or time.monotonic() < self.deadline:
+            return False
+        if not self.time_budget_exhausted:
+            self.time_budget_exhausted = True
+            logger.warning('Scheduled job: Time budget for updating incomplete payments ran out, '
+                           'remaining payments will be checked in the next run')
+        return True
+
+    def run_daemon(self, **options):
+        """
+        Checks payments as they become due until SIGTERM or SIGINT is received.
+        Only the first instance checks payments; others wait in case they become the first.
+        """
+        self.stop_requested = threading.Event()
+
+        def request_stop(signum, frame):
+            logger.info('Scheduled job: Stopping incomplete payments daemon')
+            self.stop_requested.set()
+
+        previous_handlers = {
+            signum: signal.signal(signum, request_stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            while not self.stop_requested.is_set():
+                if self.should_perform_update():
+                    with try_lock_file(settings.UPDATE_INCOMPLETE_PAYMENTS_LOCK_PATH) as locked:
+                        if locked:
+                            if options['verbosity']:
+                                self.stdout.write('Updating incomplete payments continuously')
+                            self.perform_daemon_update(**options)
+                        else:
+                            # a run started by cron must finish first
+                            logger.info('Scheduled job: Incomplete payments daemon waiting for a previous run')
+                self.stop_requested.wait(settings.UPDATE_INCOMPLETE_PAYMENTS_POLL_INTERVAL)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            self.stop_requested = None
+
+    def perform_daemon_update(self, **options):
+        """
+        Lists incomplete payments every UPDATE_INCOMPLETE_PAYMENTS_POLL_INTERVAL seconds and checks each one
+        when its PaymentCheckSchedule says it is due, keeping the MTP API and GOV.UK Pay sessions open.
+        Returns when a stop is requested or this is no longer the first instance.
+        """
+        poll_interval = settings.UPDATE_INCOMPLETE_PAYMENTS_POLL_INTERVAL
+        if settings.UPDATE_INCOMPLETE_PAYMENTS_METRICS_PATH:
+            self.metrics = UpdateIncompletePaymentsMetrics()
+        # back-off is decided like for runs started by cron but is not kept after the daemon stops
+        self.schedule = PaymentCheckSchedule(PaymentCheckStore(':memory:'))
+        next_refresh = time.monotonic()
+        try:
+            with observing_requests(self.metrics.observe_request) if self.metrics else nullcontext(), \
+                    sending_emails_in_background():
+                while not self.stop_requested.is_set():
+                    if time.monotonic() >= next_refresh:
+                        if not self.should_perform_update():
+                            break
+                        prune_email_references(older_than=time.time() - (CAPTURE_EXPIRY * 2).total_seconds())
+                        self.schedule.store.prune(older_than=timezone.now() - CAPTURE_EXPIRY * 2)
+                        self.refresh_schedule(self.get_payment_client())
+                        next_refresh = time.monotonic() + poll_interval
+                    payments = self.schedule.take_due(time.monotonic())
+                    if payments:
+                        start = time.perf_counter()
+                        # a new client for every group of checks so that what it caches is not kept forever
+                        payment_client = self.get_payment_client(options['batch_size'])
+                        self.check_due_payments(payment_client, payments, **options)
+                        logger.info(
+                            'Scheduled job: Checked %(count)d incomplete payments that were due',
+                            {'count': len(payments)},
+                        )
+                        if self.metrics:
+                            self.metrics.finish_run(time.perf_counter() - start)
+                            self.metrics.write(settings.UPDATE_INCOMPLETE_PAYMENTS_METRICS_PATH)
+                        continue
+                    next_due = self.schedule.get_next_due()
+                    wake_up = next_refresh if next_due is None else min(next_due, next_refresh)
+                    self.stop_requested.wait(max(wake_up - time.monotonic(), 0))
+        finally:
+            self.schedule.store.close()
+            self.schedule = None
+            self.metrics = None
+
+    def refresh_schedule(self, payment_client):
+        """
+        Lists incomplete payments to find new ones and those whose security check changed;
+        the schedule is left as it was if they cannot be loaded.
+        """
+        try:
+            payments = [
+                payment_client.compact_payment(payment)
+                for page in payment_client.iter_incomplete_payment_pages()
+                for payment in page
+            ]
+        except OAuth2Error:
+            logger.exception('Scheduled job: Authentication error while listing incomplete payments')
+            return
+        except RequestException as error:
+            response_content = get_requests_exception_for_logging(error)
+            logger.exception(
+                'Scheduled job: Could not list incomplete payments. Received: %(response_content)s',
+                {'response_content': response_content},
+            )
+            return
+        self.schedule.refresh(payments, time.monotonic())
+        if self.metrics:
+            self.metrics.backlog.set(len(payments))
+
+    def check_due_payments(self, payment_client, payments, **options):
+        """
+        Checks payments that are due; those that should not be checked yet are postponed
+        until their security check changes or for the longest back-off.
+        """
+        payments_to_check = []
+        for payment in payments:
+            if self.should_be_checked(payment):
+                payments_to_check.append(payment)
+            else:
+                self.count_outcome('skipped')
+                self.schedule.postpone(payment, PaymentCheckStore.default_back_off[1], time.monotonic())
+        payments = self.join_govuk_payments(payment_client, payments_to_check, search=options['search'])
+        try:
+            if options['workers'] > 1:
+                self.update_payments_concurrently(payment_client, payments, options['workers'])
+            else:
+                for payment, govuk_payment in payments:
+                    if self.is_out_of_time():
+                        break
+                    self.update_payment(payment_client, payment, govuk_payment)
+        finally:
+            if payment_client.update_batch:
+                payment_client.update_batch.flush()
+
+    def run_update(self, payments=None, **options):
+        if options['use_async']:
+            asyncio.run(self.perform_async_update(
+                workers=options['workers'], search=options['search'], prioritise=options['prioritise'],
+                payments=payments,
+            ))
+        else:
+            self.perform_update(
+                workers=options['workers'], search=options['search'], batch_size=options['batch_size'],
+                prioritise=options['prioritise'], payments=payments,
+            )
+
+    def perform_partitioned_update(self, **options):
+        """
+        Updates payments in every partition that no other instance holds a lease on.
+
+        Leases are renewed while partitions are being updated and then left to expire
+        so that other instances do not repeat the work; if an instance dies, its partition
+        is picked up once the lease expires.
+
+        The MTP API cannot filter payments by partition so incomplete payments are listed once,
+        when the first partition is leased, and shared by partitions updated by this run. They are listed again
+        for partitions leased more than a lease duration later so that payments completed since,
+        e.g. by other instances, the confirmation page or webhooks, are not updated again.
+        """
+        partitions = options['partitions']
+        lease_store = FileLeaseStore(settings.UPDATE_INCOMPLETE_PAYMENTS_LEASE_DIRECTORY)
+        lease_duration = settings.UPDATE_INCOMPLETE_PAYMENTS_LEASE_DURATION
+        owner = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        # start from a random partition so that instances starting together contend less
+        first_partition = random.randrange(partitions)
+        payments_by_partition = None
+        listed_at = None
+        for offset in range(partitions):
+            if self.is_out_of_time():
+                break
+            partition = (first_partition + offset) % partitions
+            lease_name = f'update_incomplete_payments-{partition}-of-{partitions}'
+            if not lease_store.acquire(lease_name, owner, lease_duration):
+                continue
+            if options['verbosity']:
+                self.stdout.write(f'Updating partition {partition + 1} of {partitions}')
+            with lease_store.hold(lease_name, owner, lease_duration) as lease:
+                if payments_by_partition is None or time.monotonic() - listed_at > lease_duration:
+                    payments_by_partition = self.list_payments_by_partition(partitions)
+                    listed_at = time.monotonic()
+                self.partition = (partition, partitions)
+                self.partition_lease = lease
+                try:
+                    self.run_update(payments=payments_by_partition[partition], **options)
+                finally:
+                    self.partition = None
+                    self.partition_lease = None
+
+    def list_payments_by_partition(self, partitions):
+        """
+        :return: dict of lists of incomplete payments keyed by partition
+        """
+        payment_client = self.get_payment_client()
+        payments_by_partition = defaultdict(list)
+        for page in payment_client.iter_incomplete_payment_pages():
+            for payment in page:
+                payments_by_partition[get_partition(payment['uuid'], partitions)].append(
+                    payment_client.compact_payment(payment)
+                )
+        return payments_by_partition
+
+    def is_in_partition(self, payment):
+        """
+        Returns True if the payment belongs to the partition being updated and its lease is still held.
+        """
+        if not self.partition:
+            return True
+        if not self.partition_lease.is_held:
+            # another instance may have taken over the partition
+            return False
+        partition, partitions = self.partition
+        return get_partition(payment['uuid'], partitions) == partition
+
     def should_perform_update(self):
         try:
             return is_first_instance()
         except StackException:
-            self.stderr.write('Not running on Cloud Platform')
+            if not self.reported_not_on_cloud_platform:
+                self.stderr.write('Not running on Cloud Platform')
+                self.reported_not_on_cloud_platform = True
             return True
 
+    def get_payments_to_check(self, payments):
+        """
+        Returns a list of `payments` that should be checked, counting those that are not.
+        Payments in other partitions are not counted at all as they are the backlog of other runs.
+        """
+        payments_to_check = []
+        for payment in payments:
+            if self.partition and get_partition(payment['uuid'], self.partition[1]) != self.partition[0]:
+                continue
+            if self.metrics:
+                self.metrics.backlog.inc()
+            if self.should_be_checked(payment):
+                payments_to_check.append(payment)
+            else:
+                self.count_outcome('skipped')
+        return payments_to_check
+
     def should_be_checked(self, payment):
         """
         Returns True if the GOV.UK Pay API should be used to check the status of the payment.
 
         Used to limit the amount of API calls to GOV.UK Pay endpoints.
         """
+        if not self.is_in_partition(payment):
+            return False
+
+        # payments found unchanged in recent checks are backed off from
+        if self.check_store and not self.check_store.is_due(payment):
+            return False
+
         # if delayed capture hasn't been released yet => always check
         if not get_payment_delayed_capture_rollout_percentage():
             return True
@@ -55,43 +507,230 @@ class Command(BaseCommand):
 
         return security_check.get('status') != 'pending'
 
-    def perform_update(self):
-        payment_client = PaymentClient()
-        payments = payment_client.get_incomplete_payments()
-        for payment in payments:
-            if not self.should_be_checked(payment):
-                continue
+    def get_check_priority(self, payment):
+        """
+        Returns the CheckPriority of a payment that should be checked.
+        """
+        security_check = payment.get('security_check') or {}
+        if security_check.get('status') == 'accepted':
+            # probably capturable and waiting to be captured
+            return CheckPriority.security_check_accepted
 
-            payment_ref = payment['uuid']
-            govuk_id = payment['processor_id']
+        age = timezone.now() - parse_datetime(payment['created'])
+        if CAPTURE_EXPIRY - CAPTURE_EXPIRY_MARGIN <= age < CAPTURE_EXPIRY:
+            return CheckPriority.close_to_capture_expiry
+        if age >= ALWAYS_CHECK_IF_OLDER_THAN:
+            return CheckPriority.must_have_finished
+        return CheckPriority.other
 
-            try:
-                govuk_payment = payment_client.get_govuk_payment(govuk_id)
-                previous_govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
-                govuk_status = payment_client.complete_payment_if_necessary(payment, govuk_payment)
-
-                # not yet finished and can't do anything so skip
-                if govuk_status and not govuk_status.finished():
-                    continue
-
-                if previous_govuk_status != govuk_status:
-                    # refresh govuk payment to get up-to-date fields (e.g. error codes)
-                    govuk_payment = payment_client.get_govuk_payment(govuk_id)
-
-                # if here, status is either success, failed, cancelled, error
-                # or None (in case of govuk payment not found)
-                payment_client.update_completed_payment(payment, govuk_payment)
-            except OAuth2Error:
-                logger.exception(
-                    'Scheduled job: Authentication error while processing %(payment_ref)s',
-                    {'payment_ref': payment_ref},
-                )
-            except RequestException as error:
-                response_content = get_requests_exception_for_logging(error)
-                logger.exception(
-                    'Scheduled job: Payment check failed for ref %(payment_ref)s. Received: %(response_content)s',
-                    {'payment_ref': payment_ref, 'response_content': response_content},
+    def order_by_priority(self, payments):
+        """
+        Returns payments ordered by CheckPriority and then oldest first.
+        """
+        return sorted(
+            payments,
+            key=lambda payment: (self.get_check_priority(payment), parse_datetime(payment['created'])),
+        )
+
+    def get_payment_client(self, batch_size=1):
+        """
+        :return: PaymentClient for checking payments in the background, batching updates if `batch_size` > 1
+        """
+        payment_client = PaymentClient(govuk_pay_priority=RequestPriority.background)
+        if batch_size > 1:
+            payment_client.update_batch = PaymentUpdateBatch(
+                payment_client, batch_size,
+                handle_errors=self.handle_update_errors,
+            )
+        return payment_client
+
+    def perform_update(self, workers=1, search=False, batch_size=1, prioritise=False, payments=None):
+        """
+        Checks incomplete payments, listing them unless already listed `payments` are given.
+        """
+        payment_client = self.get_payment_client(batch_size)
+        if payments is None:
+            # only the fields needed are kept in memory
+            pages = (
+                [payment_client.compact_payment(payment) for payment in page]
+                for page in payment_client.iter_incomplete_payment_pages()
+            )
+        else:
+            pages = [payments]
+        if prioritise:
+            # all payments need to be loaded to be ordered
+            pages = [self.order_by_priority(payment for page in pages for payment in page)]
+        payments = (
+            payment_and_govuk_payment
+            for page in pages
+            for payment_and_govuk_payment in self.join_govuk_payments(
+                payment_client,
+                self.get_payments_to_check(page),
+                search=search,
+            )
+        )
+        try:
+            if workers > 1:
+                self.update_payments_concurrently(payment_client, payments, workers)
+            else:
+                for payment, govuk_payment in payments:
+                    if self.is_out_of_time():
+                        break
+                    self.update_payment(payment_client, payment, govuk_payment)
+        finally:
+            if payment_client.update_batch:
+                payment_client.update_batch.flush()
+
+    def join_govuk_payments(self, payment_client, payments, search=False):
+        """
+        Returns a list of (payment, GOV.UK payment) pairs. The GOV.UK payment is None
+        unless `search` is True and it was found in the search results.
+        """
+        govuk_payments = self.search_govuk_payments(payment_client, payments) if search and payments else {}
+        joined_payments = []
+        for payment in payments:
+            govuk_payment = govuk_payments.get(payment['uuid'])
+            if govuk_payment and govuk_payment.get('payment_id') != payment['processor_id']:
+                govuk_payment = None
+            joined_payments.append((payment, govuk_payment))
+        return joined_payments
+
+    def search_govuk_payments(self, payment_client, payments):
+        """
+        Returns GOV.UK payments created in the same time window as `payments`, keyed by reference (MTP payment uuid).
+        If the search fails, payments will be loaded individually instead.
+        """
+        creation_dates = [parse_datetime(payment['created']) for payment in payments]
+        try:
+            return {
+                govuk_payment.get('reference'): govuk_payment
+                for govuk_payment in payment_client.search_govuk_payments(
+                    min(creation_dates), max(creation_dates) + SEARCH_WINDOW_MARGIN,
                 )
-            except GovUkPaymentStatusException:
-                # expected much of the time
-                pass
+            }
+        except RequestException as error:
+            self.count_outcome('search_error')
+            response_content = get_requests_exception_for_logging(error)
+            logger.exception(
+                'Scheduled job: GOV.UK payment search failed. Received: %(response_content)s',
+                {'response_content': response_content},
+            )
+            return {}
+
+    def update_payments_concurrently(self, payment_client, payments, workers):
+        """
+        Checks and completes payments using a pool of `workers` threads.
+
+        Each payment is still processed in order by a single thread and at most
+        twice as many payments as there are workers are queued at any time.
+        """
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update_incomplete_payments') as executor:
+            pending = set()
+            for payment, govuk_payment in payments:
+                if self.is_out_of_time():
+                    break
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # re-raise unexpected errors as in the sequential mode
+                        future.result()
+                pending.add(executor.submit(self.update_payment, payment_client, payment, govuk_payment))
+            for future in pending:
+                future.result()
+
+    def update_payment(self, payment_client, payment, govuk_payment=None):
+        """
+        Checks and completes a payment, see PaymentClient.check_payment
+
+        :param govuk_payment: GOV.UK payment if already loaded, e.g. from search results
+        """
+        with self.handle_update_errors(payment['uuid']):
+            status = payment_client.check_payment(
+                payment, govuk_payment,
+                on_checked=functools.partial(self.record_check_outcome, payment),
+            )
+            if status:
+                self.count_outcome(status)
+
+    async def perform_async_update(self, workers=1, search=False, prioritise=False, payments=None):
+        async with AsyncPaymentClient(max_connections=workers) as payment_client:
+            if payments is None:
+                payments = await payment_client.get_incomplete_payments()
+            payments = self.get_payments_to_check(payments)
+            if prioritise:
+                payments = self.order_by_priority(payments)
+            payments = iter(await asyncio.to_thread(
+                self.join_govuk_payments, payment_client.payment_client, payments, search=search,
+            ))
+
+            async def worker():
+                # all workers share the same iterator so each payment is only checked once
+                for payment, govuk_payment in payments:
+                    if self.is_out_of_time():
+                        break
+                    await self.async_update_payment(payment_client, payment, govuk_payment)
+
+            await asyncio.gather(*(worker() for _ in range(workers)))
+
+    async def async_update_payment(self, payment_client, payment, govuk_payment=None):
+        """
+        See update_payment
+        """
+        with self.handle_update_errors(payment['uuid']):
+            status = await payment_client.check_payment(
+                payment, govuk_payment,
+                on_checked=functools.partial(self.record_check_outcome, payment),
+            )
+            if status:
+                self.count_outcome(status)
+
+    def record_check_outcome(self, payment, previous_govuk_status, govuk_status):
+        self.record_check(payment, govuk_status)
+        self.count_check_outcome(previous_govuk_status, govuk_status)
+
+    def record_check(self, payment, govuk_status):
+        if self.schedule:
+            self.schedule.record_check(payment, govuk_status, time.monotonic())
+        if self.check_store:
+            self.check_store.record_check(payment, govuk_status)
+
+    def count_outcome(self, outcome):
+        if self.metrics:
+            self.metrics.count_outcome(outcome)
+
+    def count_check_outcome(self, previous_govuk_status, govuk_status):
+        """
+        Counts what was done to a payment that is not yet finished or was just finalised;
+        payments which are completed are counted by the new status of the MTP payment instead.
+        """
+        if previous_govuk_status == GovUkPaymentStatus.capturable:
+            if govuk_status == GovUkPaymentStatus.success:
+                self.count_outcome('captured')
+            elif govuk_status == GovUkPaymentStatus.cancelled:
+                self.count_outcome('cancelled')
+            else:
+                # waiting for security check
+                self.count_outcome('delayed')
+        elif govuk_status and not govuk_status.finished():
+            self.count_outcome('pending')
+
+    @contextmanager
+    def handle_update_errors(self, payment_ref):
+        try:
+            yield
+        except OAuth2Error:
+            self.count_outcome('authentication_error')
+            logger.exception(
+                'Scheduled job: Authentication error while processing %(payment_ref)s',
+                {'payment_ref': payment_ref},
+            )
+        except RequestException as error:
+            self.count_outcome('request_error')
+            response_content = get_requests_exception_for_logging(error)
+            logger.exception(
+                'Scheduled job: Payment check failed for ref %(payment_ref)s. Received: %(response_content)s',
+                {'payment_ref': payment_ref, 'response_content': response_content},
+            )
+        except GovUkPaymentStatusException:
+            # expected much of the time
+            self.count_outcome('govuk_status_error')
@@ -0,0 +1,14 @@
+from django.apps import apps
+from prometheus_client import Counter
+
+try:
+    registry = apps.get_app_config('metrics').metric_registry
+except LookupError:
+    registry = None
+
+prisoner_validity_lookups = Counter(
+    'mtp_send_money_prisoner_validity_lookups',
+    'Prisoner validity lookups by whether they were answered from the cache (hit) or the MTP API (miss)',
+    labelnames=('result',),
+    registry=registry,
+)
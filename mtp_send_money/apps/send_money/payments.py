@@ -1,7 +1,11 @@
+from contextlib import contextmanager
 import enum
 from datetime import datetime, time, timedelta, timezone as tz
+import functools
 import logging
-from urllib.parse import quote_plus as url_quote
+import sys
+import threading
+from urllib.parse import parse_qs, quote_plus as url_quote, urlsplit
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
@@ -9,12 +13,12 @@ from django.core.validators import validate_email
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime, parse_date
 from django.utils.functional import cached_property
-from mtp_common.api import retrieve_all_pages_for_path
 from mtp_common.auth.exceptions import HttpNotFoundError
-import requests
 from requests.exceptions import RequestException
 
+from send_money.circuit_breaker import CircuitBreaker
 from send_money.exceptions import GovUkPaymentStatusException
+from send_money.govuk_pay import GovUkPayClient, RequestPriority
 from send_money.mail import (
     send_email_for_card_payment_accepted,
     send_email_for_card_payment_confirmation,
@@ -22,11 +26,7 @@ from send_money.mail import (
     send_email_for_card_payment_rejected,
     send_email_for_card_payment_timed_out,
 )
-from send_money.utils import (
-    get_api_session,
-    govuk_headers,
-    govuk_url,
-)
+from send_money.utils import get_api_session
 
 logger = logging.getLogger('mtp')
 
@@ -67,11 +67,46 @@ class GovUkPaymentStatus(enum.Enum):
             )
 
     @classmethod
-    def payment_timed_out_after_capturable(cls, govuk_payment):
+    def payment_timed_out_after_capturable(cls, govuk_payment, payment_client=None):
         """
         :return: True if failed because of a timeout and the payment was in a capturable
             status at some point in the past.
 
+        :param payment_client: PaymentClient whose cache of GOV.UK payment events should be used
+        :raise GovUkPaymentStatusException: if the input value is not in the expected format.
+        """
+        if not cls.may_have_timed_out_after_capturable(govuk_payment):
+            return False
+
+        # check if there's a capturable event in the event log
+        govuk_id = govuk_payment['payment_id']
+        payment_client = payment_client or PaymentClient()
+        events = payment_client.get_finished_govuk_payment_events(govuk_id)
+
+        return cls.events_include_capturable(events)
+
+    @classmethod
+    def may_have_timed_out_after_capturable(cls, govuk_payment):
+        """
+        :return: True if the GOV.UK payment's event log must be checked to know whether
+            it timed out after being capturable, see payment_timed_out_after_capturable.
+
+        :raise GovUkPaymentStatusException: if the input value is not in the expected format.
+        """
+        return cls.payment_timed_out(govuk_payment) and cls.could_have_been_capturable(govuk_payment)
+
+    @classmethod
+    def could_have_been_capturable(cls, govuk_payment):
+        """
+        :return: False if the GOV.UK payment was created without delayed capture so it was never capturable.
+        """
+        return govuk_payment.get('delayed_capture') is not False
+
+    @classmethod
+    def payment_timed_out(cls, govuk_payment):
+        """
+        :return: True if failed because of a timeout, regardless of whether it was ever capturable.
+
         :raise GovUkPaymentStatusException: if the input value is not in the expected format.
         """
         status = cls.get_from_govuk_payment(govuk_payment)
@@ -80,14 +115,13 @@ class GovUkPaymentStatus(enum.Enum):
             return False
 
         error_code = govuk_payment['state'].get('code')
-        if error_code != 'P0020':
-            return False
-
-        # check if there's a capturable event in the event log
-        govuk_id = govuk_payment['payment_id']
-        payment_client = PaymentClient()
-        events = payment_client.get_govuk_payment_events(govuk_id)
+        return error_code == 'P0020'
 
+    @classmethod
+    def events_include_capturable(cls, events):
+        """
+        :return: True if the GOV.UK payment event log shows that it was in a capturable status.
+        """
         return any(
             event['state'].get('status') == cls.capturable.name
             for event in events
@@ -103,6 +137,16 @@ class CheckResult(enum.Enum):
     cancel = 'Cancel'
 
 
+class CapturableStep(enum.Enum):
+    """
+    What to do with a GOV.UK payment in status 'capturable' once its MTP payment was updated.
+    """
+    wait = 'Wait'
+    notify_on_hold = 'NotifyOnHold'
+    capture = 'Capture'
+    cancel = 'Cancel'
+
+
 def is_active_payment(payment):
     if payment['status'] == 'pending':
         return True
@@ -118,22 +162,260 @@ def is_active_payment(payment):
         return False
 
 
+class CompactPayment:
+    """
+    Stands in for an MTP payment dict keeping only the fields needed to reconcile it and send
+    notification emails so that large backlogs of incomplete payments take little memory.
+    Security checks are reduced to their status and whether they were actioned.
+
+    Supports the parts of the dict interface used by PaymentClient and `update_incomplete_payments`;
+    any other field is loaded from the API when first read.
+    """
+    fields = (
+        'uuid', 'processor_id', 'status', 'created', 'received_at',
+        'amount', 'recipient_name', 'prisoner_number',
+        # completion attributes, see PaymentClient.get_completion_payment_attr_updates
+        'email', 'worldpay_id', 'cardholder_name', 'card_number_first_digits', 'card_number_last_digits',
+        'card_expiry_date', 'card_brand', 'billing_address',
+    )
+    __slots__ = fields + ('security_check_status', 'security_check_user_actioned', 'load_payment', 'full_payment')
+    # share the few distinct values of these fields
+    interned_fields = {'status', 'card_brand'}
+
+    def __init__(self, payment, load_payment=None):
+        """
+        :param payment: MTP payment dict as returned by the API
+        :param load_payment: callable returning the full MTP payment given its reference
+        """
+        self.load_payment = load_payment
+        self.full_payment = None
+        self.security_check_status = None
+        self.security_check_user_actioned = None
+        for field in self.fields:
+            setattr(self, field, None)
+        self.update(payment)
+
+    def __repr__(self):
+        return f'<CompactPayment {self.uuid}>'
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return getattr(self, key)
+        if key == 'security_check':
+            if self.security_check_status is None:
+                return None
+            return {'status': self.security_check_status, 'user_actioned': self.security_check_user_actioned}
+        if self.full_payment is None:
+            self.full_payment = (self.load_payment and self.load_payment(self.uuid)) or {}
+        return self.full_payment[key]
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def update(self, payment=(), **kwargs):
+        for key, value in dict(payment, **kwargs).items():
+            if key in self.interned_fields and value:
+                value = sys.intern(value)
+            if key in self.fields:
+                setattr(self, key, value)
+            elif key == 'security_check':
+                security_check = value or {}
+                status = security_check.get('status')
+                self.security_check_status = status and sys.intern(status)
+                self.security_check_user_actioned = security_check.get('user_actioned')
+            if self.full_payment is not None:
+                self.full_payment[key] = value
+
+
+class PaymentUpdateBatch:
+    """
+    Merges updates to MTP payments and sends them to the API in groups of `batch_size` payments.
+
+    Each group is sent as one bulk `PATCH /payments/` request with a list of updates; if the API
+    does not support bulk updates, or the bulk request fails, payments are updated one at a time.
+    Callbacks such as sending notification emails run only once the payment's update is saved.
+    """
+    unsupported_status_codes = (404, 405)
+
+    def __init__(self, payment_client, batch_size, handle_errors=None):
+        """
+        :param payment_client: PaymentClient used to make requests
+        :param batch_size: number of payments to send in one request
+        :param handle_errors: context manager factory taking a payment reference,
+            used to handle errors per payment; errors are raised by default
+        """
+        self.payment_client = payment_client
+        self.batch_size = batch_size
+        self.handle_errors = handle_errors or self.raise_errors
+        self.bulk_update_supported = True
+        self.lock = threading.Lock()
+        self.updates = {}
+        self.callbacks = {}
+
+    @staticmethod
+    @contextmanager
+    def raise_errors(payment_ref):
+        yield
+
+    def add(self, payment_ref, payment_update, on_success=None):
+        """
+        Queues an update for a payment merging it with any queued earlier.
+        Sends the group if it's full.
+
+        :param on_success: callable with no arguments to run once the update is saved
+        """
+        if not payment_ref:
+            raise ValueError('payment_ref must be provided')
+        with self.lock:
+            self.updates.setdefault(payment_ref, {}).update(payment_update)
+            if on_success:
+                self.callbacks.setdefault(payment_ref, []).append(on_success)
+            if len(self.updates) < self.batch_size:
+                return
+            updates, callbacks = self.take_queued()
+        self.send(updates, callbacks)
+
+    def flush(self):
+        """
+        Sends all queued updates; must be called once no more updates will be added.
+        """
+        with self.lock:
+            updates, callbacks = self.take_queued()
+        if updates:
+            self.send(updates, callbacks)
+
+    def take_queued(self):
+        updates, callbacks = self.updates, self.callbacks
+        self.updates, self.callbacks = {}, {}
+        return updates, callbacks
+
+    def send(self, updates, callbacks):
+        if self.bulk_update_supported and len(updates) > 1 and self.send_bulk(updates):
+            for payment_ref in updates:
+                with self.handle_errors(payment_ref):
+                    self.run_callbacks(callbacks.get(payment_ref))
+            return
+
+        for payment_ref, payment_update in updates.items():
+            with self.handle_errors(payment_ref):
+                self.payment_client.update_payment(payment_ref, payment_update)
+                self.run_callbacks(callbacks.get(payment_ref))
+
+    def send_bulk(self, updates):
+        """
+        :return: True if all updates were saved using one request
+        """
+        try:
+            self.payment_client.api_session.patch('/payments/', json=[
+                {'uuid': payment_ref, **payment_update}
+                for payment_ref, payment_update in updates.items()
+            ])
+            return True
+        except RequestException as error:
+            if getattr(error.response, 'status_code', None) in self.unsupported_status_codes:
+                self.bulk_update_supported = False
+                logger.info('MTP API does not support bulk payment updates, updating payments one at a time')
+            else:
+                logger.warning(
+                    'Bulk update of %(count)d payments failed, updating them one at a time',
+                    {'count': len(updates)},
+                    exc_info=True,
+                )
+            return False
+        except Exception:
+            # e.g. OAuth2Error when refreshing the access token; updating payments one at a time
+            # means that errors are handled per payment rather than losing the other updates in the group
+            logger.warning(
+                'Bulk update of %(count)d payments failed, updating them one at a time',
+                {'count': len(updates)},
+                exc_info=True,
+            )
+            return False
+
+    def run_callbacks(self, callbacks):
+        for callback in callbacks or []:
+            callback()
+
+
 class PaymentClient:
     CHECK_INCOMPLETE_PAYMENT_DELAY = timedelta(minutes=settings.CHECK_INCOMPLETE_PAYMENT_DELAY)
+    GOVUK_SEARCH_PAGE_SIZE = 500
+    # if set, updates to completed payments are queued rather than sent immediately
+    update_batch = None
 
-    @cached_property
+    def __init__(self, govuk_pay_priority=RequestPriority.interactive):
+        """
+        :param govuk_pay_priority: RequestPriority of requests to GOV.UK Pay; scheduled jobs should use
+            `background` so that they are held back to leave capacity for users
+        """
+        self.govuk_pay_priority = govuk_pay_priority
+        # event logs of finished GOV.UK payments keyed by GOV.UK payment id
+        self.govuk_payment_events_cache = {}
+
+    @classmethod
+    def is_unavailable(cls):
+        """
+        :return: True if the circuit breaker of the MTP API or GOV.UK Pay is open so payments cannot be made
+        """
+        return any(CircuitBreaker.get(upstream).is_open for upstream in ('api', 'govuk_pay'))
+
+    @property
     def api_session(self):
+        # not cached because sessions belong to threads and their access token is renewed when it expires
         return get_api_session()
 
+    @cached_property
+    def govuk_pay_client(self):
+        return GovUkPayClient.shared_client()
+
     def create_payment(self, new_payment):
         api_response = self.api_session.post('/payments/', json=new_payment).json()
         return api_response['uuid']
 
-    def get_incomplete_payments(self):
+    def iter_incomplete_payment_pages(self):
+        """
+        Yields lists of incomplete payments, loading each page only after the previous one was consumed
+        so that at most around one page is held in memory.
+
+        Payments that get updated stop matching the `modified__lt` filter so later payments shift
+        towards the start of the list. The drop in total count since the previous page is used to
+        load payments that shifted into positions that were already loaded.
+        """
         older_than = timezone.now() - self.CHECK_INCOMPLETE_PAYMENT_DELAY
-        return retrieve_all_pages_for_path(
-            self.api_session, '/payments/', modified__lt=older_than.isoformat()
-        )
+        page_size = settings.REQUEST_PAGE_SIZE
+
+        def get_page(offset, limit):
+            return self.api_session.get(
+                '/payments/',
+                params=dict(limit=limit, offset=offset, modified__lt=older_than.isoformat()),
+            ).json()
+
+        offset = 0
+        count = None
+        while True:
+            content = get_page(offset, page_size)
+            results = content.get('results', [])
+            new_count = content.get('count', 0)
+            if count is not None and new_count < count:
+                shift = min(count - new_count, offset)
+                if shift:
+                    results = get_page(offset - shift, shift).get('results', []) + results
+            offset += len(content.get('results', []))
+            count = new_count
+            if results:
+                yield results
+            if not content.get('results') or offset >= count:
+                break
+
+    def compact_payment(self, payment):
+        """
+        :return: CompactPayment loading fields it does not keep using this client
+        """
+        return CompactPayment(payment, load_payment=self.get_payment)
 
     def get_payment(self, payment_ref):
         try:
@@ -175,6 +457,36 @@ class PaymentClient:
         )
         return CheckResult.capture
 
+    def check_payment(self, payment, govuk_payment=None, on_checked=None):
+        """
+        Checks the GOV.UK payment related to `payment`, completes it if necessary
+        and updates the MTP payment if it reached a final status.
+
+        :param govuk_payment: GOV.UK payment if already loaded, e.g. from search results
+        :param on_checked: callable taking the GOV.UK status before and after completing it if necessary,
+            called before the MTP payment is updated
+        :return: the new status of the MTP payment or None if it is not yet completed
+        """
+        govuk_id = payment['processor_id']
+        if govuk_payment is None:
+            govuk_payment = self.get_govuk_payment(govuk_id)
+        previous_govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
+        govuk_status = self.complete_payment_if_necessary(payment, govuk_payment)
+        if on_checked:
+            on_checked(previous_govuk_status, govuk_status)
+
+        # not yet finished and can't do anything so skip
+        if govuk_status and not govuk_status.finished():
+            return None
+
+        if previous_govuk_status != govuk_status and not self.has_completion_details(govuk_payment):
+            # the payment was just captured so load it once to get its settlement data
+            govuk_payment = self.get_govuk_payment(govuk_id)
+
+        # if here, status is either success, failed, cancelled, error
+        # or None (in case of govuk payment not found)
+        return self.update_completed_payment(payment, govuk_payment)
+
     def complete_payment_if_necessary(self, payment, govuk_payment):
         """
         Completes a payment if necessary and returns the resulting GovUkPaymentStatus.
@@ -192,53 +504,87 @@ class PaymentClient:
         :param payment: dict with MTP payment details as returned by the MTP API
         :param govuk_payment: dict with GOV.UK payment details as returned by the GOV.UK Pay API
         """
-        govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
-        if not govuk_status:
-            return
-
-        if govuk_status == GovUkPaymentStatus.error:
-            error_code = govuk_payment.get('state', {}).get('code')
-            error_msg = govuk_payment.get('state', {}).get('message')
-
-            logger.error(
-                f'GOV.UK Pay returned an error: {error_code} {error_msg}',
-                {
-                    'code': error_code,
-                    'msg': error_msg,
-                    # Additional context for Sentry issue
-                    'govuk_id': govuk_payment.get('payment_id'),
-                    'payment_uuid': payment.get('uuid'),
-                }
-            )
-
-        successfulish = govuk_status in [GovUkPaymentStatus.success, GovUkPaymentStatus.capturable]
+        govuk_status, payment_attr_updates = self.get_completion_updates(payment, govuk_payment)
         # if nothing can be done, exit immediately
-        if not successfulish:
+        if payment_attr_updates is None:
             return govuk_status
 
         # update payment so that we can work out if it has to be delayed
-        payment_attr_updates = self.get_completion_payment_attr_updates(payment, govuk_payment)
         if payment_attr_updates:
-            # update instead of replace payment because we want to keep the same reference
-            payment.update(
-                **self.update_payment(payment['uuid'], payment_attr_updates),
-            )
+            if self.update_batch and govuk_status != GovUkPaymentStatus.capturable:
+                # the saved payment is only needed to decide what to do with capturable payments
+                payment.update(payment_attr_updates)
+                self.update_batch.add(payment['uuid'], payment_attr_updates)
+            else:
+                # update instead of replace payment because we want to keep the same reference
+                payment.update(
+                    **self.update_payment(payment['uuid'], payment_attr_updates),
+                )
 
         if govuk_status == GovUkPaymentStatus.capturable:
-            # decide next action
-            check_action = self.get_security_check_result(payment)
-            if check_action == CheckResult.delay:
-                # if the user hasn't been notified, send email
-                if 'email' in payment_attr_updates:
-                    email = payment_attr_updates['email']
-                    send_email_for_card_payment_on_hold(email, payment)
-            elif check_action == CheckResult.capture:
+            step = self.get_capturable_step(payment, payment_attr_updates)
+            if step == CapturableStep.notify_on_hold:
+                send_email_for_card_payment_on_hold(payment_attr_updates['email'], payment)
+            elif step == CapturableStep.capture:
                 govuk_status = self.capture_govuk_payment(govuk_payment)
-            elif check_action == CheckResult.cancel:
+            elif step == CapturableStep.cancel:
                 govuk_status = self.cancel_govuk_payment(govuk_payment)
 
         return govuk_status
 
+    def get_completion_updates(self, payment, govuk_payment):
+        """
+        Decides how the MTP payment should be updated before its GOV.UK payment can be completed,
+        see complete_payment_if_necessary; makes no requests.
+
+        :return: (GovUkPaymentStatus or None, dict of attributes to update the MTP payment with
+            or None if nothing can be done)
+        """
+        govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
+        if not govuk_status:
+            return None, None
+
+        if govuk_status == GovUkPaymentStatus.error:
+            self.log_govuk_payment_error(payment, govuk_payment)
+
+        successfulish = govuk_status in [GovUkPaymentStatus.success, GovUkPaymentStatus.capturable]
+        if not successfulish:
+            return govuk_status, None
+
+        return govuk_status, self.get_completion_payment_attr_updates(payment, govuk_payment)
+
+    def get_capturable_step(self, payment, payment_attr_updates):
+        """
+        Decides what to do with a GOV.UK payment in status 'capturable' once the MTP payment
+        was updated with `payment_attr_updates`; makes no requests.
+
+        :return: CapturableStep
+        """
+        check_action = self.get_security_check_result(payment)
+        if check_action == CheckResult.capture:
+            return CapturableStep.capture
+        if check_action == CheckResult.cancel:
+            return CapturableStep.cancel
+        # if the user hasn't been notified, send email
+        if 'email' in payment_attr_updates:
+            return CapturableStep.notify_on_hold
+        return CapturableStep.wait
+
+    def log_govuk_payment_error(self, payment, govuk_payment):
+        error_code = govuk_payment.get('state', {}).get('code')
+        error_msg = govuk_payment.get('state', {}).get('message')
+
+        logger.error(
+            f'GOV.UK Pay returned an error: {error_code} {error_msg}',
+            {
+                'code': error_code,
+                'msg': error_msg,
+                # Additional context for Sentry issue
+                'govuk_id': govuk_payment.get('payment_id'),
+                'payment_uuid': payment.get('uuid'),
+            }
+        )
+
     def get_completion_payment_attr_updates(self, payment, govuk_payment):
         """
         Returns a dict of completion related attribute names and values extracted from govuk_payment
@@ -302,17 +648,14 @@ class PaymentClient:
             return govuk_status
 
         govuk_id = govuk_payment['payment_id']
-        response = requests.post(
-            govuk_url(f'/payments/{govuk_id}/capture'),
-            headers=govuk_headers(),
-            timeout=15,
+        response = self.govuk_pay_client.post(
+            f'/payments/{govuk_id}/capture', endpoint='capture_payment',
+            priority=self.govuk_pay_priority,
         )
 
         response.raise_for_status()
 
-        govuk_status = GovUkPaymentStatus.success
-        govuk_payment['state']['status'] = govuk_status.name
-        return govuk_status
+        return self.set_finalised_govuk_status(govuk_payment, GovUkPaymentStatus.success)
 
     def cancel_govuk_payment(self, govuk_payment):
         """
@@ -325,23 +668,74 @@ class PaymentClient:
             return govuk_status
 
         govuk_id = govuk_payment['payment_id']
-        response = requests.post(
-            govuk_url(f'/payments/{govuk_id}/cancel'),
-            headers=govuk_headers(),
-            timeout=15,
+        response = self.govuk_pay_client.post(
+            f'/payments/{govuk_id}/cancel', endpoint='cancel_payment',
+            priority=self.govuk_pay_priority,
         )
 
         response.raise_for_status()
 
-        govuk_status = GovUkPaymentStatus.cancelled
+        return self.set_finalised_govuk_status(govuk_payment, GovUkPaymentStatus.cancelled)
+
+    def set_finalised_govuk_status(self, govuk_payment, govuk_status):
+        """
+        Updates the status of a GOV.UK payment in place after it was captured or cancelled
+        as GOV.UK Pay does not return the payment in response; other state is left as GOV.UK Pay sent it.
+
+        :return: the new GovUkPaymentStatus
+        """
         govuk_payment['state']['status'] = govuk_status.name
         return govuk_status
 
+    def has_completion_details(self, govuk_payment):
+        """
+        :return: False if the GOV.UK payment is missing details needed to complete the MTP payment,
+            i.e. the settlement data of a successful payment which only becomes available
+            some time after GOV.UK Pay has accepted a capture
+        """
+        if GovUkPaymentStatus.get_from_govuk_payment(govuk_payment) != GovUkPaymentStatus.success:
+            return True
+        try:
+            self.get_govuk_capture_time(govuk_payment)
+        except GovUkPaymentStatusException:
+            return False
+        return True
+
     def update_completed_payment(self, payment, govuk_payment):
-        govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
-        timed_out_after_capturable = GovUkPaymentStatus.payment_timed_out_after_capturable(govuk_payment)
+        """
+        Updates the MTP payment now that the GOV.UK payment is finished (or could not be found)
+        and notifies the sender.
+
+        :return: the new status of the MTP payment
+        """
+        timed_out_after_capturable = GovUkPaymentStatus.payment_timed_out_after_capturable(
+            govuk_payment, payment_client=self,
+        )
 
         # update mtp payment
+        payment_attr_updates = self.get_completed_payment_attr_updates(
+            payment, govuk_payment, timed_out_after_capturable,
+        )
+        send_email = functools.partial(
+            self.send_completed_payment_email,
+            payment, govuk_payment, timed_out_after_capturable,
+        )
+        if self.update_batch:
+            # notification email is only sent once the update is saved
+            self.update_batch.add(payment['uuid'], payment_attr_updates, on_success=send_email)
+        else:
+            self.update_payment(payment['uuid'], payment_attr_updates)
+            send_email()
+        return payment_attr_updates['status']
+
+    def get_completed_payment_attr_updates(self, payment, govuk_payment, timed_out_after_capturable):
+        """
+        Returns a dict of attribute names and values to update a payment with now that
+        the GOV.UK payment is in a finished status (or could not be found).
+
+        :raise GovUkPaymentStatusException: if the capture date is not yet available
+        """
+        govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
         payment_attr_updates = self.get_completion_payment_attr_updates(payment, govuk_payment)
 
         if govuk_status == GovUkPaymentStatus.success:
@@ -354,45 +748,55 @@ class PaymentClient:
             payment_attr_updates['status'] = 'expired'
         else:
             payment_attr_updates['status'] = 'failed'
+        return payment_attr_updates
 
-        self.update_payment(payment['uuid'], payment_attr_updates)
-
-        # send notification email
+    def send_completed_payment_email(self, payment, govuk_payment, timed_out_after_capturable):
+        """
+        Sends the notification email appropriate for a payment that has been completed, if any.
+        """
         email = (govuk_payment or {}).get('email')
         if not email:
             return
 
+        send_email = self.get_completed_payment_email(payment, govuk_payment, timed_out_after_capturable)
+        if send_email:
+            send_email(email, payment)
+
+    def get_completed_payment_email(self, payment, govuk_payment, timed_out_after_capturable):
+        """
+        Decides which notification email to send for a payment that has been completed; makes no requests.
+
+        :return: function sending the email given the address and payment or None
+        """
+        govuk_status = GovUkPaymentStatus.get_from_govuk_payment(govuk_payment)
         if govuk_status == GovUkPaymentStatus.success:
             was_accepted_by_fiu = (payment.get('security_check') or {}).get('user_actioned')
 
             if was_accepted_by_fiu:
-                send_email_for_card_payment_accepted(email, payment)
-            else:
-                send_email_for_card_payment_confirmation(email, payment)
+                return send_email_for_card_payment_accepted
+            return send_email_for_card_payment_confirmation
         elif govuk_status == GovUkPaymentStatus.cancelled:
-            send_email_for_card_payment_rejected(email, payment)
-        elif govuk_status == GovUkPaymentStatus.failed:
-            if timed_out_after_capturable:
-                # it expired after being captured meaning that the user should really be notified
-                security_check = payment.get('security_check') or {}
-
-                # if it was rejected by FIU, send rejection email anyway
-                if security_check.get('user_actioned') and security_check.get('status') == 'rejected':
-                    send_email_for_card_payment_rejected(email, payment)
-                else:
-                    send_email_for_card_payment_timed_out(email, payment)
-
-                if not security_check.get('user_actioned'):
-                    logger.warning(
-                        'Payment %(payment_id)s timed out before being actioned by FIU',
-                        {'payment_id': payment['uuid']},
-                    )
+            return send_email_for_card_payment_rejected
+        elif govuk_status == GovUkPaymentStatus.failed and timed_out_after_capturable:
+            # it expired after being captured meaning that the user should really be notified
+            security_check = payment.get('security_check') or {}
+
+            if not security_check.get('user_actioned'):
+                logger.warning(
+                    'Payment %(payment_id)s timed out before being actioned by FIU',
+                    {'payment_id': payment['uuid']},
+                )
+
+            # if it was rejected by FIU, send rejection email anyway
+            if security_check.get('user_actioned') and security_check.get('status') == 'rejected':
+                return send_email_for_card_payment_rejected
+            return send_email_for_card_payment_timed_out
+        return None
 
     def get_govuk_payment(self, govuk_id):
-        response = requests.get(
-            govuk_url('/payments/%s' % govuk_id),
-            headers=govuk_headers(),
-            timeout=15
+        response = self.govuk_pay_client.get(
+            '/payments/%s' % govuk_id, endpoint='get_payment',
+            priority=self.govuk_pay_priority,
         )
 
         if response.status_code != 200:
@@ -402,16 +806,65 @@ class PaymentClient:
                 'Unexpected status code: %s' % response.status_code,
                 response=response
             )
+        return self.parse_govuk_payment(response)
+
+    def parse_govuk_payment(self, response):
+        """
+        :return: dict with GOV.UK payment details from a GOV.UK Pay response, dropping invalid emails
+        :raise RequestException: if the response body cannot be parsed
+        """
         try:
-            data = response.json()
-            try:
-                validate_email(data.get('email'))
-            except ValidationError:
-                data['email'] = None
-            return data
+            return self.clean_govuk_payment(response.json())
         except (ValueError, KeyError):
             raise RequestException('Cannot parse response', response=response)
 
+    def clean_govuk_payment(self, data):
+        try:
+            validate_email(data.get('email'))
+        except ValidationError:
+            data['email'] = None
+        return data
+
+    def search_govuk_payments(self, from_date, to_date):
+        """
+        Yields GOV.UK payments created in a time window using GOV.UK Pay's search endpoint,
+        following `next_page` links so that only a handful of requests are needed for many payments.
+
+        :param from_date: inclusive start of the creation date window
+        :param to_date: exclusive end of the creation date window
+        :raise HTTPError: if GOV.UK Pay returns a 4xx or 5xx response
+        :raise RequestException: if the response body cannot be parsed
+        """
+        def format_date(date):
+            return date.astimezone(tz.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        params = {
+            'from_date': format_date(from_date),
+            'to_date': format_date(to_date),
+            'display_size': self.GOVUK_SEARCH_PAGE_SIZE,
+        }
+        while True:
+            response = self.govuk_pay_client.get(
+                '/payments', endpoint='search_payments',
+                priority=self.govuk_pay_priority, params=params,
+            )
+
+            response.raise_for_status()
+            try:
+                data = response.json()
+                results = data['results']
+                next_page = (data.get('_links') or {}).get('next_page')
+            except (ValueError, KeyError, AttributeError):
+                raise RequestException('Cannot parse response', response=response)
+
+            for govuk_payment in results:
+                yield self.clean_govuk_payment(govuk_payment)
+
+            if not results or not next_page or not next_page.get('href'):
+                break
+            # only the query of the link is followed so that the auth token is never sent elsewhere
+            params = parse_qs(urlsplit(next_page['href']).query)
+
     def get_govuk_payment_events(self, govuk_id):
         """
         :return: list with events information about a certain govuk payment.
@@ -420,10 +873,9 @@ class PaymentClient:
         :raise HTTPError: if GOV.UK Pay returns a 4xx or 5xx response
         :raise RequestException: if the response body cannot be parsed
         """
-        response = requests.get(
-            govuk_url(f'/payments/{govuk_id}/events'),
-            headers=govuk_headers(),
-            timeout=15,
+        response = self.govuk_pay_client.get(
+            f'/payments/{govuk_id}/events', endpoint='get_payment_events',
+            priority=self.govuk_pay_priority,
         )
 
         response.raise_for_status()
@@ -434,6 +886,18 @@ class PaymentClient:
         except (ValueError, KeyError):
             raise RequestException('Cannot parse response', response=response)
 
+    def get_finished_govuk_payment_events(self, govuk_id):
+        """
+        Same as get_govuk_payment_events but only loads the events once for the lifetime of this client.
+        Only suitable for finished GOV.UK payments whose event log can no longer change.
+        """
+        try:
+            return self.govuk_payment_events_cache[govuk_id]
+        except KeyError:
+            events = self.get_govuk_payment_events(govuk_id)
+            self.govuk_payment_events_cache[govuk_id] = events
+            return events
+
     def get_govuk_capture_time(self, govuk_payment):
         try:
             capture_submit_time = parse_datetime(
@@ -463,9 +927,9 @@ class PaymentClient:
         )
 
     def create_govuk_payment(self, payment_ref, new_govuk_payment):
-        govuk_response = requests.post(
-            govuk_url('/payments'), headers=govuk_headers(),
-            json=new_govuk_payment, timeout=15
+        govuk_response = self.govuk_pay_client.post(
+            '/payments', endpoint='create_payment', priority=self.govuk_pay_priority,
+            json=new_govuk_payment,
         )
 
         try:
@@ -0,0 +1,324 @@
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+import json
+import math
+import re
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from django.conf import settings
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from send_money.async_payments import AsyncPaymentClient
+from send_money.circuit_breaker import CircuitBreakerAdapter
+
+# response headers that are not worth keeping in recordings
+IGNORED_RESPONSE_HEADERS = {'set-cookie', 'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+
+def split_url(url):
+    """
+    :return: (upstream, path, query) where upstream is `api` or `govuk_pay` if the url belongs to
+        the MTP API or GOV.UK Pay so that recordings can be replayed with different settings
+    """
+    upstreams = {'api': settings.API_URL, 'govuk_pay': settings.GOVUK_PAY_URL}
+    parsed_url = urlsplit(url)
+    upstream = parsed_url.netloc
+    path = parsed_url.path
+    for name, base_url in upstreams.items():
+        base_url = urlsplit((base_url or '').rstrip('/'))
+        if base_url.netloc == parsed_url.netloc and (
+            path == base_url.path or path.startswith(base_url.path + '/')
+        ):
+            upstream = name
+            path = path[len(base_url.path):]
+            break
+    return upstream, path or '/', parse_qsl(parsed_url.query, keep_blank_values=True)
+
+
+def get_endpoint_name(method, url):
+    """
+    :return: name grouping requests to the same endpoint, e.g. `govuk_pay GET /payments/*`;
+        path segments containing digits are taken to be identifiers
+    """
+    upstream, path, _ = split_url(url)
+    path = '/'.join('*' if re.search(r'\d', segment) else segment for segment in path.split('/'))
+    return f'{upstream} {method} {path}'
+
+
+class Recording:
+    """
+    HTTP responses received by a run of `update_incomplete_payments`, saved as a JSON fixture
+    so that the run can be replayed without a network to benchmark changes.
+
+    Fixtures contain real payment and personal details and must be handled accordingly.
+    """
+
+    def __init__(self, interactions=None):
+        self.interactions = []
+        self.replayed = set()
+        # indices of interactions keyed by (upstream, method, path)
+        self.endpoint_index = {}
+        # indices of interactions not yet replayed keyed by (upstream, method, path, query)
+        self.unreplayed_index = {}
+        self.lock = threading.Lock()
+        for interaction in interactions or []:
+            self.index(interaction)
+
+    @classmethod
+    def get_query_key(cls, query):
+        return tuple(sorted(tuple(param) for param in query))
+
+    def index(self, interaction):
+        index = len(self.interactions)
+        self.interactions.append(interaction)
+        endpoint = (interaction['upstream'], interaction['method'], interaction['path'])
+        self.endpoint_index.setdefault(endpoint, []).append(index)
+        query_key = self.get_query_key(interaction['query'])
+        self.unreplayed_index.setdefault(endpoint + (query_key,), deque()).append(index)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f)['interactions'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'interactions': self.interactions}, f, indent=2)
+
+    def add(self, method, url, status_code, headers, content, elapsed):
+        upstream, path, query = split_url(url)
+        with self.lock:
+            self.index({
+                'upstream': upstream,
+                'method': method,
+                'path': path,
+                'query': query,
+                'status_code': status_code,
+                'headers': {
+                    name: value
+                    for name, value in headers.items()
+                    if name.lower() not in IGNORED_RESPONSE_HEADERS
+                },
+                'content': content,
+                'elapsed': elapsed,
+            })
+
+    def find(self, method, url):
+        """
+        Finds the recorded response to a request, in the order recorded if the same request was made
+        several times. Query parameters may not match exactly because some depend on the time of the run,
+        so otherwise the recording to the same endpoint sharing the most query parameter values is chosen,
+        preferring ones not yet replayed.
+
+        :return: recorded interaction or None
+        """
+        upstream, path, query = split_url(url)
+        endpoint = (upstream, method, path)
+        with self.lock:
+            unreplayed = self.unreplayed_index.get(endpoint + (self.get_query_key(query),))
+            if unreplayed:
+                best_index = unreplayed.popleft()
+            else:
+                best_index = self.find_closest(endpoint, query)
+                if best_index is None:
+                    return None
+                if best_index not in self.replayed:
+                    query_key = self.get_query_key(self.interactions[best_index]['query'])
+                    self.unreplayed_index[endpoint + (query_key,)].remove(best_index)
+            self.replayed.add(best_index)
+            return self.interactions[best_index]
+
+    def find_closest(self, endpoint, query):
+        """
+        :return: index of the interaction with `endpoint` whose query is closest to `query` or None
+        """
+        query = {tuple(param) for param in query}
+        best_index = None
+        best_score = None
+        for index in self.endpoint_index.get(endpoint, ()):
+            recorded_query = {tuple(param) for param in self.interactions[index]['query']}
+            score = (
+                len(query & recorded_query) - len(query ^ recorded_query),
+                index not in self.replayed,
+            )
+            if best_score is None or score > best_score:
+                best_index, best_score = index, score
+        return best_index
+
+
+class CallStats:
+    """
+    Counts calls made to each upstream endpoint and how long they took.
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def add(self, method, url, duration):
+        endpoint = get_endpoint_name(method, url)
+        with self.lock:
+            self.durations.setdefault(endpoint, []).append(duration)
+
+    @classmethod
+    def get_percentile(cls, durations, percentile):
+        durations = sorted(durations)
+        rank = math.ceil(len(durations) * percentile / 100)
+        return durations[max(rank - 1, 0)]
+
+    def get_report(self):
+        """
+        :return: list of lines listing calls and latency percentiles in ms for each endpoint
+        """
+        lines = [f'{"Endpoint":<60}{"Calls":>8}{"p50":>10}{"p90":>10}{"p99":>10}']
+        for endpoint, durations in sorted(self.durations.items()):
+            percentiles = ''.join(
+                f'{self.get_percentile(durations, percentile) * 1000:>10.1f}'
+                for percentile in (50, 90, 99)
+            )
+            lines.append(f'{endpoint:<60}{len(durations):>8}{percentiles}')
+        return lines
+
+
+def build_requests_response(request, interaction):
+    response = requests.Response()
+    response.request = request
+    response.url = request.url
+    response.status_code = interaction['status_code']
+    response.headers = CaseInsensitiveDict(interaction['headers'])
+    response.encoding = 'utf-8'
+    response._content = interaction['content'].encode('utf-8')
+    return response
+
+
+@contextmanager
+def patch_transports(send, async_transport):
+    """
+    Replaces how all `requests` sessions and AsyncPaymentClient make requests.
+    """
+    original_send = HTTPAdapter.send
+    original_async_transport = AsyncPaymentClient.transport
+
+    def patched_send(adapter, request, **kwargs):
+        return send(original_send, adapter, request, **kwargs)
+
+    HTTPAdapter.send = patched_send
+    AsyncPaymentClient.transport = async_transport
+    try:
+        yield
+    finally:
+        HTTPAdapter.send = original_send
+        AsyncPaymentClient.transport = original_async_transport
+
+
+class ObservingAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    Passes requests on to `transport` calling `observe` with every response received.
+    """
+
+    def __init__(self, transport, observe):
+        self.transport = transport
+        self.observe = observe
+
+    async def handle_async_request(self, request):
+        start = time.perf_counter()
+        response = None
+        try:
+            response = await self.transport.handle_async_request(request)
+            await response.aread()
+        finally:
+            self.observe(request.method, str(request.url), response, time.perf_counter() - start)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+@contextmanager
+def observing_requests(observe):
+    """
+    Calls `observe(method, url, response, elapsed)` after every request made to the MTP API or GOV.UK Pay
+    by their `requests` sessions or AsyncPaymentClient; `response` is None if the request failed.
+    """
+    original_async_transport = AsyncPaymentClient.transport
+    AsyncPaymentClient.transport = ObservingAsyncTransport(
+        original_async_transport or httpx.AsyncHTTPTransport(),
+        observe,
+    )
+    CircuitBreakerAdapter.add_observer(observe)
+    try:
+        yield
+    finally:
+        CircuitBreakerAdapter.remove_observer(observe)
+        AsyncPaymentClient.transport = original_async_transport
+
+
+@contextmanager
+def recording_requests(recording, stats):
+    """
+    Records responses to all requests made to `recording`, not only those made using the upstream sessions
+    as authenticating with the MTP API is also needed to replay them.
+    """
+    def observe(method, url, response, elapsed):
+        stats.add(method, url, elapsed)
+        if response is not None:
+            recording.add(method, url, response.status_code, response.headers, response.text, elapsed)
+
+    def send(original_send, adapter, request, **kwargs):
+        start = time.perf_counter()
+        response = None
+        try:
+            response = original_send(adapter, request, **kwargs)
+        finally:
+            observe(request.method, request.url, response, time.perf_counter() - start)
+        return response
+
+    async_transport = ObservingAsyncTransport(
+        AsyncPaymentClient.transport or httpx.AsyncHTTPTransport(),
+        observe,
+    )
+    with patch_transports(send, async_transport):
+        yield
+
+
+@contextmanager
+def replaying_requests(recording, stats, latency=None):
+    """
+    Responds to all requests with responses from `recording` instead of making them.
+
+    :param latency: seconds to wait before responding or None to wait as long as when recorded
+    """
+    def get_delay(interaction):
+        return interaction['elapsed'] if latency is None else latency
+
+    def send(original_send, adapter, request, **kwargs):
+        interaction = recording.find(request.method, request.url)
+        if not interaction:
+            raise requests.ConnectionError(f'No recorded response for {request.method} {request.url}', request=request)
+        # the lookup is not part of the latency measured
+        start = time.perf_counter()
+        time.sleep(get_delay(interaction))
+        stats.add(request.method, request.url, time.perf_counter() - start)
+        return build_requests_response(request, interaction)
+
+    async def handle_async_request(request):
+        interaction = recording.find(request.method, str(request.url))
+        if not interaction:
+            raise httpx.ConnectError(f'No recorded response for {request.method} {request.url}', request=request)
+        start = time.perf_counter()
+        await asyncio.sleep(get_delay(interaction))
+        stats.add(request.method, str(request.url), time.perf_counter() - start)
+        return httpx.Response(
+            interaction['status_code'],
+            headers=interaction['headers'],
+            content=interaction['content'].encode('utf-8'),
+        )
+
+    with patch_transports(send, httpx.MockTransport(handle_async_request)):
+        yield
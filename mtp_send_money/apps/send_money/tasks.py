@@ -0,0 +1,57 @@
+import logging
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from mtp_common.spooling import spoolable
+from oauthlib.oauth2 import OAuth2Error
+from requests.exceptions import RequestException
+
+from send_money.exceptions import GovUkPaymentStatusException
+from send_money.govuk_pay import RequestPriority
+from send_money.payments import PaymentClient
+from send_money.utils import get_requests_exception_for_logging
+
+logger = logging.getLogger('mtp')
+
+
+@spoolable()
+def update_payment_from_govuk_pay(payment_ref, govuk_id):
+    """
+    Checks one payment that GOV.UK Pay notified a change to and completes it if necessary
+    in the same way as `update_incomplete_payments`, leaving payments modified within
+    CHECK_INCOMPLETE_PAYMENT_DELAY to the confirmation page and later runs of `update_incomplete_payments`.
+    Runs in the uWSGI spooler if installed.
+    """
+    payment_client = PaymentClient(govuk_pay_priority=RequestPriority.background)
+    try:
+        payment = payment_client.get_payment(payment_ref)
+        if not payment or payment['status'] != 'pending' or payment['processor_id'] != govuk_id:
+            # already completed or not the payment's current GOV.UK payment
+            logger.info(
+                'GOV.UK Pay webhook: Not updating payment %(payment_ref)s',
+                {'payment_ref': payment_ref},
+            )
+            return
+        if parse_datetime(payment['modified']) > timezone.now() - payment_client.CHECK_INCOMPLETE_PAYMENT_DELAY:
+            # the confirmation page may still be completing the payment so, like `update_incomplete_payments`,
+            # recent payments are not touched to avoid sending emails or capturing twice
+            logger.info(
+                'GOV.UK Pay webhook: Not updating recently modified payment %(payment_ref)s',
+                {'payment_ref': payment_ref},
+            )
+            return
+        payment_client.check_payment(payment)
+    except OAuth2Error:
+        logger.exception(
+            'GOV.UK Pay webhook: Authentication error while processing %(payment_ref)s',
+            {'payment_ref': payment_ref},
+        )
+    except RequestException as error:
+        response_content = get_requests_exception_for_logging(error)
+        logger.exception(
+            'GOV.UK Pay webhook: Payment check failed for ref %(payment_ref)s. Received: %(response_content)s',
+            {'payment_ref': payment_ref, 'response_content': response_content},
+        )
+    except GovUkPaymentStatusException:
+        # e.g. settlement data is not yet available; `update_incomplete_payments` will complete the payment
+        pass
@@ -1,14 +1,21 @@
+import json
+import re
 from unittest import mock
 
+from django.core.cache import cache
 from django.test import SimpleTestCase
 from django.utils.crypto import get_random_string
 from mtp_common.auth.api_client import get_request_token_url
 
+from send_money.utils import ApiSessionManager, api_url
+
 
 def mock_auth(rsps):
     """
     Adds a mocked response for OAuth authentication
+    and forgets the shared access token so that it is used
     """
+    ApiSessionManager.shared_manager().reset()
     rsps.add(
         rsps.POST,
         get_request_token_url(),
@@ -20,6 +27,40 @@ def mock_auth(rsps):
     )
 
 
+class StubPaymentsApi:
+    """
+    Stub of the MTP API payment update endpoints that keeps payments in memory
+    so that batching can be checked without a real API.
+    """
+
+    def __init__(self, rsps, payments, supports_bulk_update=True):
+        self.payments = {payment['uuid']: dict(payment) for payment in payments}
+        self.supports_bulk_update = supports_bulk_update
+        self.bulk_requests = []
+        self.single_requests = []
+        rsps.add_callback(rsps.PATCH, api_url('/payments/'), callback=self.bulk_update)
+        rsps.add_callback(rsps.PATCH, re.compile(re.escape(api_url('/payments/')) + r'[^/]+/$'), callback=self.update)
+
+    def bulk_update(self, request):
+        if not self.supports_bulk_update:
+            return 405, {}, json.dumps({'detail': 'Method "PATCH" not allowed.'})
+        updates = json.loads(request.body)
+        self.bulk_requests.append(updates)
+        for update in updates:
+            update = dict(update)
+            self.payments[update.pop('uuid')].update(update)
+        return 200, {}, json.dumps(updates)
+
+    def update(self, request):
+        payment_ref = request.url.rstrip('/').rsplit('/', 1)[-1]
+        if payment_ref not in self.payments:
+            return 404, {}, json.dumps({'detail': 'Not found.'})
+        update = json.loads(request.body)
+        self.single_requests.append((payment_ref, update))
+        self.payments[payment_ref].update(update)
+        return 200, {}, json.dumps(self.payments[payment_ref])
+
+
 def patch_notifications():
     return mock.patch('mtp_common.templatetags.mtp_common.notifications_for_request', mock.Mock(return_value=[]))
 
@@ -32,6 +73,11 @@ def patch_gov_uk_pay_availability_check():
 class BaseTestCase(SimpleTestCase):
     root_url = '/en-gb/'
 
+    def setUp(self):
+        super().setUp()
+        # prisoner lookups are cached
+        cache.clear()
+
     def assertOnPage(self, response, url_name):  # noqa: N802
         self.assertContains(response, '<!-- %s -->' % url_name)
 
@@ -0,0 +1,71 @@
+from django.test.testcases import SimpleTestCase
+
+from send_money.check_schedule import PaymentCheckSchedule
+from send_money.check_store import PaymentCheckStore
+from send_money.payments import GovUkPaymentStatus
+
+
+class PaymentCheckScheduleTestCase(SimpleTestCase):
+    """
+    Tests related to PaymentCheckSchedule.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.schedule = PaymentCheckSchedule(PaymentCheckStore(':memory:'))
+        self.payment = {
+            'uuid': 'wargle-1111',
+            'security_check': {'status': 'pending', 'user_actioned': False},
+        }
+
+    def tearDown(self):
+        self.schedule.store.close()
+        super().tearDown()
+
+    def test_new_payments_are_due(self):
+        self.schedule.refresh([self.payment], now=100)
+        self.assertEqual(self.schedule.get_next_due(), 100)
+        self.assertEqual(self.schedule.take_due(now=100), [self.payment])
+        # postponed in case the check fails
+        self.assertEqual(self.schedule.take_due(now=100), [])
+        self.assertEqual(self.schedule.get_next_due(), 160)
+
+    def test_back_off_doubles_while_status_is_unchanged(self):
+        self.schedule.refresh([self.payment], now=0)
+        # delays are decided by the store whose clock keeps running
+        expected_delays = [60, 120, 240, 480, 960, 1800, 1800]
+        for expected_delay in expected_delays:
+            self.schedule.record_check(self.payment, GovUkPaymentStatus.submitted, now=0)
+            self.assertAlmostEqual(self.schedule.get_next_due(), expected_delay, delta=1)
+
+        self.schedule.record_check(self.payment, GovUkPaymentStatus.capturable, now=0)
+        self.assertAlmostEqual(self.schedule.get_next_due(), 30 * 60, delta=1)
+
+    def test_back_off_recorded_before_is_respected(self):
+        self.schedule.store.record_check(self.payment, GovUkPaymentStatus.capturable)
+
+        self.schedule.refresh([self.payment], now=0)
+        self.assertEqual(self.schedule.take_due(now=0), [])
+        self.assertAlmostEqual(self.schedule.get_next_due(), 30 * 60, delta=1)
+
+    def test_payments_are_due_when_security_check_changes(self):
+        self.schedule.refresh([self.payment], now=0)
+        self.schedule.take_due(now=0)
+        self.schedule.record_check(self.payment, GovUkPaymentStatus.capturable, now=0)
+
+        self.schedule.refresh([self.payment], now=10)
+        self.assertEqual(self.schedule.take_due(now=10), [])
+
+        accepted_payment = {**self.payment, 'security_check': {'status': 'accepted', 'user_actioned': True}}
+        self.schedule.refresh([accepted_payment], now=20)
+        self.assertEqual(self.schedule.take_due(now=20), [accepted_payment])
+
+    def test_payments_no_longer_listed_are_forgotten(self):
+        self.schedule.refresh([self.payment], now=0)
+        self.assertEqual(len(self.schedule), 1)
+        self.schedule.refresh([], now=10)
+        self.assertEqual(len(self.schedule), 0)
+        self.assertIsNone(self.schedule.get_next_due())
+        # checks finishing after a payment is forgotten are ignored
+        self.schedule.record_check(self.payment, GovUkPaymentStatus.success, now=10)
+        self.assertEqual(len(self.schedule), 0)
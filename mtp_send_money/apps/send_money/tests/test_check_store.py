@@ -0,0 +1,64 @@
+from datetime import timedelta
+
+from django.test.testcases import SimpleTestCase
+from django.utils import timezone
+
+from send_money.check_store import PaymentCheckStore
+from send_money.payments import GovUkPaymentStatus
+
+
+class PaymentCheckStoreTestCase(SimpleTestCase):
+    """
+    Tests related to PaymentCheckStore.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.store = PaymentCheckStore(':memory:')
+        self.payment = {
+            'uuid': 'wargle-1111',
+            'security_check': {'status': 'pending', 'user_actioned': False},
+        }
+
+    def tearDown(self):
+        self.store.close()
+        super().tearDown()
+
+    def test_unknown_payments_are_due(self):
+        self.assertTrue(self.store.is_due(self.payment))
+
+    def test_back_off_doubles_while_status_is_unchanged(self):
+        now = timezone.now()
+        expected_delays = [1, 2, 4, 8, 16, 30, 30]
+        for expected_delay in expected_delays:
+            self.store.record_check(self.payment, GovUkPaymentStatus.submitted, now=now)
+            self.assertFalse(
+                self.store.is_due(self.payment, now=now + timedelta(minutes=expected_delay) - timedelta(seconds=1)),
+            )
+            self.assertTrue(self.store.is_due(self.payment, now=now + timedelta(minutes=expected_delay)))
+
+    def test_changed_status_resets_back_off(self):
+        now = timezone.now()
+        for _ in range(3):
+            self.store.record_check(self.payment, GovUkPaymentStatus.submitted, now=now)
+        self.assertFalse(self.store.is_due(self.payment, now=now + timedelta(minutes=2)))
+
+        self.store.record_check(self.payment, GovUkPaymentStatus.success, now=now)
+        self.assertTrue(self.store.is_due(self.payment, now=now + timedelta(minutes=1)))
+
+    def test_changed_security_check_makes_payment_due(self):
+        now = timezone.now()
+        for _ in range(3):
+            self.store.record_check(self.payment, GovUkPaymentStatus.capturable, now=now)
+        self.assertFalse(self.store.is_due(self.payment, now=now))
+
+        self.payment['security_check'] = {'status': 'accepted', 'user_actioned': True}
+        self.assertTrue(self.store.is_due(self.payment, now=now))
+
+    def test_old_checks_are_pruned(self):
+        now = timezone.now()
+        for _ in range(3):
+            self.store.record_check(self.payment, GovUkPaymentStatus.submitted, now=now - timedelta(days=20))
+        self.store.prune(older_than=now - timedelta(days=10))
+
+        self.assertIsNone(self.store.get_check(self.payment['uuid']))
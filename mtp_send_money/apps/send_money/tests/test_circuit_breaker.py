@@ -0,0 +1,119 @@
+import asyncio
+
+from django.test import override_settings
+from django.test.testcases import SimpleTestCase
+import httpx
+from requests.exceptions import ConnectionError
+import responses
+
+from send_money.async_payments import AsyncPaymentClient
+from send_money.circuit_breaker import CircuitBreaker, CircuitOpenError, CircuitState
+from send_money.govuk_pay import GovUkPayClient
+from send_money.utils import govuk_url
+
+
+@override_settings(
+    CIRCUIT_BREAKER_FAILURE_RATE=0.5,
+    CIRCUIT_BREAKER_MINIMUM_REQUESTS=4,
+    CIRCUIT_BREAKER_WINDOW=60,
+    CIRCUIT_BREAKER_OPEN_DURATION=30,
+)
+class CircuitBreakerTestCase(SimpleTestCase):
+    """
+    Tests related to the circuit breaker around upstreams.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.circuit_breaker = CircuitBreaker('upstream')
+
+    def make_requests(self, *failures):
+        for failed in failures:
+            self.circuit_breaker.before_request()
+            self.circuit_breaker.record(failed)
+
+    def test_opens_when_failure_rate_is_reached(self):
+        self.make_requests(False, True, True)
+        self.assertEqual(self.circuit_breaker.state, CircuitState.closed)
+
+        self.make_requests(True)
+        self.assertEqual(self.circuit_breaker.state, CircuitState.open)
+        self.assertTrue(self.circuit_breaker.is_open)
+        with self.assertRaises(CircuitOpenError):
+            self.circuit_breaker.before_request()
+
+    def test_stays_closed_below_failure_rate(self):
+        self.make_requests(False, False, False, True, False, True)
+
+        self.assertEqual(self.circuit_breaker.state, CircuitState.closed)
+
+    def test_half_open_probe_closes_breaker(self):
+        self.make_requests(True, True, True, True)
+
+        with override_settings(CIRCUIT_BREAKER_OPEN_DURATION=0):
+            self.circuit_breaker.before_request()
+            self.assertEqual(self.circuit_breaker.state, CircuitState.half_open)
+            # only one probe at a time
+            with self.assertRaises(CircuitOpenError):
+                self.circuit_breaker.before_request()
+            self.circuit_breaker.record(False)
+
+        self.assertEqual(self.circuit_breaker.state, CircuitState.closed)
+        self.make_requests(False)
+
+    def test_failed_half_open_probe_reopens_breaker(self):
+        self.make_requests(True, True, True, True)
+
+        with override_settings(CIRCUIT_BREAKER_OPEN_DURATION=0):
+            self.make_requests(True)
+
+        self.assertEqual(self.circuit_breaker.state, CircuitState.open)
+        with self.assertRaises(CircuitOpenError):
+            self.circuit_breaker.before_request()
+
+    def test_guard_counts_only_upstream_failures(self):
+        for _ in range(4):
+            with self.assertRaises(ValueError), self.circuit_breaker.guard():
+                raise ValueError
+        self.assertEqual(self.circuit_breaker.state, CircuitState.closed)
+
+        for _ in range(4):
+            with self.assertRaises(ConnectionError), self.circuit_breaker.guard():
+                raise ConnectionError
+        self.assertEqual(self.circuit_breaker.state, CircuitState.open)
+
+    @override_settings(GOVUK_PAY_URL='https://pay.gov.local/v1')
+    def test_govuk_pay_requests_fail_fast_when_open(self):
+        CircuitBreaker.get('govuk_pay').reset()
+        self.addCleanup(CircuitBreaker.get('govuk_pay').reset)
+        client = GovUkPayClient(pool_size=2)
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.GET, govuk_url('/payments/123'), status=503)
+            for _ in range(4):
+                self.assertEqual(client.get('/payments/123', endpoint='get_payment').status_code, 503)
+
+            with self.assertRaises(CircuitOpenError):
+                client.get('/payments/123', endpoint='get_payment')
+            self.assertEqual(len(rsps.calls), 4)
+
+    def test_async_requests_always_record_an_outcome(self):
+        self.make_requests(True, True, True, True)
+
+        def handler(request):
+            raise RuntimeError
+
+        async def make_request():
+            payment_client = AsyncPaymentClient()
+            payment_client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            try:
+                await payment_client.request('GET', 'https://upstream.local/', self.circuit_breaker)
+            finally:
+                await payment_client.client.aclose()
+
+        with override_settings(CIRCUIT_BREAKER_OPEN_DURATION=0):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(make_request())
+
+        # the probe that failed with an unexpected error is no longer waited for
+        self.assertNotEqual(self.circuit_breaker.state, CircuitState.half_open)
+        self.make_requests(False)
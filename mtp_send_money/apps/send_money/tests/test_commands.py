@@ -1,15 +1,25 @@
 from datetime import datetime, timedelta, timezone
+import io
 import json
+import os
+import signal
+import tempfile
+import time
 from unittest import mock
 
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
 from django.test import override_settings
 from django.test.testcases import SimpleTestCase
+import httpx
 import responses
 
-from send_money.tests import mock_auth
+from send_money.async_payments import AsyncPaymentClient
+from send_money.leases import FileLeaseStore, try_lock_file
+from send_money.tests import StubPaymentsApi, mock_auth
 from send_money.utils import api_url, govuk_url
-from send_money.management.commands.update_incomplete_payments import ALWAYS_CHECK_IF_OLDER_THAN
+from send_money.management.commands.update_incomplete_payments import (
+    ALWAYS_CHECK_IF_OLDER_THAN, Command as UpdateIncompletePaymentsCommand,
+)
 
 
 PAYMENT_DATA = {
@@ -30,6 +40,22 @@ PAYMENT_DATA = {
 }
 
 
+def make_payments(count, **fields):
+    """
+    :return: list of `count` payments like PAYMENT_DATA with uuids wargle-1111, wargle-2222 etc.
+        and processor ids 1, 2 etc.
+    """
+    return [
+        {
+            **PAYMENT_DATA,
+            'uuid': f'wargle-{processor_id}{processor_id}{processor_id}{processor_id}',
+            'processor_id': processor_id,
+            **fields,
+        }
+        for processor_id in range(1, count + 1)
+    ]
+
+
 @override_settings(GOVUK_PAY_URL='https://pay.gov.local/v1')
 class UpdateIncompletePaymentsTestCase(SimpleTestCase):
     def setUp(self):
@@ -532,6 +558,815 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
             # double-check that no more emails were sent
             self.assertEqual(len(mock_send_email.call_args_list), 5)
 
+    @mock.patch('send_money.mail.send_email')
+    def test_update_incomplete_payments_concurrently(self, mock_send_email):
+        """
+        Test that incomplete payments get updated in the same way when checked by several workers.
+
+        - wargle-1111 relates to a GOV.UK payment in 'success' status so should become 'taken'
+        - wargle-2222 relates to a GOV.UK payment in 'submitted' status so should be ignored
+        - wargle-3333 relates to a GOV.UK payment in 'cancelled' status so should become 'rejected'
+        """
+        payments = make_payments(3)
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments/1/'),
+                json={
+                    'reference': 'wargle-1111',
+                    'state': {'status': 'success'},
+                    'settlement_summary': {
+                        'capture_submit_time': '2016-10-27T15:11:05Z',
+                        'captured_date': '2016-10-27'
+                    },
+                    'email': 'success_sender@outside.local',
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.PATCH,
+                api_url('/payments/wargle-1111/'),
+                json=payments[0],
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments/2/'),
+                json={
+                    'reference': 'wargle-2222',
+                    'state': {'status': 'submitted'},
+                    'email': 'pending_sender@outside.local',
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments/3/'),
+                json={
+                    'reference': 'wargle-3333',
+                    'state': {'status': 'cancelled'},
+                    'email': 'cancelled_sender@outside.local',
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.PATCH,
+                api_url('/payments/wargle-3333/'),
+                json={
+                    **payments[2],
+                    'status': 'rejected',
+                },
+                status=200,
+            )
+
+            call_command('update_incomplete_payments', workers=3, verbosity=0)
+
+            patch_bodies = {}
+            for call in rsps.calls:
+                if call.request.method == 'PATCH':
+                    payment_ref = call.request.url.rstrip('/').rsplit('/', 1)[-1]
+                    patch_bodies.setdefault(payment_ref, []).append(json.loads(call.request.body.decode()))
+
+        self.assertDictEqual(patch_bodies, {
+            'wargle-1111': [{'status': 'taken', 'received_at': '2016-10-27T15:11:05+00:00'}],
+            'wargle-3333': [{'status': 'rejected'}],
+        })
+        sent_templates = sorted(
+            send_email_call.kwargs['template_name']
+            for send_email_call in mock_send_email.call_args_list
+        )
+        self.assertListEqual(sent_templates, [
+            'send-money-debit-card-confirmation',
+            'send-money-debit-card-payment-rejected',
+        ])
+
+    @mock.patch('send_money.mail.send_email')
+    def test_update_incomplete_payments_using_search(self, mock_send_email):
+        """
+        Test that GOV.UK payments are loaded from paged search results and only missing ones are loaded individually.
+
+        - wargle-1111 is in the first page of search results in 'success' status so should become 'taken'
+        - wargle-2222 is missing from search results so is loaded individually and should be ignored
+        - wargle-3333 is in the second page of search results in 'cancelled' status so should become 'rejected'
+        """
+        payments = [
+            {**payment, 'processor_id': str(payment['processor_id'])}
+            for payment in make_payments(3)
+        ]
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments'),
+                match=[responses.matchers.query_param_matcher({'display_size': '500'}, strict_match=False)],
+                json={
+                    'total': 3,
+                    'count': 2,
+                    'page': 1,
+                    'results': [
+                        {
+                            'payment_id': '1',
+                            'reference': 'wargle-1111',
+                            'state': {'status': 'success'},
+                            'settlement_summary': {
+                                'capture_submit_time': '2016-10-27T15:11:05Z',
+                                'captured_date': '2016-10-27'
+                            },
+                            'email': 'success_sender@outside.local',
+                        },
+                        {
+                            'payment_id': 'unrelated',
+                            'reference': 'wargle-9999',
+                            'state': {'status': 'success'},
+                        },
+                    ],
+                    '_links': {'next_page': {'href': 'https://pay.gov.local/v1/payments?page=2'}},
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments'),
+                match=[responses.matchers.query_param_matcher({'page': '2'}, strict_match=False)],
+                json={
+                    'total': 3,
+                    'count': 1,
+                    'page': 2,
+                    'results': [
+                        {
+                            'payment_id': '3',
+                            'reference': 'wargle-3333',
+                            'state': {'status': 'cancelled'},
+                            'email': 'cancelled_sender@outside.local',
+                        },
+                    ],
+                    '_links': {'next_page': None},
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments/2'),
+                json={
+                    'payment_id': '2',
+                    'reference': 'wargle-2222',
+                    'state': {'status': 'submitted'},
+                    'email': 'pending_sender@outside.local',
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.PATCH,
+                api_url('/payments/wargle-1111/'),
+                json=payments[0],
+                status=200,
+            )
+            rsps.add(
+                rsps.PATCH,
+                api_url('/payments/wargle-3333/'),
+                json={
+                    **payments[2],
+                    'status': 'rejected',
+                },
+                status=200,
+            )
+
+            call_command('update_incomplete_payments', search=True, verbosity=0)
+
+            govuk_urls = [
+                call.request.url
+                for call in rsps.calls
+                if call.request.url.startswith('https://pay.gov.local/')
+            ]
+            self.assertEqual(len(govuk_urls), 3)
+            self.assertEqual(govuk_urls[-1], govuk_url('/payments/2'))
+            patch_bodies = [
+                json.loads(call.request.body)
+                for call in rsps.calls
+                if call.request.method == 'PATCH'
+            ]
+            self.assertListEqual(patch_bodies, [
+                {'status': 'taken', 'received_at': '2016-10-27T15:11:05+00:00'},
+                {'status': 'rejected'},
+            ])
+
+        sent_templates = [
+            send_email_call.kwargs['template_name']
+            for send_email_call in mock_send_email.call_args_list
+        ]
+        self.assertListEqual(sent_templates, [
+            'send-money-debit-card-confirmation',
+            'send-money-debit-card-payment-rejected',
+        ])
+
+    @mock.patch('send_money.mail.send_email')
+    def test_update_incomplete_payments_in_batches(self, mock_send_email):
+        """
+        Test that completed payments are saved in one bulk request and emails are only sent once saved.
+
+        - wargle-1111 relates to a GOV.UK payment in 'success' status without card details so should become 'taken'
+          updating card details in the same request
+        - wargle-2222 relates to a GOV.UK payment in 'submitted' status so should be ignored
+        - wargle-3333 relates to a GOV.UK payment in 'cancelled' status so should become 'rejected'
+        """
+        payments = make_payments(3)
+        govuk_payments = {
+            1: {
+                'reference': 'wargle-1111',
+                'state': {'status': 'success'},
+                'settlement_summary': {
+                    'capture_submit_time': '2016-10-27T15:11:05Z',
+                    'captured_date': '2016-10-27'
+                },
+                'email': 'success_sender@outside.local',
+                'card_details': {'cardholder_name': 'Mr Sender'},
+            },
+            2: {
+                'reference': 'wargle-2222',
+                'state': {'status': 'submitted'},
+                'email': 'pending_sender@outside.local',
+            },
+            3: {
+                'reference': 'wargle-3333',
+                'state': {'status': 'cancelled'},
+                'email': 'cancelled_sender@outside.local',
+            },
+        }
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            for processor_id, govuk_payment in govuk_payments.items():
+                rsps.add(rsps.GET, govuk_url(f'/payments/{processor_id}/'), json=govuk_payment, status=200)
+            api = StubPaymentsApi(rsps, payments)
+
+            def assert_saved(payment_ref):
+                # emails are sent only after the update is saved
+                self.assertEqual(len(api.bulk_requests), 1)
+                self.assertNotEqual(api.payments[payment_ref]['status'], 'pending')
+                return mock.DEFAULT
+
+            mock_send_email.side_effect = lambda **kwargs: assert_saved(kwargs['reference'].split('-', 1)[1])
+
+            call_command('update_incomplete_payments', batch_size=5, verbosity=0)
+
+        self.assertEqual(api.bulk_requests, [[
+            {
+                'uuid': 'wargle-1111',
+                'cardholder_name': 'Mr Sender',
+                'status': 'taken',
+                'received_at': '2016-10-27T15:11:05+00:00',
+            },
+            {'uuid': 'wargle-3333', 'status': 'rejected'},
+        ]])
+        self.assertEqual(api.single_requests, [])
+        sent_templates = [
+            send_email_call.kwargs['template_name']
+            for send_email_call in mock_send_email.call_args_list
+        ]
+        self.assertListEqual(sent_templates, [
+            'send-money-debit-card-confirmation',
+            'send-money-debit-card-payment-rejected',
+        ])
+
+    def test_prioritise_payments(self):
+        """
+        Test that payments are checked in order of priority and then oldest first.
+
+        - wargle-4444 has an accepted security check so should be checked first
+        - wargle-3333 is close to expiring on GOV.UK Pay so should be checked next
+        - wargle-5555 and wargle-2222 are old enough to have finished so should be checked next, oldest first
+        - wargle-1111 is recent and pending so should be checked last
+        """
+        def make_payment(processor_id, age, security_check_status='pending'):
+            return {
+                **PAYMENT_DATA,
+                'uuid': f'wargle-{processor_id}{processor_id}{processor_id}{processor_id}',
+                'processor_id': processor_id,
+                'created': (datetime.now() - age).isoformat() + 'Z',
+                'security_check': {
+                    'status': security_check_status,
+                    'user_actioned': security_check_status != 'pending',
+                },
+            }
+
+        payments = [
+            make_payment(1, timedelta(0)),
+            make_payment(2, timedelta(hours=80)),
+            make_payment(3, timedelta(hours=100)),
+            make_payment(4, timedelta(0), security_check_status='accepted'),
+            make_payment(5, timedelta(hours=130)),
+        ]
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            for payment in payments:
+                rsps.add(
+                    rsps.GET,
+                    govuk_url(f'/payments/{payment["processor_id"]}/'),
+                    json={
+                        'payment_id': payment['processor_id'],
+                        'reference': payment['uuid'],
+                        'state': {'status': 'submitted'},
+                    },
+                    status=200,
+                )
+
+            call_command('update_incomplete_payments', prioritise=True, verbosity=0)
+
+            checked_govuk_ids = [
+                call.request.url.rstrip('/').rsplit('/', 1)[-1]
+                for call in rsps.calls
+                if call.request.url.startswith('https://pay.gov.local/')
+            ]
+        self.assertListEqual(checked_govuk_ids, ['4', '3', '5', '2', '1'])
+
+    def test_unchanged_payments_are_backed_off(self):
+        """
+        Test that when checks are recorded, payments found in the same status are checked less often
+        until their security check changes.
+        """
+        payment = {
+            **PAYMENT_DATA,
+            'security_check': {'status': 'pending', 'user_actioned': False},
+        }
+        with tempfile.TemporaryDirectory() as state_dir, \
+                override_settings(UPDATE_INCOMPLETE_PAYMENTS_STATE_PATH=os.path.join(state_dir, 'state.sqlite3')), \
+                responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            payment_list = rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': 1,
+                    'results': [payment],
+                },
+                status=200,
+            )
+            govuk_payment = rsps.add(
+                rsps.GET,
+                govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/'),
+                json={
+                    'payment_id': PAYMENT_DATA['processor_id'],
+                    'reference': PAYMENT_DATA['uuid'],
+                    'state': {'status': 'submitted'},
+                },
+                status=200,
+            )
+
+            for _ in range(3):
+                call_command('update_incomplete_payments', verbosity=0)
+            self.assertEqual(govuk_payment.call_count, 1)
+
+            payment_list.body = json.dumps({
+                'count': 1,
+                'results': [{**payment, 'security_check': {'status': 'accepted', 'user_actioned': True}}],
+            })
+            call_command('update_incomplete_payments', verbosity=0)
+            self.assertEqual(govuk_payment.call_count, 2)
+
+    def test_partitioned_update(self):
+        """
+        Test that in partitioned mode, payments are checked in partitions that are not leased by other instances
+        even when not running on the first instance.
+
+        - wargle-1111 is in partition 0 which is leased by another instance so should be skipped
+        - wargle-2222 is in partition 1 so should be checked
+        """
+        payments = make_payments(2)
+        with tempfile.TemporaryDirectory() as lease_dir, \
+                override_settings(
+                    UPDATE_INCOMPLETE_PAYMENTS_LEASE_DIRECTORY=lease_dir,
+                    UPDATE_INCOMPLETE_PAYMENTS_METRICS_PATH=os.path.join(lease_dir, 'metrics.prom'),
+                ), \
+                mock.patch(
+                    'send_money.management.commands.update_incomplete_payments.is_first_instance',
+                    return_value=False,
+                ), \
+                responses.RequestsMock() as rsps:
+            FileLeaseStore(lease_dir).acquire('update_incomplete_payments-0-of-2', 'another-instance', 60)
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments/2/'),
+                json={
+                    'payment_id': 2,
+                    'reference': 'wargle-2222',
+                    'state': {'status': 'submitted'},
+                },
+                status=200,
+            )
+
+            call_command('update_incomplete_payments', partitions=2, verbosity=0)
+
+            govuk_calls = [call for call in rsps.calls if call.request.url.startswith('https://pay.gov.local/')]
+            self.assertEqual(len(govuk_calls), 1)
+            # the lease is kept so that other instances do not check the partition again
+            self.assertFalse(
+                FileLeaseStore(lease_dir).acquire('update_incomplete_payments-1-of-2', 'another-instance', 60)
+            )
+            # only payments in the partition checked are part of its backlog
+            with open(os.path.join(lease_dir, 'metrics.prom')) as f:
+                self.assertIn('mtp_update_incomplete_payments_backlog 1.0', f.read())
+
+    def test_partitioned_update_lists_payments_once(self):
+        """
+        Test that incomplete payments are listed once for all partitions that are updated
+        and each payment is checked only in its own partition.
+        """
+        payments = make_payments(2)
+        with tempfile.TemporaryDirectory() as lease_dir, \
+                override_settings(UPDATE_INCOMPLETE_PAYMENTS_LEASE_DIRECTORY=lease_dir), \
+                responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            payment_list = rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            for payment in payments:
+                rsps.add(
+                    rsps.GET,
+                    govuk_url(f'/payments/{payment["processor_id"]}/'),
+                    json={
+                        'payment_id': payment['processor_id'],
+                        'reference': payment['uuid'],
+                        'state': {'status': 'submitted'},
+                    },
+                    status=200,
+                )
+
+            call_command('update_incomplete_payments', partitions=2, verbosity=0)
+
+            self.assertEqual(payment_list.call_count, 1)
+            govuk_calls = [call for call in rsps.calls if call.request.url.startswith('https://pay.gov.local/')]
+            self.assertEqual(len(govuk_calls), 2)
+
+    def test_partitioned_update_lists_payments_again_when_stale(self):
+        """
+        Test that payments are listed again for a partition leased long after they were listed
+        so that payments completed in the meantime are not updated again.
+
+        - wargle-1111 in partition 0 is checked first and takes longer than a lease
+        - wargle-2222 in partition 1 is completed elsewhere in the meantime so should not be checked
+        """
+        payments = make_payments(2)
+        clock = [1000]
+
+        def slow_govuk_payment(request):
+            clock[0] += 301
+            return 200, {}, json.dumps({
+                'payment_id': 1,
+                'reference': 'wargle-1111',
+                'state': {'status': 'submitted'},
+            })
+
+        mocked_time = mock.Mock(wraps=time)
+        mocked_time.monotonic.side_effect = lambda: clock[0]
+        with tempfile.TemporaryDirectory() as lease_dir, \
+                override_settings(
+                    UPDATE_INCOMPLETE_PAYMENTS_LEASE_DIRECTORY=lease_dir,
+                    UPDATE_INCOMPLETE_PAYMENTS_LEASE_DURATION=300,
+                ), \
+                mock.patch('send_money.management.commands.update_incomplete_payments.time', mocked_time), \
+                mock.patch(
+                    'send_money.management.commands.update_incomplete_payments.random.randrange',
+                    return_value=0,
+                ), \
+                responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': 0,
+                    'results': [],
+                },
+                status=200,
+            )
+            rsps.add_callback(rsps.GET, govuk_url('/payments/1/'), callback=slow_govuk_payment)
+
+            call_command('update_incomplete_payments', partitions=2, verbosity=0)
+
+            list_calls = [call for call in rsps.calls if call.request.url.startswith(api_url('/payments/'))]
+            self.assertEqual(len(list_calls), 2)
+            govuk_calls = [call for call in rsps.calls if call.request.url.startswith('https://pay.gov.local/')]
+            self.assertEqual(len(govuk_calls), 1)
+
+    def test_run_stops_when_out_of_time(self):
+        """
+        Test that no more payments are checked once the time budget runs out.
+
+        - wargle-1111 is checked and takes longer than the time budget
+        - wargle-2222 should be left for the next run
+        """
+        payments = make_payments(2)
+        clock = [1000]
+
+        def slow_govuk_payment(request):
+            clock[0] += 120
+            return 200, {}, json.dumps({
+                'payment_id': 1,
+                'reference': 'wargle-1111',
+                'state': {'status': 'submitted'},
+            })
+
+        mocked_time = mock.Mock(wraps=time)
+        mocked_time.monotonic.side_effect = lambda: clock[0]
+        with mock.patch('send_money.management.commands.update_incomplete_payments.time', mocked_time), \
+                responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': len(payments),
+                    'results': payments,
+                },
+                status=200,
+            )
+            rsps.add_callback(rsps.GET, govuk_url('/payments/1/'), callback=slow_govuk_payment)
+
+            call_command('update_incomplete_payments', '--time-budget=60', verbosity=0)
+
+            govuk_calls = [call for call in rsps.calls if call.request.url.startswith('https://pay.gov.local/')]
+            self.assertEqual(len(govuk_calls), 1)
+
+    def test_run_exits_if_previous_run_is_active(self):
+        """
+        Test that the command does nothing while another run holds the lock.
+        """
+        with tempfile.TemporaryDirectory() as lock_dir:
+            lock_path = os.path.join(lock_dir, 'update_incomplete_payments.lock')
+            with override_settings(UPDATE_INCOMPLETE_PAYMENTS_LOCK_PATH=lock_path), \
+                    try_lock_file(lock_path) as locked, \
+                    responses.RequestsMock() as rsps:
+                self.assertTrue(locked)
+                stdout = io.StringIO()
+
+                call_command('update_incomplete_payments', stdout=stdout)
+
+                self.assertEqual(len(rsps.calls), 0)
+                self.assertIn('previous run is still active', stdout.getvalue())
+
+    @override_settings(PAYMENT_DELAYED_CAPTURE_ROLLOUT_PERCENTAGE='100', UPDATE_INCOMPLETE_PAYMENTS_POLL_INTERVAL=0)
+    @mock.patch('send_money.mail.send_email')
+    def test_daemon_checks_payments_when_due(self, mock_send_email):
+        """
+        Test that the daemon checks a payment as soon as its security check changes and stops on SIGTERM.
+
+        - wargle-1111 is first listed with a pending security check so should not be checked
+        - it is then listed with an accepted security check, is not found on GOV.UK Pay and should be failed
+        - SIGTERM is received while it is being updated
+        """
+        pending_payment = {
+            **PAYMENT_DATA,
+            'security_check': {'status': 'pending', 'user_actioned': False},
+        }
+
+        def update_payment(request):
+            os.kill(os.getpid(), signal.SIGTERM)
+            return 200, {}, json.dumps({**PAYMENT_DATA, 'status': 'failed'})
+
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        with tempfile.TemporaryDirectory() as lock_dir, \
+                override_settings(
+                    UPDATE_INCOMPLETE_PAYMENTS_LOCK_PATH=os.path.join(lock_dir, 'daemon.lock'),
+                    NOTIFICATION_EMAIL_REFERENCE_DIRECTORY=os.path.join(lock_dir, 'email-references'),
+                ), \
+                mock.patch(
+                    'send_money.management.commands.update_incomplete_payments.prune_email_references',
+                ) as mock_prune_email_references, \
+                responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': 1,
+                    'results': [pending_payment],
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                api_url('/payments/'),
+                json={
+                    'count': 1,
+                    'results': [PAYMENT_DATA],
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.GET,
+                govuk_url('/payments/1/'),
+                status=404,
+            )
+            rsps.add_callback(rsps.PATCH, api_url('/payments/wargle-1111/'), callback=update_payment)
+
+            payment_clients = []
+            original_get_payment_client = UpdateIncompletePaymentsCommand.get_payment_client
+
+            def get_payment_client(command, *args):
+                payment_clients.append(original_get_payment_client(command, *args))
+                return payment_clients[-1]
+
+            with mock.patch.object(UpdateIncompletePaymentsCommand, 'get_payment_client', get_payment_client):
+                call_command('update_incomplete_payments', '--daemon', verbosity=0)
+
+            govuk_calls = [call for call in rsps.calls if call.request.url.startswith('https://pay.gov.local/')]
+            self.assertEqual(len(govuk_calls), 1)
+            self.assertEqual(json.loads(rsps.calls[-1].request.body)['status'], 'failed')
+        self.assertIs(signal.getsignal(signal.SIGTERM), previous_handler)
+        # nothing cached by clients is kept between cycles
+        self.assertGreater(len(payment_clients), 1)
+        self.assertEqual(len(set(map(id, payment_clients))), len(payment_clients))
+        # sent email references are pruned on every refresh
+        self.assertGreater(mock_prune_email_references.call_count, 1)
+
+    @override_settings(NOTIFICATION_EMAIL_REFERENCE_DIRECTORY='')
+    def test_daemon_requires_email_reference_directory(self):
+        with self.assertRaises(CommandError):
+            call_command('update_incomplete_payments', '--daemon', verbosity=0)
+
+    @mock.patch('send_money.mail.send_email')
+    def test_metrics_are_written(self, mock_send_email):
+        """
+        Test that metrics of the run are written to a file for node-exporter's textfile collector.
+
+        - wargle-1111 is not found on GOV.UK Pay so should be failed
+        - wargle-2222 is still submitted so should be pending
+        """
+        payments = make_payments(2)
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            metrics_path = os.path.join(metrics_dir, 'update_incomplete_payments.prom')
+            with override_settings(UPDATE_INCOMPLETE_PAYMENTS_METRICS_PATH=metrics_path), \
+                    responses.RequestsMock() as rsps:
+                mock_auth(rsps)
+                rsps.add(
+                    rsps.GET,
+                    api_url('/payments/'),
+                    json={
+                        'count': len(payments),
+                        'results': payments,
+                    },
+                    status=200,
+                )
+                rsps.add(
+                    rsps.GET,
+                    govuk_url('/payments/1/'),
+                    status=404,
+                )
+                rsps.add(
+                    rsps.GET,
+                    govuk_url('/payments/2/'),
+                    json={
+                        'payment_id': 2,
+                        'reference': 'wargle-2222',
+                        'state': {'status': 'submitted'},
+                    },
+                    status=200,
+                )
+                rsps.add(
+                    rsps.PATCH,
+                    api_url('/payments/wargle-1111/'),
+                    json={
+                        **payments[0],
+                        'status': 'failed',
+                    },
+                    status=200,
+                )
+
+                call_command('update_incomplete_payments', verbosity=0)
+
+            with open(metrics_path) as f:
+                metrics = f.read()
+
+        self.assertIn('mtp_update_incomplete_payments_outcomes_total{outcome="failed"} 1.0', metrics)
+        self.assertIn('mtp_update_incomplete_payments_outcomes_total{outcome="pending"} 1.0', metrics)
+        self.assertIn('mtp_update_incomplete_payments_backlog 2.0', metrics)
+        self.assertIn(
+            'mtp_update_incomplete_payments_upstream_request_duration_seconds_count'
+            '{endpoint="govuk_pay GET /payments/*/",status="200"} 1.0',
+            metrics,
+        )
+        self.assertIn(
+            'mtp_update_incomplete_payments_upstream_request_duration_seconds_count'
+            '{endpoint="govuk_pay GET /payments/*/",status="404"} 1.0',
+            metrics,
+        )
+        self.assertIn('mtp_update_incomplete_payments_run_duration_seconds', metrics)
+
+    @mock.patch('send_money.mail.send_email')
+    def test_record_and_replay(self, mock_send_email):
+        """
+        Test that responses saved with --record can be replayed without a network
+        and that the replay reports calls made to each endpoint.
+        """
+        with tempfile.TemporaryDirectory() as fixture_dir:
+            fixture_path = os.path.join(fixture_dir, 'recording.json')
+            with responses.RequestsMock() as rsps:
+                mock_auth(rsps)
+                rsps.add(
+                    rsps.GET,
+                    api_url('/payments/'),
+                    json={
+                        'count': 1,
+                        'results': [PAYMENT_DATA],
+                    },
+                    status=200,
+                )
+                rsps.add(
+                    rsps.GET,
+                    govuk_url(f'/payments/{PAYMENT_DATA["processor_id"]}/'),
+                    status=404,
+                )
+                rsps.add(
+                    rsps.PATCH,
+                    api_url(f'/payments/{PAYMENT_DATA["uuid"]}/'),
+                    json={
+                        **PAYMENT_DATA,
+                        'status': 'failed',
+                    },
+                    status=200,
+                )
+
+                call_command('update_incomplete_payments', record=fixture_path, verbosity=0)
+
+            with open(fixture_path) as f:
+                self.assertEqual(len(json.load(f)['interactions']), 4)
+
+            stdout = io.StringIO()
+            with responses.RequestsMock() as rsps:
+                # no requests are made
+                call_command(
+                    'update_incomplete_payments', '--replay-latency=0', replay=fixture_path,
+                    verbosity=0, stdout=stdout,
+                )
+            self.assertEqual(len(rsps.calls), 0)
+
+        report = stdout.getvalue()
+        self.assertIn('Wall time:', report)
+        self.assertRegex(report, r'govuk_pay GET /payments/\*/ +1 ')
+        self.assertRegex(report, r'api PATCH /payments/\*/ +1 ')
+        mock_send_email.assert_not_called()
+
     @override_settings(PAYMENT_DELAYED_CAPTURE_ROLLOUT_PERCENTAGE='100')
     @mock.patch('send_money.mail.send_email')
     def test_skip_payments(self, mock_send_email):
@@ -1228,3 +2063,200 @@ class UpdateIncompletePaymentsTestCase(SimpleTestCase):
             '2016-10-28',
             '2016-10-28T23:59:59.999999+00:00'
         )
+
+
+@override_settings(GOVUK_PAY_URL='https://pay.gov.local/v1')
+class AsyncUpdateIncompletePaymentsTestCase(SimpleTestCase):
+    """
+    Tests for the asyncio-based mode of update_incomplete_payments.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.mocked_is_first_instance = mock.patch(
+            'send_money.management.commands.update_incomplete_payments.is_first_instance',
+            return_value=True
+        )
+        self.mocked_is_first_instance.start()
+
+    def tearDown(self):
+        self.mocked_is_first_instance.stop()
+        super().tearDown()
+
+    def call_command_with_mocked_transport(self, routes):
+        """
+        Runs the command in async mode responding to requests using `routes`, a dict of
+        (method, url) to a list of (status, json) responses returned in order.
+        Returns the list of requests made.
+        """
+        requests_made = []
+
+        def handler(request):
+            requests_made.append(request)
+            url = str(request.url.copy_with(query=None))
+            status, data = routes[(request.method, url)].pop(0)
+            if isinstance(data, bytes):
+                return httpx.Response(status, content=data)
+            return httpx.Response(status, json=data)
+
+        with responses.RequestsMock() as rsps, \
+                mock.patch.object(AsyncPaymentClient, 'transport', httpx.MockTransport(handler)):
+            mock_auth(rsps)
+            call_command('update_incomplete_payments', use_async=True, workers=3, verbosity=0)
+
+        for route, remaining_responses in routes.items():
+            self.assertEqual(remaining_responses, [], msg=f'Not all responses for {route} were used')
+        return requests_made
+
+    @mock.patch('send_money.mail.send_email')
+    def test_update_incomplete_payments(self, mock_send_email):
+        """
+        Test that the async mode makes the same decisions as the synchronous one.
+
+        - wargle-1111 relates to a GOV.UK payment in 'success' status so should become 'taken'
+        - wargle-2222 relates to a GOV.UK payment in 'capturable' status with an accepted check so:
+            * should be captured
+            * should become 'taken' once the captured date is available
+        - wargle-3333 relates to a GOV.UK payment in 'failed' status which was in a capturable status in the past so
+            should become 'expired'
+        - wargle-4444 relates to a GOV.UK payment in 'submitted' status so should be ignored
+        """
+        payments = make_payments(4, email=None)
+        settlement_summary = {
+            'capture_submit_time': '2016-10-27T15:11:05Z',
+            'captured_date': '2016-10-27'
+        }
+        routes = {
+            ('GET', api_url('/payments/')): [(200, {'count': len(payments), 'results': payments})],
+            ('GET', govuk_url('/payments/1')): [(200, {
+                'payment_id': 1,
+                'reference': 'wargle-1111',
+                'state': {'status': 'success'},
+                'settlement_summary': settlement_summary,
+                'email': 'sender1@outside.local',
+            })],
+            ('PATCH', api_url('/payments/wargle-1111/')): [
+                (200, {**payments[0], 'email': 'sender1@outside.local'}),
+                (200, {**payments[0], 'status': 'taken'}),
+            ],
+            ('GET', govuk_url('/payments/2')): [
+                (200, {
+                    'payment_id': 2,
+                    'reference': 'wargle-2222',
+                    'state': {'status': 'capturable'},
+                    'email': 'sender2@outside.local',
+                }),
+                (200, {
+                    'payment_id': 2,
+                    'reference': 'wargle-2222',
+                    'state': {'status': 'success'},
+                    'settlement_summary': settlement_summary,
+                    'email': 'sender2@outside.local',
+                }),
+            ],
+            ('POST', govuk_url('/payments/2/capture')): [(204, None)],
+            ('PATCH', api_url('/payments/wargle-2222/')): [
+                (200, {**payments[1], 'email': 'sender2@outside.local'}),
+                (200, {**payments[1], 'status': 'taken'}),
+            ],
+            ('GET', govuk_url('/payments/3')): [(200, {
+                'payment_id': 3,
+                'reference': 'wargle-3333',
+                'state': {'status': 'failed', 'code': 'P0020'},
+                'email': 'sender3@outside.local',
+            })],
+            ('GET', govuk_url('/payments/3/events')): [(200, {
+                'events': [{'state': {'status': 'capturable', 'finished': False}}],
+            })],
+            ('PATCH', api_url('/payments/wargle-3333/')): [(200, {**payments[2], 'status': 'expired'})],
+            ('GET', govuk_url('/payments/4')): [(200, {
+                'payment_id': 4,
+                'reference': 'wargle-4444',
+                'state': {'status': 'submitted'},
+            })],
+        }
+
+        requests_made = self.call_command_with_mocked_transport(routes)
+
+        patch_bodies = {}
+        for request in requests_made:
+            if request.method == 'PATCH':
+                payment_ref = request.url.path.rstrip('/').rsplit('/', 1)[-1]
+                patch_bodies.setdefault(payment_ref, []).append(json.loads(request.content.decode()))
+        self.assertDictEqual(patch_bodies, {
+            'wargle-1111': [
+                {'email': 'sender1@outside.local'},
+                {'status': 'taken', 'received_at': '2016-10-27T15:11:05+00:00'},
+            ],
+            'wargle-2222': [
+                {'email': 'sender2@outside.local'},
+                {'status': 'taken', 'received_at': '2016-10-27T15:11:05+00:00'},
+            ],
+            'wargle-3333': [
+                {'email': 'sender3@outside.local', 'status': 'expired'},
+            ],
+        })
+        sent_emails = sorted(
+            (send_email_call.kwargs['to'], send_email_call.kwargs['template_name'])
+            for send_email_call in mock_send_email.call_args_list
+        )
+        self.assertListEqual(sent_emails, [
+            ('sender1@outside.local', 'send-money-debit-card-confirmation'),
+            ('sender2@outside.local', 'send-money-debit-card-confirmation'),
+            ('sender3@outside.local', 'send-money-debit-card-payment-timeout'),
+        ])
+
+    @mock.patch('send_money.mail.send_email')
+    def test_errors_are_logged_per_payment(self, mock_send_email):
+        """
+        Test that an upstream error only affects the payment being checked.
+        """
+        payments = make_payments(2)
+        routes = {
+            ('GET', api_url('/payments/')): [(200, {'count': len(payments), 'results': payments})],
+            ('GET', govuk_url('/payments/1')): [(500, {})],
+            ('GET', govuk_url('/payments/2')): [(200, {
+                'payment_id': 2,
+                'reference': 'wargle-2222',
+                'state': {'status': 'cancelled'},
+            })],
+            ('PATCH', api_url('/payments/wargle-2222/')): [(200, {**payments[1], 'status': 'rejected'})],
+        }
+
+        with mock.patch('send_money.management.commands.update_incomplete_payments.logger') as mock_logger:
+            requests_made = self.call_command_with_mocked_transport(routes)
+
+        mock_logger.exception.assert_called_once()
+        self.assertEqual(mock_logger.exception.call_args.args[1]['payment_ref'], 'wargle-1111')
+        patch_requests = [request for request in requests_made if request.method == 'PATCH']
+        self.assertEqual(len(patch_requests), 1)
+        self.assertEqual(json.loads(patch_requests[0].content.decode()), {'status': 'rejected'})
+        mock_send_email.assert_not_called()
+
+    @mock.patch('send_money.mail.send_email')
+    def test_invalid_responses_are_logged_per_payment(self, mock_send_email):
+        """
+        Test that a response that is not JSON only affects the payment being updated.
+        """
+        payments = make_payments(2)
+        routes = {
+            ('GET', api_url('/payments/')): [(200, {'count': len(payments), 'results': payments})],
+            ('GET', govuk_url('/payments/1')): [(200, {
+                'payment_id': 1,
+                'reference': 'wargle-1111',
+                'state': {'status': 'cancelled'},
+            })],
+            ('PATCH', api_url('/payments/wargle-1111/')): [(200, b'<html>Bad gateway</html>')],
+            ('GET', govuk_url('/payments/2')): [(200, {
+                'payment_id': 2,
+                'reference': 'wargle-2222',
+                'state': {'status': 'cancelled'},
+            })],
+            ('PATCH', api_url('/payments/wargle-2222/')): [(200, {**payments[1], 'status': 'rejected'})],
+        }
+
+        with mock.patch('send_money.management.commands.update_incomplete_payments.logger') as mock_logger:
+            self.call_command_with_mocked_transport(routes)
+
+        mock_logger.exception.assert_called_once()
+        self.assertEqual(mock_logger.exception.call_args.args[1]['payment_ref'], 'wargle-1111')
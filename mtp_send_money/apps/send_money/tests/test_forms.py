@@ -1,6 +1,8 @@
 import logging
 from unittest import mock
 
+from django.conf import settings
+from django.core.cache import cache
 from django.test.testcases import SimpleTestCase
 from django.test import override_settings
 from django.utils.crypto import get_random_string
@@ -11,6 +13,7 @@ from send_money.forms import (
     DebitCardPrisonerDetailsForm,
     DebitCardAmountForm,
 )
+from send_money.metrics import prisoner_validity_lookups
 from send_money.tests import mock_auth, patch_gov_uk_pay_availability_check
 from send_money.utils import api_url, get_api_session
 
@@ -20,6 +23,11 @@ logger = logging.getLogger('mtp')
 class FormTestCase(SimpleTestCase):
     form_class = NotImplemented
 
+    def setUp(self):
+        super().setUp()
+        # lookups are cached
+        cache.clear()
+
     @classmethod
     def make_valid_tests(cls, data_sets):
         def make_method(input_data):
@@ -156,6 +164,59 @@ class PrisonerDetailsFormTestCase(FormTestCase):
 class DebitCardPrisonerDetailsFormTestCase(PrisonerDetailsFormTestCase):
     form_class = DebitCardPrisonerDetailsForm
 
+    def make_form(self, prisoner_dob_day='5'):
+        return self.form_class(data={
+            'prisoner_name': 'john smith',
+            'prisoner_number': 'A1234AB',
+            'prisoner_dob_0': prisoner_dob_day,
+            'prisoner_dob_1': '10',
+            'prisoner_dob_2': '1980',
+        })
+
+    def test_prisoner_lookups_are_cached(self):
+        hits = prisoner_validity_lookups.labels(result='hit')
+        misses = prisoner_validity_lookups.labels(result='miss')
+        initial_hits, initial_misses = hits._value.get(), misses._value.get()
+        with responses.RequestsMock() as rsps, \
+                mock.patch('send_money.forms.PrisonerDetailsForm.get_api_session') as mocked_api_session:
+            mocked_api_session.side_effect = get_api_session
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/prisoner_validity/'),
+                json={
+                    'count': 1,
+                    'results': [{
+                        'prisoner_number': 'A1234AB',
+                        'prisoner_dob': '1980-10-05',
+                    }],
+                },
+                status=200,
+            )
+            self.assertTrue(self.make_form().is_valid())
+            self.assertTrue(self.make_form().is_valid())
+            self.assertEqual(len(rsps.calls), 2)
+        self.assertEqual(hits._value.get() - initial_hits, 1)
+        self.assertEqual(misses._value.get() - initial_misses, 1)
+
+    def test_failed_prisoner_lookups_are_cached_briefly(self):
+        with responses.RequestsMock() as rsps, \
+                mock.patch('send_money.forms.PrisonerDetailsForm.get_api_session') as mocked_api_session, \
+                mock.patch('send_money.forms.cache') as mocked_cache:
+            mocked_api_session.side_effect = get_api_session
+            mocked_cache.get.return_value = None
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url('/prisoner_validity/'),
+                json={'count': 0, 'results': []},
+                status=200,
+            )
+            self.assertFalse(self.make_form(prisoner_dob_day='6').is_valid())
+        mocked_cache.set.assert_called_once_with(
+            mock.ANY, {'count': 0, 'results': []}, timeout=settings.PRISONER_VALIDITY_NEGATIVE_CACHE_TTL,
+        )
+
 
 DebitCardPrisonerDetailsFormTestCase.make_valid_tests([
     {
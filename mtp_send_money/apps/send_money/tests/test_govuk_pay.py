@@ -0,0 +1,124 @@
+from datetime import timedelta
+import threading
+from unittest import mock
+
+from django.test import override_settings
+from django.test.testcases import SimpleTestCase
+from django.utils import timezone
+from django.utils.http import http_date
+import responses
+
+from send_money.govuk_pay import GovUkPayClient, RateLimiter, RequestPriority
+from send_money.payments import PaymentClient
+from send_money.utils import govuk_url
+
+
+@override_settings(GOVUK_PAY_URL='https://pay.gov.local/v1', GOVUK_PAY_AUTH_TOKEN='auth-token')
+class GovUkPayClientTestCase(SimpleTestCase):
+    """
+    Tests related to the pooled GOV.UK Pay client.
+    """
+
+    def test_client_is_shared_across_threads_and_payment_clients(self):
+        clients = []
+        threads = [
+            threading.Thread(target=lambda: clients.append(PaymentClient().govuk_pay_client))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(clients), 5)
+        self.assertTrue(all(client is GovUkPayClient.shared_client() for client in clients))
+
+    @override_settings(
+        GOVUK_PAY_RATE_LIMIT=25, GOVUK_PAY_RATE_LIMIT_PROCESSES=5, GOVUK_PAY_RATE_LIMIT_INTERACTIVE_RESERVE=10,
+    )
+    def test_rate_is_shared_between_processes(self):
+        client = GovUkPayClient(pool_size=2)
+        self.assertEqual(client.rate_limiter.max_rate, 5)
+        self.assertEqual(client.rate_limiter.interactive_reserve, 2)
+
+    @override_settings(GOVUK_PAY_TIMEOUTS={'default': 15, 'get_payment': 3})
+    def test_timeout_depends_on_endpoint(self):
+        self.assertEqual(GovUkPayClient.get_timeout('get_payment'), 3)
+        self.assertEqual(GovUkPayClient.get_timeout('capture_payment'), 15)
+
+    def test_requests_are_authenticated(self):
+        client = GovUkPayClient(pool_size=2)
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.GET, govuk_url('/payments/123'), json={'payment_id': '123'}, status=200)
+
+            response = client.get('/payments/123', endpoint='get_payment')
+
+            self.assertEqual(response.json(), {'payment_id': '123'})
+            self.assertEqual(rsps.calls[0].request.headers['Authorization'], 'Bearer auth-token')
+
+    def test_throttled_requests_are_retried_after_delay(self):
+        client = GovUkPayClient(pool_size=2)
+        with responses.RequestsMock() as rsps:
+            rsps.add(rsps.GET, govuk_url('/payments/123'), status=429, headers={'Retry-After': '0'})
+            rsps.add(rsps.GET, govuk_url('/payments/123'), json={'payment_id': '123'}, status=200)
+
+            response = client.get('/payments/123', endpoint='get_payment', priority=RequestPriority.background)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(rsps.calls), 2)
+        self.assertLess(client.rate_limiter.rate, client.rate_limiter.max_rate)
+
+    @override_settings(GOVUK_PAY_RATE_LIMIT_MAX_INTERACTIVE_WAIT=2)
+    def test_interactive_requests_are_not_held_back_for_long(self):
+        client = GovUkPayClient(pool_size=2)
+        with responses.RequestsMock() as rsps, mock.patch('send_money.govuk_pay.time.sleep') as mocked_sleep:
+            rsps.add(rsps.GET, govuk_url('/payments/123'), status=429, headers={'Retry-After': '60'})
+
+            response = client.get('/payments/123', endpoint='get_payment')
+
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(len(rsps.calls), 1)
+        mocked_sleep.assert_not_called()
+
+
+class RateLimiterTestCase(SimpleTestCase):
+    """
+    Tests related to the GOV.UK Pay rate limiter.
+    """
+
+    def test_tokens_are_reserved_for_interactive_requests(self):
+        rate_limiter = RateLimiter(rate=5, interactive_reserve=2)
+
+        for _ in range(3):
+            self.assertEqual(rate_limiter.try_acquire(RequestPriority.background), 0)
+        self.assertGreater(rate_limiter.try_acquire(RequestPriority.background), 0)
+        for _ in range(2):
+            self.assertEqual(rate_limiter.try_acquire(RequestPriority.interactive), 0)
+        self.assertGreater(rate_limiter.try_acquire(RequestPriority.interactive), 0)
+
+    def test_rate_adapts_to_throttling(self):
+        rate_limiter = RateLimiter(rate=10, min_rate=2)
+
+        self.assertEqual(rate_limiter.record_throttled('0'), 0)
+        self.assertEqual(rate_limiter.rate, 5)
+        for _ in range(3):
+            rate_limiter.record_throttled('0')
+        self.assertEqual(rate_limiter.rate, 2)
+
+        for _ in range(100):
+            rate_limiter.record_success()
+        self.assertEqual(rate_limiter.rate, 10)
+
+    def test_throttling_holds_back_all_requests(self):
+        rate_limiter = RateLimiter(rate=10)
+
+        rate_limiter.record_throttled('30')
+
+        self.assertAlmostEqual(rate_limiter.try_acquire(RequestPriority.interactive), 30, delta=1)
+
+    def test_retry_after_formats(self):
+        self.assertEqual(RateLimiter.parse_retry_after('3'), 3)
+        self.assertEqual(RateLimiter.parse_retry_after(None), RateLimiter.default_retry_after)
+        self.assertEqual(RateLimiter.parse_retry_after('soon'), RateLimiter.default_retry_after)
+        retry_at = http_date((timezone.now() + timedelta(seconds=30)).timestamp())
+        self.assertAlmostEqual(RateLimiter.parse_retry_after(retry_at), 30, delta=2)
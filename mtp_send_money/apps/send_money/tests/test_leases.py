@@ -0,0 +1,76 @@
+import os
+import tempfile
+import time
+
+from django.test.testcases import SimpleTestCase
+
+from send_money.leases import FileLeaseStore, get_partition, try_lock_file
+
+
+class GetPartitionTestCase(SimpleTestCase):
+    """
+    Tests related to get_partition.
+    """
+
+    def test_keys_are_spread_across_partitions(self):
+        partitions = [get_partition(f'wargle-{index}', 4) for index in range(200)]
+
+        self.assertEqual(set(partitions), {0, 1, 2, 3})
+        self.assertEqual(partitions, [get_partition(f'wargle-{index}', 4) for index in range(200)])
+
+
+class FileLeaseStoreTestCase(SimpleTestCase):
+    """
+    Tests related to FileLeaseStore.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = FileLeaseStore(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super().tearDown()
+
+    def test_leases_are_exclusive(self):
+        self.assertTrue(self.store.acquire('partition-0', 'instance-a', 60))
+        self.assertFalse(self.store.acquire('partition-0', 'instance-b', 60))
+        self.assertTrue(self.store.acquire('partition-1', 'instance-b', 60))
+
+        self.assertTrue(self.store.renew('partition-0', 'instance-a', 60))
+        self.assertFalse(self.store.renew('partition-0', 'instance-b', 60))
+
+    def test_expired_leases_can_be_taken(self):
+        self.assertTrue(self.store.acquire('partition-0', 'instance-a', -1))
+
+        self.assertTrue(self.store.acquire('partition-0', 'instance-b', 60))
+        self.assertFalse(self.store.renew('partition-0', 'instance-a', 60))
+
+    def test_held_lease_is_renewed_until_lost(self):
+        self.assertTrue(self.store.acquire('partition-0', 'instance-a', 0.3))
+        with self.store.hold('partition-0', 'instance-a', 0.3) as lease:
+            time.sleep(0.4)
+            self.assertTrue(lease.is_held)
+            self.assertFalse(self.store.acquire('partition-0', 'instance-b', 60))
+
+            # another instance takes over the lease as if it had expired
+            self.store.write('partition-0', 'instance-b', 60)
+            time.sleep(0.2)
+            self.assertFalse(lease.is_held)
+
+
+class TryLockFileTestCase(SimpleTestCase):
+    """
+    Tests related to try_lock_file.
+    """
+
+    def test_lock_is_exclusive_until_released(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'job.lock')
+            with try_lock_file(path) as locked:
+                self.assertTrue(locked)
+                with try_lock_file(path) as locked_again:
+                    self.assertFalse(locked_again)
+            with try_lock_file(path) as locked:
+                self.assertTrue(locked)
@@ -0,0 +1,108 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.test import override_settings
+from django.test.testcases import SimpleTestCase
+
+from mtp_common.spooling import Context
+from notifications_python_client.errors import APIError
+
+from send_money.mail import (
+    claim_email_reference, prune_email_references,
+    send_claimed_email, send_email_for_card_payment_confirmation, sending_emails_in_background,
+)
+
+PAYMENT_DATA = {
+    'uuid': 'wargle-1111',
+    'recipient_name': 'John',
+    'amount': 1700,
+    'prisoner_number': 'A1409AE',
+}
+
+
+@mock.patch('send_money.mail.send_email')
+class NotificationEmailTestCase(SimpleTestCase):
+    """
+    Tests related to sending notification emails.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.reference_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.reference_directory.cleanup)
+
+    def test_same_email_is_not_sent_twice(self, mock_send_email):
+        with override_settings(NOTIFICATION_EMAIL_REFERENCE_DIRECTORY=self.reference_directory.name):
+            send_email_for_card_payment_confirmation('sender@outside.local', PAYMENT_DATA)
+            send_email_for_card_payment_confirmation('sender@outside.local', PAYMENT_DATA)
+
+        self.assertEqual(mock_send_email.call_count, 1)
+        self.assertEqual(mock_send_email.call_args.kwargs['reference'], 'confirmation-wargle-1111')
+
+    def test_email_is_sent_again_if_sending_failed(self, mock_send_email):
+        mock_send_email.side_effect = [ConnectionError(), None]
+        with override_settings(NOTIFICATION_EMAIL_REFERENCE_DIRECTORY=self.reference_directory.name):
+            with self.assertRaises(ConnectionError):
+                send_email_for_card_payment_confirmation('sender@outside.local', PAYMENT_DATA)
+            send_email_for_card_payment_confirmation('sender@outside.local', PAYMENT_DATA)
+            send_email_for_card_payment_confirmation('sender@outside.local', PAYMENT_DATA)
+
+        self.assertEqual(mock_send_email.call_count, 2)
+
+    def test_spooled_email_is_released_if_sending_failed(self, mock_send_email):
+        mock_send_email.func.side_effect = ConnectionError()
+        with override_settings(NOTIFICATION_EMAIL_REFERENCE_DIRECTORY=self.reference_directory.name):
+            self.assertTrue(claim_email_reference('confirmation-wargle-1111'))
+            with self.assertRaises(ConnectionError), self.assertLogs('mtp', level='WARNING'):
+                send_claimed_email.func(
+                    template_name='send-money-debit-card-confirmation', to='sender@outside.local',
+                    reference='confirmation-wargle-1111', spoolable_ctx=Context(spooled=True),
+                )
+            self.assertTrue(claim_email_reference('confirmation-wargle-1111'))
+
+        # `send_email` is not spooled again from within the spooler
+        mock_send_email.assert_not_called()
+
+    def test_spooled_email_is_retried_with_reference_kept(self, mock_send_email):
+        mock_send_email.func.side_effect = APIError()
+        with override_settings(NOTIFICATION_EMAIL_REFERENCE_DIRECTORY=self.reference_directory.name), \
+                mock.patch('send_money.mail.send_claimed_email') as mock_send_claimed_email:
+            self.assertTrue(claim_email_reference('confirmation-wargle-1111'))
+            send_claimed_email.func(
+                template_name='send-money-debit-card-confirmation', to='sender@outside.local',
+                reference='confirmation-wargle-1111', spoolable_ctx=Context(spooled=True),
+            )
+            self.assertFalse(claim_email_reference('confirmation-wargle-1111'))
+
+        self.assertEqual(mock_send_claimed_email.call_args.kwargs['retry_attempts'], 1)
+
+    def test_emails_are_not_deduplicated_without_directory(self, mock_send_email):
+        with override_settings(NOTIFICATION_EMAIL_REFERENCE_DIRECTORY=''):
+            send_email_for_card_payment_confirmation('sender@outside.local', PAYMENT_DATA)
+            send_email_for_card_payment_confirmation('sender@outside.local', PAYMENT_DATA)
+
+        self.assertEqual(mock_send_email.call_count, 2)
+
+    def test_emails_can_be_sent_in_background(self, mock_send_email):
+        sending_threads = []
+        mock_send_email.side_effect = lambda **kwargs: sending_threads.append(threading.current_thread())
+
+        with sending_emails_in_background():
+            send_email_for_card_payment_confirmation('sender@outside.local', PAYMENT_DATA)
+
+        self.assertEqual(len(sending_threads), 1)
+        self.assertIsNot(sending_threads[0], threading.current_thread())
+
+    def test_old_references_are_pruned(self, mock_send_email):
+        with override_settings(NOTIFICATION_EMAIL_REFERENCE_DIRECTORY=self.reference_directory.name):
+            self.assertTrue(claim_email_reference('confirmation-wargle-1111'))
+            self.assertTrue(claim_email_reference('confirmation-wargle-2222'))
+            old_path = os.path.join(self.reference_directory.name, os.listdir(self.reference_directory.name)[0])
+            os.utime(old_path, (time.time() - 3600, time.time() - 3600))
+
+            prune_email_references(older_than=time.time() - 60)
+
+            self.assertEqual(len(os.listdir(self.reference_directory.name)), 1)
@@ -1,15 +1,19 @@
+from contextlib import contextmanager
 import json
 from unittest import mock
 
 from django.test import override_settings
 from django.test.testcases import SimpleTestCase
 from mtp_common.test_utils import silence_logger
+from oauthlib.oauth2 import OAuth2Error
 from requests.exceptions import HTTPError, RequestException
 import responses
 
 from send_money.exceptions import GovUkPaymentStatusException
-from send_money.payments import GovUkPaymentStatus, PaymentClient
-from send_money.tests import mock_auth
+from send_money.payments import (
+    CapturableStep, CompactPayment, GovUkPaymentStatus, PaymentClient, PaymentUpdateBatch,
+)
+from send_money.tests import StubPaymentsApi, mock_auth
 from send_money.utils import api_url, govuk_url
 
 
@@ -160,6 +164,75 @@ class GovUkPaymentStatusTestCase(SimpleTestCase):
                 GovUkPaymentStatus.payment_timed_out_after_capturable(govuk_payment),
             )
 
+    def test_payment_created_without_delayed_capture_did_not_time_out_after_capturable(self):
+        """
+        Test that if the govuk payment failed because of timeout but was created without delayed capture,
+        the method returns False without loading the event log.
+        """
+        govuk_payment = {
+            'payment_id': 'payment-id',
+            'delayed_capture': False,
+            'state': {
+                'status': 'failed',
+                'code': 'P0020',
+                'message': 'Payment expired',
+                'finished': True,
+            },
+        }
+
+        with responses.RequestsMock():
+            self.assertFalse(
+                GovUkPaymentStatus.payment_timed_out_after_capturable(govuk_payment),
+            )
+
+    @override_settings(
+        GOVUK_PAY_URL='https://pay.gov.local/v1',
+    )
+    def test_payment_events_are_cached_by_payment_client(self):
+        """
+        Test that the event log of a payment is only loaded once when using the same PaymentClient.
+        """
+        payment_id = 'payment-id'
+
+        govuk_payment = {
+            'payment_id': payment_id,
+            'delayed_capture': True,
+            'state': {
+                'status': 'failed',
+                'code': 'P0020',
+                'message': 'Payment expired',
+                'finished': True,
+            },
+        }
+
+        with responses.RequestsMock() as rsps:
+            rsps.add(
+                rsps.GET,
+                govuk_url(f'/payments/{payment_id}/events/'),
+                status=200,
+                json={
+                    'events': [
+                        {
+                            'payment_id': payment_id,
+                            'state': {
+                                'status': 'capturable',
+                                'finished': False,
+                            },
+                        },
+                    ],
+                    'payment_id': payment_id,
+                },
+            )
+
+            payment_client = PaymentClient()
+            for _ in range(2):
+                self.assertTrue(
+                    GovUkPaymentStatus.payment_timed_out_after_capturable(
+                        govuk_payment, payment_client=payment_client,
+                    ),
+                )
+            self.assertEqual(len(rsps.calls), 1)
+
     def test_payment_didnt_time_out(self):
         """
         Test that if the govuk payment is None or it's not in failed status because of timeout,
@@ -1057,6 +1130,23 @@ class CompletePaymentIfNecessaryTestCase(SimpleTestCase):
         self.assertEqual(status, None)
         mock_send_email.assert_not_called()
 
+    def test_capturable_step_decided_without_requests(self, mock_send_email):
+        """
+        Test that what to do with a capturable payment depends on its security check
+        and whether the sender's email address was only just saved.
+        """
+        client = PaymentClient()
+
+        for security_check_status, payment_attr_updates, expected_step in (
+            ('accepted', {}, CapturableStep.capture),
+            ('rejected', {'email': 'sender@example.com'}, CapturableStep.cancel),
+            ('pending', {'email': 'sender@example.com'}, CapturableStep.notify_on_hold),
+            ('pending', {}, CapturableStep.wait),
+        ):
+            payment = {'uuid': 'some-id', 'security_check': {'status': security_check_status}}
+            self.assertEqual(client.get_capturable_step(payment, payment_attr_updates), expected_step)
+        mock_send_email.assert_not_called()
+
 
 class GetCompletionPaymentAttrUpdatesTestCase(SimpleTestCase):
     """
@@ -1155,3 +1245,235 @@ class GetCompletionPaymentAttrUpdatesTestCase(SimpleTestCase):
                 },
             }
         )
+
+
+@override_settings(REQUEST_PAGE_SIZE=2)
+class IterIncompletePaymentsTestCase(SimpleTestCase):
+    """
+    Tests related to the iter_incomplete_payment_pages method.
+    """
+
+    def add_page(self, rsps, offset, limit, count, results):
+        rsps.add(
+            rsps.GET,
+            api_url('/payments/'),
+            match=[responses.matchers.query_param_matcher(
+                {'offset': str(offset), 'limit': str(limit)},
+                strict_match=False,
+            )],
+            json={
+                'count': count,
+                'results': results,
+            },
+            status=200,
+        )
+
+    def test_pages_are_loaded_lazily(self):
+        """
+        Test that a page is only loaded once the previous one was consumed.
+        """
+        payments = [{'uuid': f'payment-{index}'} for index in range(5)]
+        client = PaymentClient()
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            self.add_page(rsps, offset=0, limit=2, count=5, results=payments[0:2])
+            self.add_page(rsps, offset=2, limit=2, count=5, results=payments[2:4])
+            self.add_page(rsps, offset=4, limit=2, count=5, results=payments[4:])
+
+            pages = client.iter_incomplete_payment_pages()
+            self.assertListEqual(next(pages), payments[0:2])
+            self.assertEqual(len(rsps.calls), 2)  # authentication and first page
+            self.assertListEqual(list(pages), [payments[2:4], payments[4:]])
+
+    def test_payments_shifted_by_updates_are_not_skipped(self):
+        """
+        Test that payments that move into already-loaded positions, because earlier payments were updated
+        and so no longer match the filter, are loaded with an extra request.
+        """
+        payments = [{'uuid': f'payment-{index}'} for index in range(5)]
+        client = PaymentClient()
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            self.add_page(rsps, offset=0, limit=2, count=5, results=payments[0:2])
+            # payment-0 was updated so everything shifted back by one
+            self.add_page(rsps, offset=2, limit=2, count=4, results=payments[3:5])
+            self.add_page(rsps, offset=1, limit=1, count=4, results=payments[2:3])
+
+            loaded_payments = [payment for page in client.iter_incomplete_payment_pages() for payment in page]
+
+        self.assertListEqual(loaded_payments, payments)
+
+
+class PaymentUpdateBatchTestCase(SimpleTestCase):
+    """
+    Tests related to PaymentUpdateBatch.
+    """
+    payments = [
+        {'uuid': f'wargle-{index}', 'status': 'pending'}
+        for index in range(1, 6)
+    ]
+
+    def test_updates_are_merged_and_sent_in_bulk(self):
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            mock_auth(rsps)
+            api = StubPaymentsApi(rsps, self.payments)
+            batch = PaymentUpdateBatch(PaymentClient(), batch_size=2)
+
+            batch.add('wargle-1', {'email': 'sender@outside.local'})
+            batch.add('wargle-1', {'status': 'taken'})
+            self.assertEqual(api.bulk_requests, [])
+            batch.add('wargle-2', {'status': 'failed'})
+            batch.add('wargle-3', {'status': 'rejected'})
+            batch.add('wargle-4', {'status': 'taken'})
+            batch.add('wargle-5', {'status': 'expired'})
+            batch.flush()
+
+        self.assertEqual(api.bulk_requests, [
+            [
+                {'uuid': 'wargle-1', 'email': 'sender@outside.local', 'status': 'taken'},
+                {'uuid': 'wargle-2', 'status': 'failed'},
+            ],
+            [
+                {'uuid': 'wargle-3', 'status': 'rejected'},
+                {'uuid': 'wargle-4', 'status': 'taken'},
+            ],
+        ])
+        # a group of one payment is sent using the individual endpoint
+        self.assertEqual(api.single_requests, [('wargle-5', {'status': 'expired'})])
+        self.assertDictEqual(
+            {payment_ref: payment['status'] for payment_ref, payment in api.payments.items()},
+            {
+                'wargle-1': 'taken',
+                'wargle-2': 'failed',
+                'wargle-3': 'rejected',
+                'wargle-4': 'taken',
+                'wargle-5': 'expired',
+            },
+        )
+
+    def test_falls_back_to_individual_updates(self):
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            mock_auth(rsps)
+            api = StubPaymentsApi(rsps, self.payments, supports_bulk_update=False)
+            batch = PaymentUpdateBatch(PaymentClient(), batch_size=2)
+
+            for payment in self.payments:
+                batch.add(payment['uuid'], {'status': 'taken'})
+            batch.flush()
+
+            bulk_attempts = [call for call in rsps.calls if call.request.url == api_url('/payments/')]
+
+        # bulk updates are only attempted once
+        self.assertEqual(len(bulk_attempts), 1)
+        self.assertFalse(batch.bulk_update_supported)
+        self.assertEqual(api.single_requests, [
+            (payment['uuid'], {'status': 'taken'})
+            for payment in self.payments
+        ])
+
+    def test_callbacks_run_once_saved_and_errors_are_handled_per_payment(self):
+        saved = []
+        failed = []
+
+        @contextmanager
+        def handle_errors(payment_ref):
+            try:
+                yield
+            except RequestException:
+                failed.append(payment_ref)
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            mock_auth(rsps)
+            StubPaymentsApi(rsps, self.payments[:2], supports_bulk_update=False)
+            batch = PaymentUpdateBatch(PaymentClient(), batch_size=3, handle_errors=handle_errors)
+
+            batch.add('wargle-1', {'status': 'taken'}, on_success=lambda: saved.append('wargle-1'))
+            batch.add('unknown', {'status': 'taken'}, on_success=lambda: saved.append('unknown'))
+            self.assertEqual(saved, [])
+            batch.add('wargle-2', {'status': 'taken'}, on_success=lambda: saved.append('wargle-2'))
+
+        self.assertEqual(saved, ['wargle-1', 'wargle-2'])
+        self.assertEqual(failed, ['unknown'])
+
+    def test_unexpected_bulk_errors_fall_back_to_individual_updates(self):
+        saved = []
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps, \
+                mock.patch.object(StubPaymentsApi, 'bulk_update', side_effect=OAuth2Error()), \
+                silence_logger():
+            mock_auth(rsps)
+            api = StubPaymentsApi(rsps, self.payments[:2])
+            batch = PaymentUpdateBatch(PaymentClient(), batch_size=2)
+
+            batch.add('wargle-1', {'status': 'taken'}, on_success=lambda: saved.append('wargle-1'))
+            batch.add('wargle-2', {'status': 'taken'}, on_success=lambda: saved.append('wargle-2'))
+
+        self.assertEqual(api.single_requests, [('wargle-1', {'status': 'taken'}), ('wargle-2', {'status': 'taken'})])
+        self.assertEqual(saved, ['wargle-1', 'wargle-2'])
+
+
+class CompactPaymentTestCase(SimpleTestCase):
+    """
+    Tests related to CompactPayment.
+    """
+    payment = {
+        'uuid': 'wargle-1111',
+        'processor_id': 'govuk-1',
+        'status': 'pending',
+        'amount': 1700,
+        'recipient_name': 'John',
+        'prisoner_number': 'A1409AE',
+        'prisoner_dob': '1989-01-21',
+        'created': '2021-01-01T10:00:00Z',
+        'email': None,
+        'security_check': {
+            'status': 'pending',
+            'user_actioned': False,
+            'rules': ['FIUMONP'],
+            'description': ['Sender is monitored'],
+        },
+    }
+
+    def test_behaves_like_payment_dict(self):
+        payment = CompactPayment(self.payment)
+
+        self.assertFalse(hasattr(payment, '__dict__'))
+        self.assertEqual(payment['uuid'], 'wargle-1111')
+        self.assertEqual(payment.get('processor_id'), 'govuk-1')
+        self.assertEqual(payment.get('email', 'default'), 'default')
+        self.assertEqual(payment['security_check'], {'status': 'pending', 'user_actioned': False})
+        self.assertIsNone(CompactPayment({**self.payment, 'security_check': None}).get('security_check'))
+
+        payment.update({'email': 'sender@outside.local', 'security_check': {'status': 'accepted'}})
+        payment.update(card_brand='Visa')
+        self.assertEqual(payment['email'], 'sender@outside.local')
+        self.assertEqual(payment['card_brand'], 'Visa')
+        self.assertEqual(payment.get('security_check')['status'], 'accepted')
+
+    def test_other_fields_are_loaded_lazily(self):
+        load_payment = mock.Mock(return_value=self.payment)
+        payment = CompactPayment(self.payment, load_payment=load_payment)
+        load_payment.assert_not_called()
+
+        self.assertEqual(payment['prisoner_dob'], '1989-01-21')
+        self.assertEqual(payment.get('security_check')['status'], 'pending')
+        self.assertIsNone(payment.get('unknown'))
+        load_payment.assert_called_once_with('wargle-1111')
+
+    def test_decisions_are_the_same_as_for_dicts(self):
+        client = PaymentClient()
+        govuk_payment = {
+            'email': 'sender@outside.local',
+            'provider_id': '123',
+            'card_details': {'card_brand': 'Visa', 'billing_address': {'line1': '1 Street'}},
+        }
+        for security_check_status in ('pending', 'accepted', 'rejected'):
+            payment = {**self.payment, 'security_check': {'status': security_check_status}}
+            self.assertEqual(
+                client.get_security_check_result(CompactPayment(payment)),
+                client.get_security_check_result(payment),
+            )
+        self.assertEqual(
+            client.get_completion_payment_attr_updates(CompactPayment(self.payment), govuk_payment),
+            client.get_completion_payment_attr_updates(self.payment, govuk_payment),
+        )
@@ -0,0 +1,83 @@
+from unittest import mock
+
+from django.test import override_settings
+from django.test.testcases import SimpleTestCase
+import requests
+import responses
+
+from send_money.circuit_breaker import CircuitBreaker, CircuitBreakerAdapter
+from send_money.recording import CallStats, Recording, get_endpoint_name, observing_requests, split_url
+
+
+@override_settings(API_URL='http://api.local', GOVUK_PAY_URL='https://pay.gov.local/v1')
+class RecordingTestCase(SimpleTestCase):
+    """
+    Tests related to recording and replaying HTTP responses.
+    """
+
+    def test_urls_are_split_by_upstream(self):
+        self.assertEqual(
+            split_url('https://pay.gov.local/v1/payments/abc/?display_size=10'),
+            ('govuk_pay', '/payments/abc/', [('display_size', '10')]),
+        )
+        self.assertEqual(split_url('http://api.local/payments/'), ('api', '/payments/', []))
+        self.assertEqual(split_url('https://notify.local/v2/email'), ('notify.local', '/v2/email', []))
+
+    def test_identifiers_are_grouped_in_endpoint_names(self):
+        self.assertEqual(
+            get_endpoint_name('GET', 'https://pay.gov.local/v1/payments/a1b2c3/events/'),
+            'govuk_pay GET /payments/*/events/',
+        )
+
+    def test_closest_recorded_response_is_replayed(self):
+        recording = Recording()
+        for offset in (0, 10):
+            recording.add(
+                'GET', f'http://api.local/payments/?limit=10&offset={offset}&modified__lt=2021-01-01',
+                200, {'Content-Type': 'application/json'}, f'{{"offset": {offset}}}', 0.1,
+            )
+        recording.add('GET', 'http://api.local/payments/abc/', 200, {}, '"first"', 0.1)
+        recording.add('GET', 'http://api.local/payments/abc/', 200, {}, '"second"', 0.1)
+
+        interaction = recording.find('GET', 'http://api.local/payments/?limit=10&offset=10&modified__lt=2022-01-01')
+        self.assertEqual(interaction['content'], '{"offset": 10}')
+        self.assertEqual(recording.find('GET', 'http://api.local/payments/abc/')['content'], '"first"')
+        self.assertEqual(recording.find('GET', 'http://api.local/payments/abc/')['content'], '"second"')
+        # repeated once all have been replayed
+        self.assertEqual(recording.find('GET', 'http://api.local/payments/abc/')['content'], '"first"')
+        self.assertIsNone(recording.find('PATCH', 'http://api.local/payments/abc/'))
+
+    def test_exact_requests_are_replayed_without_comparing_queries(self):
+        recording = Recording()
+        for index in range(3):
+            recording.add('GET', f'http://api.local/payments/{index}/?a=1&b=2', 200, {}, f'"{index}"', 0.1)
+
+        with mock.patch.object(recording, 'find_closest') as find_closest:
+            self.assertEqual(recording.find('GET', 'http://api.local/payments/1/?b=2&a=1')['content'], '"1"')
+        find_closest.assert_not_called()
+
+    def test_latency_percentiles(self):
+        durations = [index / 1000 for index in range(1, 101)]
+        self.assertEqual(CallStats.get_percentile(durations, 50), 0.05)
+        self.assertEqual(CallStats.get_percentile(durations, 99), 0.099)
+        self.assertEqual(CallStats.get_percentile([0.2], 90), 0.2)
+
+    def test_only_upstream_sessions_are_observed_including_failures(self):
+        observed = []
+        session = requests.Session()
+        session.mount('http://', CircuitBreakerAdapter(CircuitBreaker('test')))
+        with responses.RequestsMock() as rsps, \
+                observing_requests(lambda method, url, response, elapsed: observed.append((url, response))):
+            rsps.add(rsps.GET, 'http://api.local/payments/', json={})
+            rsps.add(rsps.GET, 'http://api.local/payments/abc/', body=requests.ConnectionError())
+            rsps.add(rsps.GET, 'http://other.local/')
+
+            session.get('http://api.local/payments/')
+            with self.assertRaises(requests.ConnectionError):
+                session.get('http://api.local/payments/abc/')
+            requests.get('http://other.local/')
+
+        self.assertEqual([url for url, _ in observed], ['http://api.local/payments/', 'http://api.local/payments/abc/'])
+        self.assertEqual(observed[0][1].status_code, 200)
+        self.assertIsNone(observed[1][1])
+        self.assertEqual(CircuitBreakerAdapter.observers, ())
@@ -1,11 +1,15 @@
 import datetime
 from decimal import Decimal
 from functools import partial
+import threading
+import time
 import unittest
+from unittest import mock
 
 from django.core.exceptions import ValidationError
 from django.test.utils import override_settings
-from requests.exceptions import Timeout
+from mtp_common.test_utils import silence_logger
+from requests.exceptions import ConnectionError, Timeout
 import responses
 
 from send_money.utils import (
@@ -14,7 +18,7 @@ from send_money.utils import (
     format_percentage, currency_format, currency_format_pence,
     clamp_amount, get_service_charge, get_total_charge,
     RejectCardNumberValidator, validate_prisoner_number,
-    api_url, check_payment_service_available,
+    api_url, fetch_payment_service_availability, StaleWhileRevalidateValue, ApiSessionManager,
 )
 
 
@@ -327,35 +331,35 @@ class PaymentServiceAvailabilityTestCase(unittest.TestCase):
     def test_passed_healthcheck_returns_true(self):
         with responses.RequestsMock() as rsps:
             rsps.add(rsps.GET, api_url('/service-availability/'), json={'gov_uk_pay': {'status': True}})
-            available, message_to_users = check_payment_service_available()
+            available, message_to_users = fetch_payment_service_availability()
         self.assertTrue(available)
         self.assertIsNone(message_to_users)
 
     def test_healthcheck_timeout_returns_true(self):
         with responses.RequestsMock() as rsps:
             rsps.add(rsps.GET, api_url('/service-availability/'), body=Timeout())
-            available, message_to_users = check_payment_service_available()
+            available, message_to_users = fetch_payment_service_availability()
         self.assertTrue(available)
         self.assertIsNone(message_to_users)
 
     def test_failed_healthcheck_returns_true(self):
         with responses.RequestsMock() as rsps:
             rsps.add(rsps.GET, api_url('/service-availability/'), body=b'Server error', status=500)
-            available, message_to_users = check_payment_service_available()
+            available, message_to_users = fetch_payment_service_availability()
         self.assertTrue(available)
         self.assertIsNone(message_to_users)
 
     def test_healthcheck_with_service_unspecified_returns_true(self):
         with responses.RequestsMock() as rsps:
             rsps.add(rsps.GET, api_url('/service-availability/'), json={'another_service': {'status': False}})
-            available, message_to_users = check_payment_service_available()
+            available, message_to_users = fetch_payment_service_availability()
         self.assertTrue(available)
         self.assertIsNone(message_to_users)
 
     def test_healthcheck_with_service_down_returns_false(self):
         with responses.RequestsMock() as rsps:
             rsps.add(rsps.GET, api_url('/service-availability/'), json={'gov_uk_pay': {'status': False}})
-            available, message_to_users = check_payment_service_available()
+            available, message_to_users = fetch_payment_service_availability()
         self.assertFalse(available)
         self.assertIsNone(message_to_users)
 
@@ -364,6 +368,123 @@ class PaymentServiceAvailabilityTestCase(unittest.TestCase):
             rsps.add(rsps.GET, api_url('/service-availability/'), json={
                 'gov_uk_pay': {'status': False, 'message_to_users': 'Scheduled downtime'}
             })
-            available, message_to_users = check_payment_service_available()
+            available, message_to_users = fetch_payment_service_availability()
         self.assertFalse(available)
         self.assertEqual(message_to_users, 'Scheduled downtime')
+
+
+class StaleWhileRevalidateValueTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.release_fetch = threading.Event()
+        self.fetch = mock.Mock(__name__='fetch', side_effect=self.slow_fetch)
+        self.value = StaleWhileRevalidateValue(self.fetch, ttl=30, default='default')
+
+    def slow_fetch(self):
+        self.release_fetch.wait(5)
+        return f'fetched {self.fetch.call_count}'
+
+    def wait_for_refresh(self):
+        self.release_fetch.set()
+        deadline = time.monotonic() + 5
+        while self.value.refreshing and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.release_fetch.clear()
+
+    def test_default_returned_while_first_fetch_is_in_progress(self):
+        self.assertEqual(self.value.get(), 'default')
+        self.assertEqual(self.value.get(), 'default')
+        self.wait_for_refresh()
+        self.assertEqual(self.value.get(), 'fetched 1')
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_stale_value_returned_while_refreshing(self):
+        self.value.get()
+        self.wait_for_refresh()
+
+        with mock.patch('send_money.utils.time.monotonic', return_value=time.monotonic() + 31):
+            self.assertEqual(self.value.get(), 'fetched 1')
+            self.assertEqual(self.value.get(), 'fetched 1')
+        self.wait_for_refresh()
+        self.assertEqual(self.value.get(), 'fetched 2')
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_value_kept_if_refresh_fails(self):
+        self.value.get()
+        self.wait_for_refresh()
+
+        self.fetch.side_effect = ConnectionError()
+        with mock.patch('send_money.utils.time.monotonic', return_value=time.monotonic() + 31), \
+                silence_logger():
+            self.value.get()
+            self.wait_for_refresh()
+        self.assertEqual(self.value.get(), 'fetched 1')
+
+    def test_refreshing_continues_after_unexpected_error(self):
+        self.fetch.side_effect = AttributeError()
+        with silence_logger():
+            self.value.get()
+            self.wait_for_refresh()
+        self.assertIsNone(self.value.refreshing)
+
+        self.fetch.side_effect = self.slow_fetch
+        with mock.patch('send_money.utils.time.monotonic', return_value=time.monotonic() + 31):
+            self.assertEqual(self.value.get(), 'default')
+        self.wait_for_refresh()
+        self.assertEqual(self.value.get(), 'fetched 2')
+
+
+class ApiSessionManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.manager = ApiSessionManager()
+        self.tokens = []
+        patcher = mock.patch.object(ApiSessionManager, 'fetch_token', side_effect=self.fetch_token)
+        self.fetch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_token(self, expires_in=3600):
+        token = {'access_token': f'token {len(self.tokens) + 1}', 'expires_at': time.time() + expires_in}
+        self.tokens.append(token)
+        return token
+
+    def test_token_shared_by_threads_with_their_own_sessions(self):
+        session = self.manager.get_session()
+        self.assertIs(self.manager.get_session(), session)
+
+        thread_sessions = []
+        thread = threading.Thread(target=lambda: thread_sessions.append(self.manager.get_session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(thread_sessions[0], session)
+        self.assertEqual(thread_sessions[0].token['access_token'], 'token 1')
+        self.assertEqual(session.token['access_token'], 'token 1')
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_expiring_token_renewed_in_background(self):
+        self.fetch.side_effect = partial(self.fetch_token, expires_in=60)
+        self.assertEqual(self.manager.get_session().token['access_token'], 'token 1')
+
+        self.fetch.side_effect = self.fetch_token
+        with override_settings(API_TOKEN_RENEWAL_MARGIN=120):
+            self.assertEqual(self.manager.get_session().token['access_token'], 'token 1')
+            deadline = time.monotonic() + 5
+            while self.manager.renewing and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.manager.get_session().token['access_token'], 'token 2')
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_expired_token_replaced(self):
+        self.fetch.side_effect = partial(self.fetch_token, expires_in=-1)
+        self.manager.get_session()
+        self.fetch.side_effect = self.fetch_token
+        self.assertEqual(self.manager.get_session().token['access_token'], 'token 2')
+
+    def test_rejected_token_replaced_once(self):
+        session = self.manager.get_session()
+        rejected_token = session.token
+        self.assertEqual(self.manager.get_session(reconnect=True).token['access_token'], 'token 2')
+
+        # another thread that used the same token reconnects after it was replaced
+        self.assertEqual(self.manager.get_token(rejected_token=rejected_token)['access_token'], 'token 2')
+        self.assertEqual(self.fetch.call_count, 2)
@@ -2,8 +2,10 @@ import datetime
 from decimal import Decimal
 import json
 import logging
+import time
 from unittest import mock
 
+from django.conf import settings
 from django.test import override_settings
 from django.test.testcases import SimpleTestCase
 from django.urls import reverse, reverse_lazy
@@ -11,11 +13,14 @@ from mtp_common.test_utils import silence_logger
 from requests import ConnectionError
 import responses
 
+from send_money.circuit_breaker import CircuitBreaker
+from send_money.forms import DebitCardAmountForm
 from send_money.models import PaymentMethodBankTransferEnabled as PaymentMethod
 from send_money.tests import (
     BaseTestCase, mock_auth,
     patch_notifications, patch_gov_uk_pay_availability_check,
 )
+from send_money.tasks import update_payment_from_govuk_pay
 from send_money.views import should_be_capture_delayed
 from send_money.utils import api_url, govuk_url, get_api_session
 
@@ -108,6 +113,10 @@ class DebitCardFlowTestCase(SendMoneyTestCase):
         return mock.patch('send_money.forms.DebitCardAmountForm.is_account_balance_below_threshold',
                           return_value=True)
 
+    @classmethod
+    def patch_prisoner_balance_prefetch(cls):
+        return mock.patch('send_money.forms.DebitCardAmountForm.prefetch_prisoner_account_balance')
+
     def choose_debit_card_payment_method(self):
         response = self.client.post(self.choose_method_url, data={
             'payment_method': PaymentMethod.debit_card.name
@@ -123,7 +132,8 @@ class DebitCardFlowTestCase(SendMoneyTestCase):
             'prisoner_dob_2': '1980',
         }
         data.update(kwargs)
-        with self.patch_prisoner_details_check(), self.patch_prisoner_balance_check():
+        with self.patch_prisoner_details_check(), self.patch_prisoner_balance_check(), \
+                self.patch_prisoner_balance_prefetch():
             return self.client.post(DebitCardPrisonerDetailsTestCase.url, data=data, follow=True)
 
     def fill_in_amount(self, **kwargs):
@@ -311,14 +321,7 @@ class DebitCardAmountTestCase(DebitCardFlowTestCase):
         self.fill_in_prisoner_details()
 
         with self.patch_prisoner_details_check(), responses.RequestsMock() as rsps:
-            # This mock_auth(rsps) call needs to remain, as there appears to be an
-            # issue where we need to call it in this test but not subsequent tests.
-            # This probably means there is something wrong with the test setup or reset
-            # to be investigated
-            # The reason for this is due to the fact that `DebitCardAmountForm.get_api_session` binds
-            # the session state to the class, and implements logic to not fetch it if it is set (and reconnect isn't
-            # passed as an arg) This means that the auth call will only be made the first time
-            # `DebitCardAmountForm.get_api_session` is invoked after `DebitCardAmountForm` is imported
+            # the access token is shared by the whole process so mock_auth also forgets it
             mock_auth(rsps)
             rsps.add(
                 rsps.GET,
@@ -416,6 +419,50 @@ class DebitCardAmountTestCase(DebitCardFlowTestCase):
         PRISONER_CAPPING_ENABLED=False,
         PRISONER_CAPPING_THRESHOLD_IN_POUNDS=Decimal('50')
     )
+    @override_settings(
+        SERVICE_CHARGE_PERCENTAGE=Decimal('0'),
+        SERVICE_CHARGE_FIXED=Decimal('0'),
+        PRISONER_CAPPING_ENABLED=True,
+        PRISONER_CAPPING_THRESHOLD_IN_POUNDS=Decimal('900')
+    )
+    @mock.patch('send_money.forms.DebitCardAmountForm.get_api_session', side_effect=lambda reconnect: get_api_session())
+    def test_prisoner_balance_is_prefetched(self, mocked_api_session):
+        self.choose_debit_card_payment_method()
+        prefetches = []
+        prefetch = DebitCardAmountForm.prefetch_prisoner_account_balance
+
+        def recording_prefetch(prisoner_number):
+            prefetches.append(prefetch(prisoner_number))
+            return prefetches[-1]
+
+        with mock.patch('send_money.forms.DebitCardAmountForm.prefetch_prisoner_account_balance',
+                        side_effect=recording_prefetch) as mock_prefetch, \
+                responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url(f'/prisoner_account_balances/{self.prisoner_number}'),
+                json={
+                    'combined_account_balance': 80001
+                },
+                status=200,
+            )
+            with self.patch_prisoner_details_check():
+                self.client.post(DebitCardPrisonerDetailsTestCase.url, data={
+                    'prisoner_name': 'John Smith',
+                    'prisoner_number': self.prisoner_number,
+                    'prisoner_dob_0': '4',
+                    'prisoner_dob_1': '10',
+                    'prisoner_dob_2': '1980',
+                })
+            mock_prefetch.assert_called_once_with(self.prisoner_number)
+            prefetches[0].result()
+
+        with self.patch_prisoner_details_check(), responses.RequestsMock():
+            # no requests are made
+            response = self.client.post(self.url, data={'amount': '100'}, follow=True)
+        self.assertContains(response, 'It has reached its limit for now')
+
     def test_amount_form_works_when_prisoner_capping_disabled(self):
         self.choose_debit_card_payment_method()
         self.fill_in_prisoner_details()
@@ -468,6 +515,40 @@ class DebitCardCheckTestCase(DebitCardFlowTestCase):
         self.assertIn('£17', content)
         self.assertIn('£18.55', content)
 
+    def test_validated_steps_are_not_checked_again(self):
+        self.choose_debit_card_payment_method()
+        self.fill_in_prisoner_details()
+        self.fill_in_amount()
+        with self.patch_prisoner_details_check() as mock_prisoner_check, \
+                self.patch_prisoner_balance_check() as mock_balance_check:
+            response = self.client.get(self.url)
+        self.assertOnPage(response, 'check_details')
+        mock_prisoner_check.assert_not_called()
+        mock_balance_check.assert_not_called()
+
+    def test_validated_steps_are_checked_again_when_changed_or_expired(self):
+        self.choose_debit_card_payment_method()
+        self.fill_in_prisoner_details()
+        self.fill_in_amount()
+        session = self.client.session
+        session['amount'] = '18.00'
+        session.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        with self.patch_prisoner_details_check() as mock_prisoner_check, \
+                self.patch_prisoner_balance_check() as mock_balance_check:
+            response = self.client.get(self.url)
+        self.assertOnPage(response, 'check_details')
+        mock_prisoner_check.assert_not_called()
+        mock_balance_check.assert_called_once()
+
+        with override_settings(VALIDATED_STEP_TTL=-1), \
+                self.patch_prisoner_details_check() as mock_prisoner_check, \
+                self.patch_prisoner_balance_check() as mock_balance_check:
+            response = self.client.get(self.url)
+        self.assertOnPage(response, 'check_details')
+        mock_prisoner_check.assert_called_once()
+        mock_balance_check.assert_called_once()
+
 
 @patch_notifications()
 @patch_gov_uk_pay_availability_check()
@@ -631,6 +712,21 @@ class DebitCardPaymentTestCase(DebitCardFlowTestCase):
                 response = self.client.get(self.url, follow=False)
             self.assertContains(response, 'We are experiencing technical problems')
 
+    def test_debit_card_payment_fails_fast_when_govuk_pay_is_unavailable(self):
+        self.choose_debit_card_payment_method()
+        self.fill_in_prisoner_details()
+        self.fill_in_amount()
+
+        circuit_breaker = CircuitBreaker.get('govuk_pay')
+        self.addCleanup(circuit_breaker.reset)
+        circuit_breaker.open(time.monotonic())
+        with responses.RequestsMock() as rsps:
+            with self.patch_prisoner_details_check(), self.patch_prisoner_balance_check(), silence_logger():
+                response = self.client.get(self.url, follow=False)
+            self.assertContains(response, 'We are experiencing technical problems')
+            # no payment is created
+            self.assertEqual(len(rsps.calls), 0)
+
 
 @patch_notifications()
 @patch_gov_uk_pay_availability_check()
@@ -878,6 +974,70 @@ class DebitCardConfirmationTestCase(DebitCardFlowTestCase):
         self.assertEqual(send_email_kwargs['personalisation']['short_payment_ref'], 'WARGLE-B')
         self.assertEqual(send_email_kwargs['personalisation']['amount'], '£17.00')
 
+    def test_webhook_leaves_payment_to_view(self, mock_send_email):
+        """
+        Test that when GOV.UK Pay notifies that a payment is capturable while the view is completing it,
+        the webhook task does not complete the recently modified payment again so it is only captured once.
+        """
+        self.choose_debit_card_payment_method()
+        self.fill_in_prisoner_details()
+        self.fill_in_amount()
+
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(
+                rsps.GET,
+                api_url(f'/payments/{self.ref}/'),
+                json=self.payment_data,
+                status=200,
+            )
+            govuk_payment = rsps.add(
+                rsps.GET,
+                govuk_url(f'/payments/{self.processor_id}/'),
+                json={
+                    'payment_id': self.processor_id,
+                    'reference': self.ref,
+                    'state': {'status': 'capturable'},
+                    'email': 'sender@outside.local',
+                    'settlement_summary': {
+                        'capture_submit_time': None,
+                        'captured_date': None,
+                    },
+                },
+                status=200,
+            )
+            rsps.add(
+                rsps.PATCH,
+                api_url(f'/payments/{self.ref}/'),
+                json={
+                    **self.payment_data,
+                    'email': 'sender@outside.local',
+                    'security_check': {
+                        'status': 'accepted',
+                        'user_actioned': False,
+                    },
+                },
+                status=200,
+            )
+            capture = rsps.add(
+                rsps.POST,
+                govuk_url(f'/payments/{self.processor_id}/capture/'),
+                status=204,
+            )
+            with self.patch_prisoner_details_check(), self.patch_prisoner_balance_check():
+                response = self.client.get(
+                    self.url,
+                    {'payment_ref': self.ref},
+                    follow=False,
+                )
+            # the MTP payment is still pending as it has not been captured yet
+            update_payment_from_govuk_pay(payment_ref=self.ref, govuk_id=self.processor_id)
+
+            self.assertEqual(govuk_payment.call_count, 1)
+            self.assertEqual(capture.call_count, 1)
+        self.assertContains(response, 'success')
+        mock_send_email.assert_not_called()
+
     def assertOnPaymentDeclinedPage(self, response, mock_send_email):  # noqa: N802
         """
         Payment was declined by card issuer or WorldPay (e.g. due to insufficient funds or risk management)
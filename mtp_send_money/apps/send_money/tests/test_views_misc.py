@@ -1,11 +1,16 @@
+import hashlib
+import hmac
 from http import HTTPStatus
 import json
+import tempfile
 from unittest import mock
 from xml.etree import ElementTree
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.test import override_settings, SimpleTestCase
 from django.urls import reverse, reverse_lazy
+from django.utils import timezone
 from django.utils.cache import get_max_age
 from django.utils.translation import override as override_lang
 from mtp_common.analytics import AnalyticsPolicy
@@ -18,6 +23,7 @@ from send_money.tests import (
     patch_notifications,
     patch_gov_uk_pay_availability_check
 )
+from send_money.utils import api_url, govuk_url
 
 
 @patch_notifications()
@@ -256,3 +262,128 @@ class PerformancePlatformTestCase(SimpleTestCase):
 
                 api_request = rsps.calls[1].request
                 self.assertDictEqual(api_request.params, {'week__gte': from_param, 'week__lt': to_param})
+
+
+@override_settings(GOVUK_PAY_URL='https://pay.gov.local/v1', GOVUK_PAY_WEBHOOK_SIGNING_SECRET='webhook-secret')
+class GovUkPayWebhookTestCase(SimpleTestCase):
+    message = {
+        'webhook_message_id': 'message-1',
+        'resource_id': 'govuk-1',
+        'resource_type': 'payment',
+        'event_type': 'card_payment_expired',
+        'resource': {
+            'payment_id': 'govuk-1',
+            'reference': 'wargle-1111',
+            'state': {'status': 'failed', 'finished': True},
+        },
+    }
+
+    def setUp(self):
+        super().setUp()
+        reference_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(reference_directory.cleanup)
+        settings_override = override_settings(NOTIFICATION_EMAIL_REFERENCE_DIRECTORY=reference_directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def post_message(self, message, secret='webhook-secret'):
+        body = json.dumps(message).encode()
+        signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return self.client.post(
+            reverse('govuk_pay_webhook'), data=body, content_type='application/json',
+            HTTP_PAY_SIGNATURE=signature,
+        )
+
+    @override_settings(GOVUK_PAY_WEBHOOK_SIGNING_SECRET='')
+    def test_disabled_without_secret(self):
+        with silence_logger(name='django.request'):
+            response = self.post_message(self.message, secret='')
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    @override_settings(NOTIFICATION_EMAIL_REFERENCE_DIRECTORY='')
+    @mock.patch('send_money.views_misc.update_payment_from_govuk_pay')
+    def test_disabled_without_email_reference_directory(self, mock_update_payment):
+        with self.assertRaises(ImproperlyConfigured), silence_logger(name='django.request'):
+            self.post_message(self.message)
+        mock_update_payment.assert_not_called()
+
+    @mock.patch('send_money.views_misc.update_payment_from_govuk_pay')
+    def test_invalid_signature(self, mock_update_payment):
+        with silence_logger(), silence_logger(name='django.request'):
+            response = self.post_message(self.message, secret='wrong-secret')
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        mock_update_payment.assert_not_called()
+
+    @mock.patch('send_money.views_misc.update_payment_from_govuk_pay')
+    def test_ignored_events(self, mock_update_payment):
+        response = self.post_message({**self.message, 'event_type': 'card_payment_refunded'})
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        mock_update_payment.assert_not_called()
+
+    @mock.patch('send_money.mail.send_email')
+    def test_payment_is_updated(self, mock_send_email):
+        payment = {
+            'uuid': 'wargle-1111',
+            'processor_id': 'govuk-1',
+            'recipient_name': 'John',
+            'amount': 1700,
+            'status': 'pending',
+            'email': 'sender@outside.local',
+            'created': '2021-01-01T10:00:00Z',
+            'modified': '2021-01-01T10:00:00Z',
+            'prisoner_number': 'A1409AE',
+            'prisoner_dob': '1989-01-21',
+            'security_check': {'status': 'accepted', 'user_actioned': False},
+        }
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(rsps.GET, api_url('/payments/wargle-1111/'), json=payment)
+            rsps.add(rsps.GET, govuk_url('/payments/govuk-1/'), status=404)
+            rsps.add(rsps.PATCH, api_url('/payments/wargle-1111/'), json={**payment, 'status': 'failed'})
+
+            response = self.post_message(self.message)
+
+            self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+            self.assertEqual(json.loads(rsps.calls[-1].request.body)['status'], 'failed')
+
+    def test_recently_modified_payments_are_not_updated(self):
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(rsps.GET, api_url('/payments/wargle-1111/'), json={
+                'uuid': 'wargle-1111',
+                'processor_id': 'govuk-1',
+                'status': 'pending',
+                'modified': timezone.now().isoformat(),
+            })
+
+            with silence_logger():
+                response = self.post_message(self.message)
+
+            self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+            self.assertEqual(len(rsps.calls), 2)
+
+    def test_payment_lookup_errors_are_logged(self):
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(rsps.GET, api_url('/payments/wargle-1111/'), status=500)
+
+            with self.assertLogs('mtp', level='ERROR') as logs:
+                response = self.post_message(self.message)
+
+            self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+            self.assertIn('GOV.UK Pay webhook: Payment check failed', logs.output[0])
+
+    def test_completed_payments_are_not_updated(self):
+        with responses.RequestsMock() as rsps:
+            mock_auth(rsps)
+            rsps.add(rsps.GET, api_url('/payments/wargle-1111/'), json={
+                'uuid': 'wargle-1111',
+                'processor_id': 'govuk-1',
+                'status': 'taken',
+            })
+
+            with silence_logger():
+                response = self.post_message(self.message)
+
+            self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+            self.assertEqual(len(rsps.calls), 2)
@@ -2,6 +2,8 @@ import datetime
 from decimal import Decimal, ROUND_DOWN, ROUND_UP
 import logging
 import re
+import threading
+import time
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
@@ -11,24 +13,168 @@ from django.utils.cache import patch_cache_control
 from django.utils.dateformat import format as format_date
 from django.utils.dateparse import parse_date
 from django.utils.encoding import force_str
-from django.utils.translation import gettext_lazy as _
+from django.utils.translation import get_language, gettext_lazy as _
 from django.views.generic import TemplateView
 from mtp_common.auth import api_client, urljoin
+from oauthlib.oauth2 import LegacyApplicationClient, OAuth2Error
 import requests
-from requests.exceptions import Timeout
+from requests.exceptions import RequestException, Timeout
+
+from send_money.circuit_breaker import CircuitBreaker, CircuitBreakerAdapter
 
 logger = logging.getLogger('mtp')
 prisoner_number_re = re.compile(r'^[a-z]\d\d\d\d[a-z]{2}$', re.IGNORECASE)
 
 
-def get_api_session():
-    return api_client.get_authenticated_api_session(
-        settings.SHARED_API_USERNAME,
-        settings.SHARED_API_PASSWORD,
-    )
+class ApiSessionManager:
+    """
+    Authenticates the shared send-money user once per process rather than once per session.
+
+    The access token is shared by all threads but each thread gets its own MTP API session and so its own
+    connection pool. Once the token expires within API_TOKEN_RENEWAL_MARGIN seconds, a new one is obtained
+    in a background thread so that requests only wait for a token grant if there is no valid token at all,
+    and then only one grant is made for all waiting threads.
+    """
+    shared_manager_lock = threading.Lock()
+    _shared_manager = None
+
+    @classmethod
+    def shared_manager(cls):
+        with cls.shared_manager_lock:
+            if cls._shared_manager is None:
+                cls._shared_manager = cls()
+            return cls._shared_manager
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the token and all sessions
+        """
+        with self.lock:
+            self.token = None
+            self.renewing = False
+            self.local = threading.local()
+
+    @classmethod
+    def fetch_token(cls):
+        with CircuitBreaker.get('api').guard():
+            session = api_client.get_authenticated_api_session(
+                settings.SHARED_API_USERNAME,
+                settings.SHARED_API_PASSWORD,
+            )
+        return session.token
+
+    @classmethod
+    def get_seconds_to_expiry(cls, token):
+        expires_at = token.get('expires_at')
+        if expires_at is None:
+            return float('inf')
+        return expires_at - time.time()
+
+    def get_token(self, rejected_token=None):
+        """
+        :param rejected_token: token that the API did not accept so must be replaced unless it already was
+        """
+        with self.lock:
+            token = self.token
+            if token is None or token is rejected_token or self.get_seconds_to_expiry(token) <= 0:
+                token = self.token = self.fetch_token()
+            elif self.get_seconds_to_expiry(token) < settings.API_TOKEN_RENEWAL_MARGIN and not self.renewing:
+                self.renewing = True
+                threading.Thread(target=self.renew_token, name='renew_api_token', daemon=True).start()
+            return token
+
+    def renew_token(self):
+        try:
+            token = self.fetch_token()
+        except (RequestException, OAuth2Error):
+            # tried again by the next request; the current token is used until it expires
+            logger.warning('Could not renew MTP API access token', exc_info=True)
+            token = None
+        with self.lock:
+            if token:
+                self.token = token
+            self.renewing = False
+
+    def get_session(self, reconnect=False):
+        """
+        :param reconnect: True if the API rejected this thread's access token
+        :return: this thread's MTP API session using the shared access token
+        """
+        session = getattr(self.local, 'session', None)
+        token = self.get_token(rejected_token=session.token if reconnect and session else None)
+        if session is None:
+            session = api_client.MoJOAuth2Session(
+                client=LegacyApplicationClient(client_id=settings.API_CLIENT_ID),
+            )
+            adapter = CircuitBreakerAdapter(CircuitBreaker.get('api'))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self.local.session = session
+        session.token = token
+        # sessions outlive requests which may be in different languages
+        session.headers['Accept-Language'] = get_language() or settings.LANGUAGE_CODE
+        return session
+
+
+def get_api_session(reconnect=False):
+    """
+    :param reconnect: True if the API rejected the access token of the last session returned
+    :return: MTP API session authenticated as the shared user whose requests go through the API's circuit breaker;
+        sessions are only used by the thread they are returned to
+    """
+    return ApiSessionManager.shared_manager().get_session(reconnect=reconnect)
 
 
-def check_payment_service_available():
+class StaleWhileRevalidateValue:
+    """
+    Process-wide cached result of `fetch` which is refreshed in a background thread once older than
+    `ttl` seconds so that callers never wait for it: the stale value is returned in the meantime
+    and `default` until the first fetch completes. Only one refresh runs at a time.
+    """
+
+    def __init__(self, fetch, ttl, default):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.default = default
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.value = self.default
+        self.fetched_at = None
+        self.refreshing = None
+
+    def get(self):
+        with self.lock:
+            if not self.refreshing and (
+                self.fetched_at is None or time.monotonic() - self.fetched_at >= self.ttl
+            ):
+                self.refreshing = threading.Thread(
+                    target=self.refresh, name=f'refresh_{self.fetch.__name__}', daemon=True,
+                )
+                self.refreshing.start()
+            return self.value
+
+    def refresh(self):
+        try:
+            value = self.fetch()
+            with self.lock:
+                self.value = value
+        except Exception:
+            # the previous value is kept until the next refresh
+            logger.warning('Could not refresh %(name)s', {'name': self.fetch.__name__}, exc_info=True)
+        finally:
+            # a failed refresh must not stop later ones
+            with self.lock:
+                self.fetched_at = time.monotonic()
+                self.refreshing = None
+
+
+def fetch_payment_service_availability():
     # service is deemed unavailable only if status is explicitly false, not if it cannot be determined
     try:
         response = requests.get(api_url('/service-availability/'), timeout=5)
@@ -38,6 +184,21 @@ def check_payment_service_available():
         return True, None
 
 
+payment_service_availability = StaleWhileRevalidateValue(
+    fetch_payment_service_availability,
+    ttl=settings.SERVICE_AVAILABILITY_CACHE_TTL,
+    default=(True, None),
+)
+
+
+def check_payment_service_available():
+    """
+    :return: (available, message to users) as last loaded from `/service-availability/`
+        without waiting for the MTP API; see fetch_payment_service_availability
+    """
+    return payment_service_availability.get()
+
+
 def validate_prisoner_number(value):
     if not prisoner_number_re.match(value):
         raise ValidationError(_('Incorrect prisoner number format'), code='invalid')
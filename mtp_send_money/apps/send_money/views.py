@@ -12,6 +12,7 @@ from oauthlib.oauth2 import OAuth2Error
 from requests.exceptions import RequestException
 
 from send_money import forms as send_money_forms
+from send_money.circuit_breaker import CircuitOpenError
 from send_money.exceptions import GovUkPaymentStatusException
 from send_money.models import PaymentMethodBankTransferEnabled as PaymentMethod
 from send_money.payments import is_active_payment, GovUkPaymentStatus, PaymentClient
@@ -107,6 +108,7 @@ class SendMoneyView(View):
             form = view.form_class.unserialise_from_session(request)
             if form.is_valid():
                 self.valid_form_data[view.url_name] = form.cleaned_data
+                form.record_validation()
             else:
                 return redirect(build_view_url(self.request, view.url_name))
         # if choose method form has been used and we are in the wrong flow, redirect
@@ -189,6 +191,11 @@ class DebitCardPrisonerDetailsView(DebitCardFlow, SendMoneyFormView):
     template_name = 'send_money/debit-card-prisoner-details.html'
     form_class = send_money_forms.DebitCardPrisonerDetailsForm
 
+    def form_valid(self, form):
+        # the balance is needed once the amount is entered
+        send_money_forms.DebitCardAmountForm.prefetch_prisoner_account_balance(form.cleaned_data['prisoner_number'])
+        return super().form_valid(form)
+
     def get_success_url(self):
         return build_view_url(self.request, DebitCardAmountView.url_name)
 
@@ -258,6 +265,10 @@ class DebitCardPaymentView(DebitCardFlow):
         failure_context = {
             'short_payment_ref': _('Not known')
         }
+        if PaymentClient.is_unavailable():
+            # do not create payments that could not be paid or wait for upstreams known to be failing
+            logger.warning('Not creating new payment because the MTP API or GOV.UK Pay is unavailable')
+            return render(request, 'send_money/debit-card-error.html', failure_context)
         try:
             payment_client = PaymentClient()
             new_payment = {
@@ -288,6 +299,8 @@ class DebitCardPaymentView(DebitCardFlow):
                 return redirect(get_link_by_rel(govuk_payment, 'next_url'))
         except OAuth2Error:
             logger.exception('Authentication error')
+        except CircuitOpenError:
+            logger.warning('Failed to create new payment (ref %s) because an upstream is unavailable', payment_ref)
         except RequestException:
             logger.exception('Failed to create new payment (ref %s)', payment_ref)
 
@@ -387,6 +400,12 @@ class DebitCardConfirmationView(TemplateView):
                 {'payment_ref': payment_ref},
             )
             self.status = GovUkPaymentStatus.error
+        except CircuitOpenError:
+            logger.warning(
+                'Payment check skipped for ref %(payment_ref)s because an upstream is unavailable',
+                {'payment_ref': payment_ref},
+            )
+            self.status = GovUkPaymentStatus.error
         except RequestException as error:
             response_content = get_requests_exception_for_logging(error)
             logger.exception(
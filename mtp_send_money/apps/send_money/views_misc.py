@@ -1,22 +1,30 @@
 import csv
 import datetime
 import json
+import logging
 import warnings
 
 from django import forms
 from django.conf import settings
-from django.http import HttpResponse
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.shortcuts import redirect
 from django.urls import reverse, reverse_lazy
 from django.utils.cache import patch_cache_control
 from django.utils.dateparse import parse_date
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.utils.translation import gettext_lazy as _, override as override_language
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.views.generic import FormView, RedirectView, TemplateView, View
 from mtp_common.analytics import AnalyticsPolicy
 
+from send_money.govuk_pay import is_valid_webhook_signature
+from send_money.tasks import update_payment_from_govuk_pay
 from send_money.utils import api_url, get_api_session, make_response_cacheable
 
+logger = logging.getLogger('mtp')
+
 
 class CookiesForm(forms.Form):
     accept_cookies = forms.ChoiceField(label=_('Accept cookies to improve the service'), choices=(
@@ -182,6 +190,40 @@ class SitemapXMLView(TemplateView):
         return make_response_cacheable(response)
 
 
+# GOV.UK Pay payment events that cannot lead to a payment being completed
+IGNORED_GOVUK_PAY_WEBHOOK_EVENTS = {'card_payment_started', 'card_payment_refunded'}
+
+
+@csrf_exempt
+@require_POST
+def govuk_pay_webhook_view(request):
+    """
+    Receives GOV.UK Pay webhook messages about payment events (e.g. capturable, succeeded, failed and expired)
+    and updates the payment in the same way as `update_incomplete_payments`, in the spooler if it is installed.
+    `update_incomplete_payments` still runs to update payments whose messages are lost.
+    """
+    if not settings.GOVUK_PAY_WEBHOOK_SIGNING_SECRET:
+        raise Http404('GOV.UK Pay webhooks are not enabled')
+    if not settings.NOTIFICATION_EMAIL_REFERENCE_DIRECTORY:
+        # payments are completed by webhooks as well as the confirmation page and `update_incomplete_payments`
+        raise ImproperlyConfigured('GOV.UK Pay webhooks require NOTIFICATION_EMAIL_REFERENCE_DIRECTORY to be set '
+                                   'so that emails are never sent twice')
+    if not is_valid_webhook_signature(request.body, request.headers.get('Pay-Signature')):
+        logger.warning('GOV.UK Pay webhook: Message with invalid signature received')
+        return HttpResponseForbidden()
+    try:
+        message = json.loads(request.body)
+        event_type = message['event_type']
+        resource_type = message['resource_type']
+        govuk_id = message['resource_id']
+        payment_ref = message.get('resource', {}).get('reference')
+    except (ValueError, KeyError, AttributeError):
+        return HttpResponseBadRequest()
+    if resource_type == 'payment' and payment_ref and event_type not in IGNORED_GOVUK_PAY_WEBHOOK_EVENTS:
+        update_payment_from_govuk_pay(payment_ref=payment_ref, govuk_id=govuk_id)
+    return HttpResponse(status=204)
+
+
 class LegacyFeedbackView(RedirectView):
     url = reverse_lazy('help_area:help')
     permanent = True
@@ -3,6 +3,7 @@ from functools import partial
 import os
 from os.path import abspath, dirname, join
 import sys
+import tempfile
 from urllib.parse import urljoin
 
 BASE_DIR = dirname(dirname(abspath(__file__)))
@@ -250,6 +251,8 @@ AUTHENTICATION_BACKENDS = (
 API_CLIENT_ID = 'send-money'
 API_CLIENT_SECRET = os.environ.get('API_CLIENT_SECRET', 'send-money')
 API_URL = os.environ.get('API_URL', 'http://localhost:8000')
+# in seconds, how long before the shared user's access token expires that a new one is obtained in the background
+API_TOKEN_RENEWAL_MARGIN = int(os.environ.get('API_TOKEN_RENEWAL_MARGIN', 2 * 60))
 
 SHARED_API_USERNAME = os.environ.get('SHARED_API_USERNAME', 'send-money')
 SHARED_API_PASSWORD = os.environ.get('SHARED_API_PASSWORD', 'send-money')
@@ -267,6 +270,45 @@ PAYMENT_DELAYED_CAPTURE_ROLLOUT_PERCENTAGE = os.environ.get('PAYMENT_DELAYED_CAP
 CHECK_INCOMPLETE_PAYMENT_DELAY = int(  # in minutes
     os.environ.get('CHECK_INCOMPLETE_PAYMENT_DELAY', 30),
 )
+# number of payments checked concurrently by `update_incomplete_payments`
+UPDATE_INCOMPLETE_PAYMENTS_WORKERS = int(
+    os.environ.get('UPDATE_INCOMPLETE_PAYMENTS_WORKERS', 1),
+)
+# number of completed payments saved in one request by `update_incomplete_payments`
+UPDATE_INCOMPLETE_PAYMENTS_BATCH_SIZE = int(
+    os.environ.get('UPDATE_INCOMPLETE_PAYMENTS_BATCH_SIZE', 1),
+)
+# SQLite database where `update_incomplete_payments` run by cron records checks to back off from unchanging payments;
+# should be on persistent storage; not used if blank; the daemon keeps its checks in memory
+UPDATE_INCOMPLETE_PAYMENTS_STATE_PATH = os.environ.get('UPDATE_INCOMPLETE_PAYMENTS_STATE_PATH', '')
+# number of hash ranges of payments that `update_incomplete_payments` running on all instances take leases on;
+# if 1, it only runs on the first instance
+UPDATE_INCOMPLETE_PAYMENTS_PARTITIONS = int(
+    os.environ.get('UPDATE_INCOMPLETE_PAYMENTS_PARTITIONS', 1),
+)
+# directory shared by all instances where leases on partitions are kept
+UPDATE_INCOMPLETE_PAYMENTS_LEASE_DIRECTORY = os.environ.get(
+    'UPDATE_INCOMPLETE_PAYMENTS_LEASE_DIRECTORY',
+    os.path.join(tempfile.gettempdir(), 'mtp-send-money-leases'),
+)
+# in seconds, should be shorter than the interval between runs
+UPDATE_INCOMPLETE_PAYMENTS_LEASE_DURATION = int(
+    os.environ.get('UPDATE_INCOMPLETE_PAYMENTS_LEASE_DURATION', 300),
+)
+# in seconds, `update_incomplete_payments` stops checking new payments after this long so that runs started
+# every 15 minutes by cron do not overlap; 0 for no limit
+UPDATE_INCOMPLETE_PAYMENTS_TIME_BUDGET = int(os.environ.get('UPDATE_INCOMPLETE_PAYMENTS_TIME_BUDGET', 13 * 60))
+# file locked by the running `update_incomplete_payments` so that a new run exits if the previous one is still active
+UPDATE_INCOMPLETE_PAYMENTS_LOCK_PATH = os.environ.get(
+    'UPDATE_INCOMPLETE_PAYMENTS_LOCK_PATH',
+    os.path.join(tempfile.gettempdir(), 'mtp-send-money-update_incomplete_payments.lock'),
+)
+# file that prometheus metrics of `update_incomplete_payments` are written to for node-exporter's textfile collector,
+# e.g. /var/lib/node_exporter/textfile_collector/update_incomplete_payments.prom; not collected if blank
+UPDATE_INCOMPLETE_PAYMENTS_METRICS_PATH = os.environ.get('UPDATE_INCOMPLETE_PAYMENTS_METRICS_PATH', '')
+# in seconds, how often `update_incomplete_payments --daemon` lists incomplete payments to find new ones
+# and those whose security check changed
+UPDATE_INCOMPLETE_PAYMENTS_POLL_INTERVAL = int(os.environ.get('UPDATE_INCOMPLETE_PAYMENTS_POLL_INTERVAL', 60))
 
 SERVICE_CHARGE_PERCENTAGE = Decimal(
     os.environ.get('SERVICE_CHARGE_PERCENTAGE', '0')
@@ -295,14 +337,61 @@ COMPLIANCE_CONTACT_EMAIL = os.environ.get('COMPLIANCE_CONTACT_EMAIL', '')
 
 SHOW_LANGUAGE_SWITCH = os.environ.get('SHOW_LANGUAGE_SWITCH', 'False') == 'True'
 CONFIRMATION_EXPIRES = 60  # minutes
+# in seconds, how long the availability of payments loaded from `/service-availability/` is used before
+# being refreshed in the background
+SERVICE_AVAILABILITY_CACHE_TTL = int(os.environ.get('SERVICE_AVAILABILITY_CACHE_TTL', 30))
+# in seconds, how long prisoner details and amounts checked against the MTP API are trusted by later pages
+# without checking them again
+VALIDATED_STEP_TTL = int(os.environ.get('VALIDATED_STEP_TTL', 10 * 60))
+# in seconds, how long responses from `/prisoner_validity/` are cached for and for lookups matching no prisoner
+PRISONER_VALIDITY_CACHE_TTL = int(os.environ.get('PRISONER_VALIDITY_CACHE_TTL', 5 * 60))
+PRISONER_VALIDITY_NEGATIVE_CACHE_TTL = int(os.environ.get('PRISONER_VALIDITY_NEGATIVE_CACHE_TTL', 30))
 
 GOVUK_PAY_URL = os.environ.get('GOVUK_PAY_URL', '')
 GOVUK_PAY_AUTH_TOKEN = os.environ.get('GOVUK_PAY_AUTH_TOKEN', '')
+# secret that GOV.UK Pay signs webhook messages with; the webhook endpoint is disabled if blank
+GOVUK_PAY_WEBHOOK_SIGNING_SECRET = os.environ.get('GOVUK_PAY_WEBHOOK_SIGNING_SECRET', '')
+# maximum number of keep-alive connections to GOV.UK Pay kept open by each process
+GOVUK_PAY_POOL_SIZE = int(os.environ.get('GOVUK_PAY_POOL_SIZE', 20))
+GOVUK_PAY_TIMEOUTS = {  # in seconds, by GOV.UK Pay endpoint
+    'default': 15,
+    'create_payment': 15,
+    'get_payment': 15,
+    'get_payment_events': 15,
+    'capture_payment': 15,
+    'cancel_payment': 15,
+    'search_payments': 30,
+}
+# maximum number of requests per second all processes of an instance make to GOV.UK Pay;
+# should be GOV.UK Pay's limit divided by the number of instances
+GOVUK_PAY_RATE_LIMIT = float(os.environ.get('GOVUK_PAY_RATE_LIMIT', 25))
+# number of processes of an instance making requests to GOV.UK Pay which each get an equal share of the rate:
+# 2 uWSGI workers, the spooler and `update_incomplete_payments`
+GOVUK_PAY_RATE_LIMIT_PROCESSES = int(os.environ.get('GOVUK_PAY_RATE_LIMIT_PROCESSES', 4))
+# part of the rate that only requests made on behalf of users can use;
+# divided between processes like the rate so it only holds back background requests made by the same process
+GOVUK_PAY_RATE_LIMIT_INTERACTIVE_RESERVE = float(os.environ.get('GOVUK_PAY_RATE_LIMIT_INTERACTIVE_RESERVE', 5))
+# number of times requests rejected with 429 Too Many Requests are retried
+GOVUK_PAY_RATE_LIMIT_RETRIES = int(os.environ.get('GOVUK_PAY_RATE_LIMIT_RETRIES', 3))
+# requests made on behalf of users are never held back for longer than this (in seconds)
+GOVUK_PAY_RATE_LIMIT_MAX_INTERACTIVE_WAIT = float(os.environ.get('GOVUK_PAY_RATE_LIMIT_MAX_INTERACTIVE_WAIT', 2))
+
+# requests to the MTP API or GOV.UK Pay fail immediately for CIRCUIT_BREAKER_OPEN_DURATION seconds when
+# at least this fraction of requests made to it in the last CIRCUIT_BREAKER_WINDOW seconds failed
+CIRCUIT_BREAKER_FAILURE_RATE = float(os.environ.get('CIRCUIT_BREAKER_FAILURE_RATE', 0.5))
+# provided there were at least this many
+CIRCUIT_BREAKER_MINIMUM_REQUESTS = int(os.environ.get('CIRCUIT_BREAKER_MINIMUM_REQUESTS', 10))
+CIRCUIT_BREAKER_WINDOW = float(os.environ.get('CIRCUIT_BREAKER_WINDOW', 60))
+CIRCUIT_BREAKER_OPEN_DURATION = float(os.environ.get('CIRCUIT_BREAKER_OPEN_DURATION', 30))
 
 GOVUK_NOTIFY_API_KEY = os.environ.get('GOVUK_NOTIFY_API_KEY', '')
 GOVUK_NOTIFY_REPLY_TO_PUBLIC = os.environ.get('GOVUK_NOTIFY_REPLY_TO_PUBLIC', '')
 GOVUK_NOTIFY_REPLY_TO_STAFF = os.environ.get('GOVUK_NOTIFY_REPLY_TO_STAFF', '')
 GOVUK_NOTIFY_BLOCKED_DOMAINS = set(os.environ.get('GOVUK_NOTIFY_BLOCKED_DOMAINS', '').split())
+# directory shared by all instances where references of notification emails sent are kept
+# so that the same email is never sent twice; set by send_money.ini when running in uWSGI;
+# emails are not de-duplicated if blank, which the daemon and webhooks do not allow
+NOTIFICATION_EMAIL_REFERENCE_DIRECTORY = os.environ.get('NOTIFICATION_EMAIL_REFERENCE_DIRECTORY', '')
 # install GOV.UK Notify fallback for emails accidentally sent using Django's email functionality:
 EMAIL_BACKEND = 'mtp_common.notify.email_backend.NotifyEmailBackend'
 
@@ -318,6 +407,9 @@ PRISONER_CAPPING_ENABLED = bool(
 PRISONER_CAPPING_THRESHOLD_IN_POUNDS = Decimal(
     os.environ.get('PRISONER_CAPPING_THRESHOLD_IN_POUNDS', '900')
 )  # always use `Decimal` in pounds
+# in seconds, how long prisoner account balances loaded in the background once prisoner details are entered
+# are used by the amount form
+PRISONER_BALANCE_PREFETCH_TTL = int(os.environ.get('PRISONER_BALANCE_PREFETCH_TTL', 2 * 60))
 
 try:
     from .local import *  # noqa
@@ -14,6 +14,7 @@ from send_money.views_misc import (
     LegacyFeedbackView,
     SitemapXMLView,
     PerformanceDataCsvView,
+    govuk_pay_webhook_view,
     robots_txt_view,
 )
 
@@ -48,6 +49,7 @@ urlpatterns += [
     ), name='ping_json'),
     re_path(r'^healthcheck.json$', HealthcheckView.as_view(), name='healthcheck_json'),
     re_path(r'^metrics.txt$', metrics_view, name='prometheus_metrics'),
+    re_path(r'^webhooks/govuk-pay/$', govuk_pay_webhook_view, name='govuk_pay_webhook'),
 
     re_path(r'^robots.txt$', robots_txt_view),
     re_path(r'^performance-data.csv$', PerformanceDataCsvView.as_view(), name='performance_data_csv'),